@@ -21,6 +21,120 @@ Configuration:
     # Default is loop.
     # Only used by the service.
     binding = loop
+
+    # The records are queued in memory and written by a separate thread,
+    # so the engine thread never waits on the database.
+    # The writer commits a batch of rows in one transaction when it has batch_size rows,
+    # or batch_interval milliseconds after the first row of the batch, whichever comes first.
+    # Default is 50.
+    batch_size = 50
+    # Default is 1000.
+    batch_interval = 1000
+    # The most records waiting to be written. When full, records are dropped, and counted, instead of waiting.
+    # Default is 1000.
+    queue_size = 1000
+    # How often, in seconds, the writer logs its metrics: batch sizes, queue depth, and dropped rows.
+    # The metrics are also logged when WeeWX shuts down, after all the queued records have been written.
+    # Default is 300.
+    metrics_interval = 300
+
+    # How the records are stored in the data column, json or packed.
+    # packed stores the ids of the field names, from the {table}_fields table, and a binary vector of the values.
+    # It is smaller than json, and faster to encode and decode.
+    # The readers decode both, so the encoding can be changed on an existing queue.
+    # Default is json.
+    encoding = json
+    # Whether to zlib compress the packed records.
+    # Default is False.
+    compress = False
+
+    # Store only the fields of a loop packet that changed from the previous packet,
+    # with a full packet, a keyframe, every keyframe_interval packets.
+    # The keyframes have a dataType of loop and the deltas of loop_delta,
+    # so consumers that only read the loop rows see the keyframes.
+    # QueueReader rebuilds the full packets.
+    # Default is 0, every packet is stored in full.
+    keyframe_interval = 0
+
+    # The retention of the queue. When any limit is exceeded, the oldest rows are deleted.
+    # This is done by the writer thread every prune_interval seconds, in transactions of prune_batch_size rows,
+    # writing the queued records in between, so it never holds the database for long.
+    # The space of the deleted rows is reclaimed vacuum_pages pages at a time, with PRAGMA incremental_vacuum.
+    # This needs auto_vacuum=INCREMENTAL, which is set when the queue is created, or is still empty.
+    # For an existing queue, run 'PRAGMA auto_vacuum=INCREMENTAL;' and 'VACUUM;' once, with WeeWX stopped.
+    # Until then, the rows are deleted but the file does not shrink.
+    # With keyframe_interval, a transaction ends before a keyframe, so it can delete more, or fewer, rows.
+    # The most rows. Default is 0, no limit.
+    max_rows = 0
+    # The oldest row, in seconds. Default is 0, no limit.
+    max_age = 0
+    # The most bytes used by the database. Default is 0, no limit.
+    max_bytes = 0
+    # Default is 300.
+    prune_interval = 300
+    # Default is 500.
+    prune_batch_size = 500
+    # Default is 100.
+    vacuum_pages = 100
+
+    # Where the records are written, sqlite or segmentlog.
+    # segmentlog appends the records, as json, to segment files, for loop rates that sqlite cannot keep up with.
+    # A segment is closed, and a new one started, when it reaches segment_size bytes.
+    # Each segment has a sparse index of the id, dateTime, and offset of a record every index_interval bytes.
+    # The data_binding, encoding, keyframe_interval, prune_batch_size, and vacuum_pages options are not used,
+    # and the retention options delete whole segments.
+    # Default is sqlite.
+    backend = sqlite
+    # A relative path is relative to WEEWX_ROOT.
+    # Default is archive/ext_queue.
+    segment_directory = archive/ext_queue
+    # Default is 16777216.
+    segment_size = 16777216
+    # Default is 65536.
+    index_interval = 65536
+
+    # Announce the ids of the rows as they are committed, so that consumers do not have to poll.
+    # None, socket, or fifo.
+    # With socket, consumers connect to a Unix domain socket, each committed batch is sent to them as 'first_id last_id\n'.
+    # A consumer that is not keeping up is disconnected, instead of making the writer wait.
+    # With fifo, the same lines are written to a named pipe, with one consumer. When the pipe is full, they are dropped.
+    # A dropped announcement only delays the consumer until the next one, it reads from its cursor.
+    # The announcements are sent by the writer thread, never by the engine thread.
+    # Default is None.
+    notify = None
+    # A relative path is relative to WEEWX_ROOT.
+    # Default is archive/ext_queue.notify.
+    notify_path = archive/ext_queue.notify
+
+Reading the queue:
+Consumers read the queue with a QueueReader, from their own process or thread, while the service is writing.
+Each reader has a name, and a cursor on the id of the rows (the sqlite rowid).
+dequeue returns the next rows after the cursor, ack records the rows as read.
+The acknowledged position is kept in the {table}_consumer table, so a reader resumes after the last acknowledged row.
+Rows that were dequeued, but not acknowledged, are returned again after a restart or rewind.
+With delete_acked, the acknowledged rows are deleted. Only use it when there is a single consumer of the rows.
+The newest row is never deleted, so that the ids are never reused.
+Nor are the keyframe and deltas that the unacknowledged deltas are built on.
+The loop rows are returned as full packets, rebuilt from the keyframes and deltas.
+stream reads a range of rows, rebuilding the packets as it goes, without moving the cursor.
+open_reader returns a SegmentLogReader, with the same dequeue, ack, rewind, and stream, when the backend is segmentlog.
+Its seek finds the id to read after to start at a dateTime.
+With notify, a consumer waits for new rows with Notifications, instead of polling.
+
+    with user.queuenotify.Notifications(notify_path) as notifications:
+        while True:
+            rows = reader.dequeue(100)
+            if not rows:
+                notifications.wait(60)
+                continue
+            ...
+
+    import user.externalqueue
+    with user.externalqueue.open_reader(config_dict, name='mqtt', data_type='loop') as reader:
+        rows = reader.dequeue(100)
+        for row in rows:
+            publish(row.record)
+        reader.ack()
 """
 
 # todo - rename table
@@ -29,13 +143,25 @@ Configuration:
 # need to be python 2 compatible pylint: disable=bad-option-value, raise-missing-from, super-with-arguments
 # pylint: enable=bad-option-value
 import json
+import threading
 import time
 import traceback
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue # python 2 compatible pylint: disable=import-error
+
+import weedb
 import weewx
+import weewx.manager
 from weewx.engine import StdService
 
-from weeutil.weeutil import to_bool
+from weeutil.weeutil import option_as_list, to_bool, to_int
+
+from user.queuenotify import FifoNotifier, SocketNotifier, get_notify_path
+from user.queuerecord import DELTA_DATA_TYPE, FieldDictionary, PacketBuilder, QueueRow, delta_record, encode_packed
+from user.segmentlog import SegmentLog, SegmentLogReader, get_segment_directory
 
 VERSION = "0.1"
 
@@ -51,9 +177,9 @@ try:
 
         weeutil.logger.setup('wee_MQTTSS', config_dict)
 
-    def logdbg(msg):
-        """ Log debug level. """
-        log.debug(msg)
+    def logdbg(msg, *args):
+        """ Log debug level, the args are only formatted into msg when debug is logged. """
+        log.debug(msg, *args)
 
     def loginf(msg):
         """ Log informational level. """
@@ -72,9 +198,9 @@ except ImportError:
         # Replace '__name__' with something to identify your application.
         syslog.syslog(level, '__name__: %s:' % msg)
 
-    def logdbg(msg):
+    def logdbg(msg, *args):
         """ Log debug level. """
-        logmsg(syslog.LOG_DEBUG, msg)
+        logmsg(syslog.LOG_DEBUG, msg % args if args else msg)
 
     def loginf(msg):
         """ Log informational level. """
@@ -105,6 +231,585 @@ def gettid():
 
     return 0
 
+INSERT_SQL = "INSERT INTO %s (dateTime, usUnits, interval, dataType, data) VALUES (?, ?, ?, ?, ?);"
+
+def create_indexes(dbm):
+    """ Create the index that keeps reading by dataType a seek, no matter how large the table. """
+    dbm.connection.execute("CREATE INDEX IF NOT EXISTS %s_dataType ON %s (dataType);" % (dbm.table_name, dbm.table_name))
+
+class QueueMetrics(object):
+    """ The batch sizes, queue depth, and dropped rows of the writer. """
+    def __init__(self):
+        self.batches = 0
+        self.rows = 0
+        self.min_batch = None
+        self.max_batch = 0
+        self.max_depth = 0
+        # Dropped by the engine thread because the queue was full.
+        self.dropped_full = 0
+        # Dropped by the writer because the write failed.
+        self.dropped_failed = 0
+        # Deleted by the retention limits.
+        self.pruned = 0
+        # Reclaimed by incremental vacuum.
+        self.vacuumed_pages = 0
+
+    def add_batch(self, size):
+        """ Record a written batch. """
+        self.batches += 1
+        self.rows += size
+        if self.min_batch is None or size < self.min_batch:
+            self.min_batch = size
+        if size > self.max_batch:
+            self.max_batch = size
+
+    def as_dict(self):
+        """ The metrics. """
+        return {
+            'batches': self.batches,
+            'rows': self.rows,
+            'min_batch': self.min_batch,
+            'average_batch': float(self.rows) / self.batches if self.batches else None,
+            'max_batch': self.max_batch,
+            'max_depth': self.max_depth,
+            'dropped': self.dropped_full + self.dropped_failed,
+            'pruned': self.pruned,
+            'vacuumed_pages': self.vacuumed_pages,
+        }
+
+def set_incremental_vacuum(dbm):
+    """ Set auto_vacuum to incremental. This needs a vacuum, so it is only done when the queue is empty.
+        Returns whether it is set. """
+    if dbm.getSql("PRAGMA auto_vacuum;")[0] == 2:
+        return True
+
+    if dbm.getSql("SELECT rowid FROM %s LIMIT 1;" % dbm.table_name) is not None:
+        loginf("auto_vacuum is not INCREMENTAL, the space of the pruned rows will not be reclaimed. "
+               "Run 'PRAGMA auto_vacuum=INCREMENTAL;' and 'VACUUM;' once, with WeeWX stopped.")
+        return False
+
+    dbm.connection.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+    dbm.connection.execute("VACUUM;")
+    return True
+
+class QueuePruner(object):
+    """ Delete the oldest rows, in small batches, to keep the queue within max_rows, max_age, and max_bytes.
+        The newest row is never deleted, so that the ids are never reused. """
+    def __init__(self, max_rows=0, max_age=0, max_bytes=0, batch_size=500, vacuum_pages=100, keyframes=False):
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        # Whether the loop packets are stored as keyframes and deltas.
+        self.keyframes = keyframes
+        # Whether a prune is in progress.
+        self.pending = False
+        self.row_count = None
+        self.cutoff = None
+
+    def enabled(self):
+        """ Whether there are any limits. """
+        return bool(self.max_rows or self.max_age or self.max_bytes)
+
+    def start(self, dbm):
+        """ Start a prune. """
+        self.pending = True
+        self.row_count = dbm.getSql("SELECT COUNT(*) FROM %s;" % dbm.table_name)[0] if self.max_rows else None
+        self.cutoff = time.time() - self.max_age if self.max_age else None
+
+    def used_bytes(self, dbm):
+        """ The bytes used by the database, less the free pages. """
+        page_count = dbm.getSql("PRAGMA page_count;")[0]
+        freelist_count = dbm.getSql("PRAGMA freelist_count;")[0]
+        page_size = dbm.getSql("PRAGMA page_size;")[0]
+        return (page_count - freelist_count) * page_size
+
+    def delete_oldest(self, dbm, count, cutoff=None):
+        """ Delete a batch of up to count of the oldest rows, only the ones older than cutoff when it is set.
+            With keyframes, the batch ends before a keyframe, so that no delta is left without its keyframe.
+            Returns the number deleted. """
+        table_name = dbm.table_name
+        sql = "SELECT rowid FROM %s WHERE rowid < (SELECT MAX(rowid) FROM %s)" % (table_name, table_name)
+        parameters = []
+        if cutoff is not None:
+            sql += " AND dateTime < ?"
+            parameters.append(cutoff)
+        rows = dbm.getSql(sql + " ORDER BY rowid LIMIT 1 OFFSET ?;", parameters + [count - 1])
+        if rows is None:
+            rows = dbm.getSql(sql.replace("SELECT rowid", "SELECT MAX(rowid)", 1) + ";", parameters)
+        last_id = rows[0] if rows else None
+        if last_id is None:
+            return 0
+        if self.keyframes:
+            last_id = self.keyframe_boundary(dbm, last_id)
+
+        with weedb.Transaction(dbm.connection) as cursor:
+            cursor.execute("DELETE FROM %s WHERE rowid <= ?;" % table_name, (last_id,))
+            deleted = cursor.rowcount
+        if self.row_count is not None:
+            self.row_count -= deleted
+        return deleted
+
+    def keyframe_boundary(self, dbm, last_id):
+        """ The last row to delete, moved from last_id so that the oldest loop row kept is a keyframe. """
+        table_name = dbm.table_name
+        next_row = dbm.getSql("SELECT dataType FROM %s WHERE rowid > ? AND dataType IN ('loop', ?) ORDER BY rowid LIMIT 1;"
+                              % table_name, (last_id, DELTA_DATA_TYPE))
+        if next_row is None or next_row[0] != DELTA_DATA_TYPE:
+            return last_id
+        # Delete the rest of the deltas, up to the next keyframe.
+        keyframe_id = dbm.getSql("SELECT MIN(rowid) FROM %s WHERE rowid > ? AND dataType = 'loop';" % table_name, (last_id,))[0]
+        if keyframe_id is None:
+            # The deltas are built on the newest keyframe, keep it.
+            keyframe_id = dbm.getSql("SELECT MAX(rowid) FROM %s WHERE rowid <= ? AND dataType = 'loop';" % table_name, (last_id,))[0]
+        if keyframe_id is None:
+            # There is no keyframe to keep, the deltas are already without one.
+            return last_id
+        return keyframe_id - 1
+
+    def step(self, dbm):
+        """ Do one batch of the prune: delete the oldest rows if a limit is exceeded, otherwise reclaim free pages.
+            Returns the number of rows deleted and pages reclaimed. """
+        # Each limit is checked in turn, the next one when there is nothing left to delete for the one before it.
+        deleted = 0
+        if self.cutoff is not None:
+            deleted = self.delete_oldest(dbm, self.batch_size, self.cutoff)
+            if deleted < self.batch_size:
+                self.cutoff = None
+        if not deleted and self.row_count is not None and self.row_count > self.max_rows:
+            deleted = self.delete_oldest(dbm, min(self.batch_size, self.row_count - self.max_rows))
+        if not deleted and self.max_bytes and self.used_bytes(dbm) > self.max_bytes:
+            deleted = self.delete_oldest(dbm, self.batch_size)
+        if deleted:
+            return deleted, 0
+
+        # The limits are met, or only the newest row is left, reclaim the space.
+        self.row_count = None
+        freelist_count = dbm.getSql("PRAGMA freelist_count;")[0]
+        if freelist_count and dbm.getSql("PRAGMA auto_vacuum;")[0] == 2:
+            # Each step of the pragma frees a page, executescript runs it to completion.
+            dbm.connection.connection.executescript("PRAGMA incremental_vacuum(%i);" % self.vacuum_pages)
+            return 0, freelist_count - dbm.getSql("PRAGMA freelist_count;")[0]
+
+        self.pending = False
+        return 0, 0
+
+class QueueWriter(threading.Thread):
+    """ Write the queued records in batches, off of the engine thread. """
+    def __init__(self, config_dict, data_binding, batch_size=50, batch_interval=1.0, queue_size=1000, metrics_interval=300,
+                 encoding='json', compress=False, keyframe_interval=0, pruner=None, prune_interval=300, notifier=None):
+        super(QueueWriter, self).__init__(name='ExternalQueueWriter')
+        self.daemon = True
+        self.config_dict = config_dict
+        self.data_binding = data_binding
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.metrics_interval = metrics_interval
+        self.encoding = encoding
+        self.compress = compress
+        self.fields = None
+        self.keyframe_interval = keyframe_interval
+        self.previous_packet = None
+        self.since_keyframe = 0
+        self.pruner = pruner or QueuePruner()
+        self.prune_interval = prune_interval
+        self.notifier = notifier
+        self.record_queue = queue.Queue(queue_size)
+        self.metrics = QueueMetrics()
+
+    def put(self, data_type, record):
+        """ Queue a record to be written, without waiting. Returns False if the queue is full and the record is dropped. """
+        try:
+            self.record_queue.put_nowait((data_type, record))
+        except queue.Full:
+            self.metrics.dropped_full += 1
+            return False
+
+        depth = self.record_queue.qsize()
+        if depth > self.metrics.max_depth:
+            self.metrics.max_depth = depth
+        return True
+
+    def stop(self, timeout=30):
+        """ Write all the queued records and stop the thread, waiting up to timeout seconds. Returns whether it stopped. """
+        deadline = time.time() + timeout
+        if self.is_alive():
+            try:
+                self.record_queue.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+            self.join(max(deadline - time.time(), 0))
+
+        if self.is_alive():
+            logerr("Writer did not stop within %i seconds, %i queued records are not written" % (timeout, self.record_queue.qsize()))
+            return False
+        return True
+
+    def get_batch(self, wait=True):
+        """ Wait for a batch of records, or only get the queued records when wait is False.
+            Returns the batch and whether the thread was asked to stop. """
+        try:
+            item = self.record_queue.get(wait)
+        except queue.Empty:
+            return [], False
+        if item is None:
+            return [], True
+
+        batch = [item]
+        deadline = time.time() + self.batch_interval
+        while len(batch) < self.batch_size:
+            try:
+                if wait:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    item = self.record_queue.get(timeout=remaining)
+                else:
+                    item = self.record_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+
+        return batch, False
+
+    def encode(self, cursor, record):
+        """ Encode a record for the data column. """
+        if self.fields is None:
+            return json.dumps(record)
+        self.fields.add(cursor, record)
+        return encode_packed(record, self.fields.ids, self.compress)
+
+    def delta(self, data_type, record):
+        """ The data type and record to store, a delta of the previous loop packet when it is not time for a keyframe. """
+        if not self.keyframe_interval or data_type != 'loop':
+            return data_type, record
+
+        previous_packet = self.previous_packet
+        self.previous_packet = record
+        if previous_packet is None or self.since_keyframe >= self.keyframe_interval:
+            self.since_keyframe = 1
+            return data_type, record
+
+        self.since_keyframe += 1
+        return DELTA_DATA_TYPE, delta_record(previous_packet, record)
+
+    def write_batch(self, dbm, batch):
+        """ Write a batch of records in one transaction. Returns the first and last id, None if the write failed. """
+        insert_sql = INSERT_SQL % dbm.table_name
+        first_id = None
+        try:
+            with weedb.Transaction(dbm.connection) as cursor:
+                for data_type, record in batch:
+                    data_type, data = self.delta(data_type, record)
+                    cursor.execute(insert_sql, [record['dateTime'], 0, 0, data_type, self.encode(cursor, data)])
+                    if first_id is None:
+                        first_id = cursor.lastrowid
+                last_id = cursor.lastrowid
+            self.metrics.add_batch(len(batch))
+            return first_id, last_id
+        except Exception as exception: # pylint: disable=broad-except
+            self.metrics.dropped_failed += len(batch)
+            # The next packet is a keyframe, the deltas would be of packets that were not written.
+            self.previous_packet = None
+            if self.fields is not None:
+                # The field names added by the failed transaction were rolled back.
+                self.fields.load(dbm)
+            logerr("Write of %i records failed %s" % (len(batch), exception))
+            logerr(traceback.format_exc())
+            return None
+
+    def write(self, storage, batch):
+        """ Write a batch of records and announce them. """
+        ids = self.write_batch(storage, batch)
+        if ids is None or self.notifier is None:
+            return
+        try:
+            self.notifier.notify(*ids)
+        except Exception as exception: # pylint: disable=broad-except
+            logerr("Notify failed %s" % exception)
+            logerr(traceback.format_exc())
+
+    def prune(self, dbm):
+        """ Do one batch of the prune in progress. """
+        try:
+            deleted, vacuumed_pages = self.pruner.step(dbm)
+            self.metrics.pruned += deleted
+            self.metrics.vacuumed_pages += vacuumed_pages
+        except Exception as exception: # pylint: disable=broad-except
+            self.pruner.pending = False
+            logerr("Prune failed %s" % exception)
+            logerr(traceback.format_exc())
+
+    def log_metrics(self):
+        """ Log the metrics. """
+        metrics = self.metrics.as_dict()
+        loginf("Batches %(batches)s, rows %(rows)s, batch size min %(min_batch)s average %(average_batch)s max %(max_batch)s, "
+               "max queue depth %(max_depth)s, dropped %(dropped)s, pruned %(pruned)s, vacuumed pages %(vacuumed_pages)s" % metrics)
+
+    def open_storage(self):
+        """ Open the database. """
+        dbm = weewx.manager.open_manager_with_config(self.config_dict, self.data_binding, initialize=True)
+        if self.encoding == 'packed':
+            self.fields = FieldDictionary(dbm)
+        return dbm
+
+    def close_storage(self, dbm): # need to be overridable - pylint: disable=no-self-use
+        """ Close the database. """
+        dbm.close()
+
+    def start_prune(self, dbm):
+        """ Start a prune, it is done a batch at a time by prune. """
+        self.pruner.start(dbm)
+
+    def write_queue(self, storage):
+        """ Write the queued records until asked to stop, and then the ones still queued. """
+        last_metrics = time.time()
+        last_prune = 0
+        stop = False
+        while not stop:
+            # While pruning, the queued records are written between the batches of the prune.
+            batch, stop = self.get_batch(not self.pruner.pending)
+            if batch:
+                self.write(storage, batch)
+
+            if self.pruner.enabled():
+                if not self.pruner.pending and time.time() - last_prune >= self.prune_interval:
+                    last_prune = time.time()
+                    try:
+                        self.start_prune(storage)
+                    except Exception as exception: # pylint: disable=broad-except
+                        logerr("Prune failed %s" % exception)
+                        logerr(traceback.format_exc())
+                if self.pruner.pending:
+                    self.prune(storage)
+
+            if time.time() - last_metrics >= self.metrics_interval:
+                self.log_metrics()
+                last_metrics = time.time()
+
+        # Flush anything queued after the stop request.
+        batch = []
+        while True:
+            try:
+                item = self.record_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                batch.append(item)
+            if len(batch) >= self.batch_size:
+                self.write(storage, batch)
+                batch = []
+        if batch:
+            self.write(storage, batch)
+
+    def run(self):
+        try:
+            storage = self.open_storage()
+        except Exception as exception: # pylint: disable=broad-except
+            logerr("Open of the queue failed, no records will be written %s" % exception)
+            logerr(traceback.format_exc())
+            return
+
+        try:
+            self.write_queue(storage)
+        except Exception as exception: # pylint: disable=broad-except
+            logerr("Writer failed, no more records will be written %s" % exception)
+            logerr(traceback.format_exc())
+        finally:
+            self.log_metrics()
+            try:
+                self.close_storage(storage)
+                if self.notifier is not None:
+                    self.notifier.close()
+            except Exception as exception: # pylint: disable=broad-except
+                logerr("Close of the queue failed %s" % exception)
+                logerr(traceback.format_exc())
+
+class SegmentLogWriter(QueueWriter):
+    """ Write the queued records, as json, to a segment log. """
+    def __init__(self, directory, segment_size=16777216, index_interval=65536, **kwargs):
+        super(SegmentLogWriter, self).__init__(None, None, **kwargs)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.index_interval = index_interval
+
+    def open_storage(self):
+        """ Open the segment log. """
+        return SegmentLog(self.directory, self.segment_size, self.index_interval)
+
+    def close_storage(self, dbm):
+        """ Close the segment log. """
+        dbm.close()
+
+    def write_batch(self, dbm, batch):
+        """ Append a batch of records. Returns the first and last id, None if the write failed. """
+        try:
+            first_id = dbm.next_id
+            dbm.append([(data_type, record['dateTime'], json.dumps(record).encode('utf-8')) for data_type, record in batch])
+            self.metrics.add_batch(len(batch))
+            return first_id, dbm.next_id - 1
+        except Exception as exception: # pylint: disable=broad-except
+            self.metrics.dropped_failed += len(batch)
+            logerr("Write of %i records failed %s" % (len(batch), exception))
+            logerr(traceback.format_exc())
+            return None
+
+    def start_prune(self, dbm):
+        """ Delete the segments past the limits, there is nothing to do a batch at a time. """
+        try:
+            self.metrics.pruned += dbm.prune(self.pruner.max_rows, self.pruner.max_age, self.pruner.max_bytes)
+        except Exception as exception: # pylint: disable=broad-except
+            logerr("Prune failed %s" % exception)
+            logerr(traceback.format_exc())
+
+class QueueReader(object):
+    """ Read the queue, by a cursor on the row id. """
+    def __init__(self, dbm, name='default', data_type=None, delete_acked=False):
+        self.dbm = dbm
+        self.name = name
+        self.data_type = data_type
+        self.delete_acked = delete_acked
+        self.fields = None
+        self.builder = PacketBuilder()
+
+        table_name = dbm.table_name
+        self.table_name = table_name
+        self.consumer_table = '%s_consumer' % table_name
+        create_indexes(dbm)
+        dbm.connection.execute("CREATE TABLE IF NOT EXISTS %s (name STRING NOT NULL PRIMARY KEY, acked INTEGER NOT NULL);"
+                               % self.consumer_table)
+
+        # The rowid is the primary key, and the dataType index includes it, so both are a seek to the cursor.
+        if data_type is None:
+            self.data_types = []
+            where = "rowid > ?"
+            delete_where = "rowid < ?"
+        else:
+            # The deltas are read with the keyframes.
+            self.data_types = [data_type, DELTA_DATA_TYPE] if data_type == 'loop' else [data_type]
+            data_type_where = "dataType IN (%s)" % ', '.join(['?'] * len(self.data_types))
+            where = "%s AND rowid > ?" % data_type_where
+            delete_where = "%s AND rowid < ?" % data_type_where
+        self.dequeue_sql = "SELECT rowid, dateTime, dataType, data FROM %s WHERE %s ORDER BY rowid LIMIT ?;" % (table_name, where)
+        # Sqlite reuses the ids of deleted rows when the newest row is deleted, keeping it keeps the ids increasing.
+        self.delete_sql = "DELETE FROM %s WHERE %s AND rowid < (SELECT MAX(rowid) FROM %s);" % (table_name, delete_where, table_name)
+
+        row = dbm.getSql("SELECT acked FROM %s WHERE name = ?;" % self.consumer_table, (name,))
+        self.acked = row[0] if row else 0
+        self.position = self.acked
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etyp, einst, etb):
+        self.close()
+
+    def close(self):
+        """ Close the database. """
+        self.dbm.close()
+
+    def parameters(self, row_id):
+        """ The parameters of the queries. """
+        return self.data_types + [row_id]
+
+    def decode(self, data):
+        """ Decode the data column, json is a string and packed is bytes. """
+        if not isinstance(data, bytes):
+            return json.loads(data)
+        if self.fields is None:
+            self.fields = FieldDictionary(self.dbm)
+        return self.fields.decode(self.dbm, data)
+
+    def read(self, after, count):
+        """ Read up to count rows after a row id. """
+        return [QueueRow(row[0], row[1], row[2], self.decode(row[3]))
+                for row in self.dbm.genSql(self.dequeue_sql, self.parameters(after) + [count])]
+
+    def keyframe_id(self, row_id):
+        """ The id of the last keyframe before a row, None if there is not one. """
+        return self.dbm.getSql("SELECT MAX(rowid) FROM %s WHERE dataType = 'loop' AND rowid < ?;" % self.table_name,
+                               (row_id,))[0]
+
+    def build(self, builder, rows):
+        """ Rebuild the full packets of the rows. A delta without a packet before it starts from its keyframe. """
+        for row in rows:
+            if row.dataType == DELTA_DATA_TYPE and builder.packet is None:
+                keyframe_id = self.keyframe_id(row.id)
+                if keyframe_id is not None:
+                    sql = "SELECT rowid, dateTime, dataType, data FROM %s WHERE dataType IN ('loop', ?) AND rowid >= ? AND rowid < ? " \
+                          "ORDER BY rowid;" % self.table_name
+                    for keyframe_row in self.dbm.genSql(sql, (DELTA_DATA_TYPE, keyframe_id, row.id)):
+                        builder.build(QueueRow(keyframe_row[0], keyframe_row[1], keyframe_row[2], self.decode(keyframe_row[3])))
+            built_row = builder.build(row)
+            if built_row is None:
+                logdbg("Skipping delta %s, its keyframe is not in the queue" % row.id)
+                continue
+            yield built_row
+
+    def dequeue(self, count=100):
+        """ Get up to count rows after the cursor, oldest first, and move the cursor past them. """
+        rows = self.read(self.position, count)
+        if rows:
+            self.position = rows[-1].id
+        return list(self.build(self.builder, rows))
+
+    def stream(self, after=0, stop=None, batch_size=100):
+        """ Yield the rows after the id after, up to and including the id stop, reading batch_size rows at a time.
+            The cursor is not moved. """
+        builder = PacketBuilder()
+        while True:
+            rows = self.read(after, batch_size)
+            if stop is not None:
+                rows = [row for row in rows if row.id <= stop]
+            if not rows:
+                return
+            for row in self.build(builder, rows):
+                yield row
+            after = rows[-1].id
+
+    def ack(self, row_id=None):
+        """ Acknowledge the rows up to and including row_id. The default is all of the dequeued rows. """
+        if row_id is None:
+            row_id = self.position
+        if row_id <= self.acked:
+            return
+
+        with weedb.Transaction(self.dbm.connection) as cursor:
+            cursor.execute("INSERT OR REPLACE INTO %s (name, acked) VALUES (?, ?);" % self.consumer_table, (self.name, row_id))
+            if self.delete_acked:
+                cursor.execute(self.delete_sql, self.parameters(self.keep_from(cursor, row_id)))
+        self.acked = row_id
+
+    def keep_from(self, cursor, row_id):
+        """ The id of the first row to keep when the rows up to row_id are acknowledged.
+            When there are deltas after row_id, it is the keyframe they are built on. """
+        if self.data_types and 'loop' not in self.data_types:
+            return row_id + 1
+        cursor.execute("SELECT rowid FROM %s WHERE dataType = ? AND rowid > ? LIMIT 1;" % self.table_name,
+                       (DELTA_DATA_TYPE, row_id))
+        if cursor.fetchone() is None:
+            return row_id + 1
+        keyframe_id = self.keyframe_id(row_id + 1)
+        if keyframe_id is None:
+            return row_id + 1
+        return keyframe_id
+
+    def rewind(self):
+        """ Move the cursor back to the last acknowledged row, the unacknowledged rows are dequeued again. """
+        self.position = self.acked
+        self.builder = PacketBuilder()
+
+def open_reader(config_dict, data_binding='ext_queue_binding', **kwargs):
+    """ Open a reader of the queue, a QueueReader on the data binding or a SegmentLogReader when the backend is segmentlog.
+        The keyword arguments are passed to the reader. """
+    if config_dict.get('ExternalQueue', {}).get('backend', 'sqlite') == 'segmentlog':
+        return SegmentLogReader(get_segment_directory(config_dict), **kwargs)
+    dbm = weewx.manager.open_manager_with_config(config_dict, data_binding, initialize=True)
+    return QueueReader(dbm, **kwargs)
+
 class ExternalQueue(StdService):
     """ A service to put data on to an external queue. """
     def __init__(self, engine, config_dict):
@@ -112,6 +817,8 @@ class ExternalQueue(StdService):
 
         service_dict = config_dict.get('ExternalQueue', {})
         self.dbm = None
+        self.writer = None
+        self.writer_failed = False
 
         self.enable = to_bool(service_dict.get('enable', True))
         if not self.enable:
@@ -119,9 +826,60 @@ class ExternalQueue(StdService):
             return
 
         data_binding = service_dict.get('data_binding', 'ext_queue_binding')
-        binding = weeutil.weeutil.option_as_list(service_dict.get('binding', ['loop']))
-        self.dbm = self.engine.db_binder.get_manager(data_binding=data_binding, initialize=True)
-        self.dbm.getSql("PRAGMA journal_mode=WAL;")
+        keyframe_interval = to_int(service_dict.get('keyframe_interval', 0))
+        pruner = QueuePruner(max_rows=to_int(service_dict.get('max_rows', 0)),
+                             max_age=to_int(service_dict.get('max_age', 0)),
+                             max_bytes=to_int(service_dict.get('max_bytes', 0)),
+                             batch_size=to_int(service_dict.get('prune_batch_size', 500)),
+                             vacuum_pages=to_int(service_dict.get('vacuum_pages', 100)),
+                             keyframes=bool(keyframe_interval))
+        encoding = service_dict.get('encoding', 'json')
+        if encoding not in ('json', 'packed'):
+            raise ValueError("Invalid encoding %s, must be json or packed" % encoding)
+        backend = service_dict.get('backend', 'sqlite')
+        if backend not in ('sqlite', 'segmentlog'):
+            raise ValueError("Invalid backend %s, must be sqlite or segmentlog" % backend)
+        notify = service_dict.get('notify', None)
+        if notify not in (None, 'None', 'socket', 'fifo'):
+            raise ValueError("Invalid notify %s, must be None, socket, or fifo" % notify)
+        binding = option_as_list(service_dict.get('binding', ['loop']))
+
+        notifier = None
+        if notify == 'socket':
+            notifier = SocketNotifier(get_notify_path(config_dict))
+        elif notify == 'fifo':
+            notifier = FifoNotifier(get_notify_path(config_dict))
+
+        writer_options = {
+            'batch_size': to_int(service_dict.get('batch_size', 50)),
+            'batch_interval': to_int(service_dict.get('batch_interval', 1000)) / 1000.0,
+            'queue_size': to_int(service_dict.get('queue_size', 1000)),
+            'metrics_interval': to_int(service_dict.get('metrics_interval', 300)),
+            'pruner': pruner,
+            'prune_interval': to_int(service_dict.get('prune_interval', 300)),
+            'notifier': notifier,
+        }
+        if backend == 'segmentlog':
+            if encoding != 'json' or keyframe_interval:
+                raise ValueError("The segmentlog backend only supports the json encoding, without keyframe_interval")
+            self.writer = SegmentLogWriter(get_segment_directory(config_dict),
+                                           segment_size=to_int(service_dict.get('segment_size', 16777216)),
+                                           index_interval=to_int(service_dict.get('index_interval', 65536)),
+                                           **writer_options)
+        else:
+            self.dbm = self.engine.db_binder.get_manager(data_binding=data_binding, initialize=True)
+            if pruner.enabled():
+                set_incremental_vacuum(self.dbm)
+            self.dbm.getSql("PRAGMA journal_mode=WAL;")
+            create_indexes(self.dbm)
+
+            self.writer = QueueWriter(config_dict,
+                                      data_binding,
+                                      encoding=encoding,
+                                      compress=to_bool(service_dict.get('compress', False)),
+                                      keyframe_interval=keyframe_interval,
+                                      **writer_options)
+        self.writer.start()
 
         if 'loop' in binding:
             self.bind(weewx.NEW_LOOP_PACKET, self.new_loop_packet)
@@ -133,6 +891,10 @@ class ExternalQueue(StdService):
 
     def shutDown(self): # need to override parent - pylint: disable=invalid-name
         """Run when an engine shutdown is requested."""
+        if self.writer:
+            self.writer.stop()
+            self.writer = None
+
         if self.dbm:
             try:
                 self.dbm.close()
@@ -153,10 +915,14 @@ class ExternalQueue(StdService):
         # todo
         #if self.topics[topic]['augment_record'] and dbmanager is not None:
         #    updated_record = self.get_record(updated_record, dbmanager)
-        log.debug("      Queueing   (%s): %s", int(time.time()), int(record['dateTime']))
-        self.dbm.getSql( \
-                  "INSERT INTO archive (dateTime, usUnits, interval, dataType, data) VALUES (?, ?, ?, ?, ?);",
-                  [record['dateTime'], 0, 0, data_type, json.dumps(record)])
+        logdbg("      Queueing   (%s): %s", int(time.time()), int(record['dateTime']))
+        if not self.writer.is_alive():
+            if not self.writer_failed:
+                self.writer_failed = True
+                logerr("The writer is not running, records are being dropped")
+            return
+        # A copy, so that later services cannot change what is queued.
+        self.writer.put(data_type, dict(record))
 
 if __name__ == "__main__":
     pass
@@ -4,38 +4,96 @@
 #    See the file LICENSE.txt for your full rights.
 #
 """
-WeeWX service that will cache archive record field values.
-If the next archive record is missing the value, the cached value is used.
+WeeWX service that will cache archive record and/or loop packet field values.
+If the next archive record (or loop packet) is missing the value, the cached value is used.
 This can be useful for field values that 'arrive' less frequently than the archive interval.
 
 Installation:
-    Put this file in the bin/user directory.
+    Put this file, statefile.py, and instrumentation.py, in the bin/user directory.
     Update weewx.conf [FieldCache] as needed to configure the service.
     Add the service to the engine service's configuration.
 
 Configuration:
 [FieldCache]
     # The unit system of the cache.
+    # Values arriving in a different unit system are converted to it.
+    # Values filled into a record or packet are converted to the unit system of the record or packet.
     # Default is US.
     unit_system = US
+    # The binding, loop and/or archive.
+    # When bound to loop, the count and the p50, p95, and max time spent handling the loop packets
+    # are logged at the end of each archive period.
+    # Default is archive.
+    binding = archive
+    # A file to checkpoint the cache to, so that it survives a restart of WeeWX.
+    # A relative path is relative to WEEWX_ROOT.
+    # The file is written on a separate thread, within a second of each archive record.
+    # When WeeWX starts, any values that have expired are not loaded.
+    # The values are saved with their unit system, and converted to unit_system when they are loaded.
+    # Default is None, the cache is not checkpointed.
+    snapshot_file = None
+    # A data binding used to fill the cache when WeeWX starts.
+    # Each field is filled with its most recent, unexpired, non-null value in the archive.
+    # Fields already loaded from the snapshot_file are not filled from the archive.
+    # Default is None, the cache is not filled from the archive.
+    data_binding = None
+    # How far back, in seconds, to look in the archive for a value, including for fields that never expire.
+    # Default is 604800, a week.
+    seed_window = 604800
+    # The maximum number of values to cache.
+    # When it is reached, the least recently used value, updated, read, or filled into a record or packet, is evicted.
+    # Expired values are always removed.
+    # The cache statistics (hits, misses, expired, evicted) are logged at the end of each archive period.
+    # Default is None, no maximum.
+    max_entries = None
+    # Whether to answer report lookups of the cached fields from the last archive record.
+    # The '$current' value of a cached field that is not an archive column,
+    # and the 'last' aggregate of a timespan that includes the last archive record, are taken from the record.
+    # The values are the ones written to the archive record, so this needs the archive binding.
+    # Other lookups fall back to the database.
+    # Default is False.
+    xtype = False
     # The WeeWX fields to cache.
     [[fields]]
         # The name of the field to cache.
         [[[field1]]]
-            # In seconds how long the cache is valid.
+            # In seconds how long the cache is valid, by the dateTime of the records or packets.
             # Value of 0 means the cache is always expired.
             # Useful if missing fields should have a value of None instead of the previous value.
             # Value of None means the cache never expires.
             # Default is None.
             expires_after = None
+            # How a missing value is filled.
+            # last - the last value, including a value of None.
+            # hold_until_expiry - the last value that was not None.
+            #                     A value of None in the record or packet is also filled.
+            # linear - the value is extrapolated from the line through the oldest and newest of the
+            #          last few values that were not None. Only for fields with numeric values.
+            #          The line is not followed further past the newest value than the time the values span,
+            #          after that the value is held.
+            # Default is last.
+            fill = last
 """
 
 # need to be python 2 compatible pylint: disable=bad-option-value, raise-missing-from, super-with-arguments
 # pylint: enable=bad-option-value
+import collections
+import heapq
+import os
 import time
 import configobj
+import weedb
 import weewx
-from weeutil.weeutil import to_float
+import weewx.units
+import weewx.xtypes
+from weeutil.weeutil import option_as_list, to_bool, to_float, to_int
+from user.instrumentation import HandlerStats
+from user.statefile import read_state, StateThread
+
+try:
+    perf_counter = time.perf_counter # pylint: disable=invalid-name
+except AttributeError:
+    perf_counter = time.time # pylint: disable=invalid-name
 from weewx.wxengine import StdService
 
 VERSION = "0.1"
@@ -76,42 +134,443 @@ except ImportError:
         """ Log error messages. """
         logmsg(syslog.LOG_ERR, msg)
 
+def get_converter(key, from_unit_system, to_unit_system):
+    """ Get the function that converts the key's value from one unit system to another.
+        None is returned if no conversion is needed or possible. """
+    for unit_system in (from_unit_system, to_unit_system):
+        if unit_system not in weewx.units.std_groups:
+            raise ValueError("Unknown unit system: %s" % unit_system)
+
+    from_unit, _ = weewx.units.getStandardUnitType(from_unit_system, key)
+    to_unit, _ = weewx.units.getStandardUnitType(to_unit_system, key)
+    if from_unit is None or to_unit is None or from_unit == to_unit:
+        return None
+
+    try:
+        return weewx.units.conversionDict[from_unit][to_unit]
+    except KeyError:
+        logerr("Unable to convert %s from %s to %s" % (key, from_unit, to_unit))
+        return None
+
+FILL_MODES = ('last', 'hold_until_expiry', 'linear')
+
+class History(object):
+    """ A small ring buffer of the most recent (timestamp, value) pairs of a key. """
+    __slots__ = ('timestamps', 'values', 'newest', 'count')
+    size = 4
+
+    def __init__(self):
+        self.timestamps = [None] * self.size
+        self.values = [None] * self.size
+        self.newest = -1
+        self.count = 0
+
+    def add(self, timestamp, value):
+        """ Add a value, replacing the oldest one when the ring is full. """
+        self.newest = (self.newest + 1) % self.size
+        self.timestamps[self.newest] = timestamp
+        self.values[self.newest] = value
+        if self.count < self.size:
+            self.count += 1
+
+    def clear(self):
+        """ Remove all of the values. """
+        self.newest = -1
+        self.count = 0
+
+    def estimate(self, timestamp):
+        """ Interpolate or extrapolate the value at the timestamp from the oldest and newest values.
+            The extrapolation goes no further past the newest value than the time the values span. """
+        if not self.count:
+            return None
+        newest_timestamp = self.timestamps[self.newest]
+        newest_value = self.values[self.newest]
+        oldest = (self.newest - self.count + 1) % self.size
+        oldest_timestamp = self.timestamps[oldest]
+        if newest_timestamp == oldest_timestamp:
+            return newest_value
+        try:
+            slope = (newest_value - self.values[oldest]) / (newest_timestamp - oldest_timestamp)
+        except TypeError:
+            return newest_value
+        return newest_value + slope * min(timestamp - newest_timestamp, newest_timestamp - oldest_timestamp)
+
+def snapshot_state(snapshot):
+    """ The state to save of a Cache.snapshot: the cached values, and their unit system. """
+    unit_system, keys, values, timestamps = snapshot
+    return {
+        'usUnits': unit_system,
+        'values': {key: [value, timestamp]
+                   for key, value, timestamp in zip(keys, values, timestamps) if key is not None and timestamp is not None},
+    }
+
 class Cache(object):
-    """ Manage the cache. """
-    def __init__(self, unit_system):
+    """ Manage the cache.
+        Each key is assigned a slot when it is first seen, or up front from 'expirations'.
+        The values, timestamps, and expirations are kept in parallel lists indexed by the slot.
+        A timestamp of None marks an empty slot.
+        Slots of keys that were not given up front are released, and reused, when their value is removed.
+        'current' holds the value each key would be filled with, None once the value has expired.
+        Keys that always expire, expires_after of 0, are always None in 'current'.
+        'expiry_heap' is a min-heap of (expiration, slot), with at most one live entry per slot.
+        'heap_expirations' holds the expiration of each slot's live entry, other entries are stale and skipped.
+        When 'max_entries' is set, the least recently used entries are evicted, tracked by 'lru'.
+        An entry is used when it is updated, read by get_value, or filled into a record.
+        update_record only caches the keys given up front, other keys are only added by update_value.
+        Values are stored in the cache's unit system.
+        The conversion function for each key and pair of unit systems is looked up once and kept in 'converters'.
+        'fills' is the fill mode of the keys that do not use 'last'.
+        Keys filled by 'linear' keep a History, keys in 'hold_keys' treat a value of None as missing. """
+    __slots__ = ('unit_system', 'max_entries', 'index', 'keys', 'key_set', 'fixed_keys', 'free_slots',
+                 'values', 'timestamps', 'expirations', 'current', 'valid', 'always_expired',
+                 'expiry_heap', 'heap_expirations', 'lru', 'converters',
+                 'histories', 'linear_keys', 'hold_keys',
+                 'hits', 'misses', 'expired', 'evicted')
+
+    def __init__(self, unit_system, expirations=None, max_entries=None, fills=None):
         self.unit_system = unit_system
-        self.cached_values = {}
-
-    def get_value(self, key, timestamp, expires_after):
-        """ Get the cached value. """
-        if key in self.cached_values and \
-            (expires_after is None or timestamp - self.cached_values[key]['timestamp'] < expires_after):
-            return self.cached_values[key]['value']
+        self.max_entries = max_entries
+        self.index = {}
+        self.keys = []
+        self.key_set = set()
+        self.free_slots = []
+        self.values = []
+        self.timestamps = []
+        self.expirations = []
+        self.current = {}
+        self.valid = set()
+        self.always_expired = set()
+        self.expiry_heap = []
+        self.heap_expirations = []
+        self.lru = collections.OrderedDict()
+        self.converters = {}
+        self.histories = {}
+        self.hold_keys = set()
+        for key, fill in (fills or {}).items():
+            if fill not in FILL_MODES:
+                raise ValueError("Unknown fill: %s" % fill)
+            if fill == 'linear':
+                self.histories[key] = History()
+            elif fill == 'hold_until_expiry':
+                self.hold_keys.add(key)
+        self.linear_keys = frozenset(self.histories)
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        for key, expires_after in (expirations or {}).items():
+            self.add_key(key, expires_after)
+        self.fixed_keys = frozenset(self.key_set)
+
+    @property
+    def cached_values(self):
+        """ The cached values as a dictionary of {'value': value, 'timestamp': timestamp}, keyed by the key. """
+        return {key: {'value': self.values[slot], 'timestamp': self.timestamps[slot]}
+                for key, slot in self.index.items() if self.timestamps[slot] is not None}
+
+    def __contains__(self, key):
+        slot = self.index.get(key)
+        return slot is not None and self.timestamps[slot] is not None
+
+    def stats(self):
+        """ The cache statistics. """
+        return {
+            'entries': sum(1 for timestamp in self.timestamps if timestamp is not None),
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'evicted': self.evicted,
+        }
 
+    def add_key(self, key, expires_after=None):
+        """ Assign a slot to the key. """
+        slot = self.index.get(key)
+        if slot is None:
+            if self.free_slots:
+                slot = self.free_slots.pop()
+                self.keys[slot] = key
+                self.expirations[slot] = expires_after
+            else:
+                slot = len(self.keys)
+                self.keys.append(key)
+                self.values.append(None)
+                self.timestamps.append(None)
+                self.expirations.append(expires_after)
+                self.heap_expirations.append(None)
+            self.index[key] = slot
+            self.key_set.add(key)
+            self.current[key] = None
+            if expires_after == 0:
+                self.always_expired.add(key)
+        return slot
+
+    def set_slot(self, slot, value, timestamp):
+        """ Set the value and timestamp of a slot. """
+        key = self.keys[slot]
+        self.values[slot] = value
+        self.timestamps[slot] = timestamp
+
+        if self.max_entries is not None:
+            if key in self.lru:
+                self.touch(key)
+            else:
+                self.lru[key] = None
+                if len(self.lru) > self.max_entries:
+                    self.evict()
+
+        expires_after = self.expirations[slot]
+        if expires_after == 0:
+            # Always expired, so never used to fill a record.
+            return
+        self.current[key] = value
+        if value is None:
+            self.valid.discard(key)
+        else:
+            self.valid.add(key)
+            if key in self.histories:
+                self.histories[key].add(timestamp, value)
+
+        if expires_after is not None and timestamp is not None:
+            # An earlier live entry is pushed back when it is popped, so only an earlier expiration needs a new entry.
+            expiration = timestamp + expires_after
+            heap_expiration = self.heap_expirations[slot]
+            if heap_expiration is None or expiration < heap_expiration:
+                self.heap_expirations[slot] = expiration
+                heapq.heappush(self.expiry_heap, (expiration, slot))
+
+    def clear_slot(self, slot):
+        """ Remove the value of a slot, releasing the slot if its key was not given up front. """
+        key = self.keys[slot]
+        self.values[slot] = None
+        self.timestamps[slot] = None
+        self.heap_expirations[slot] = None
+        self.current[key] = None
+        self.valid.discard(key)
+        self.lru.pop(key, None)
+        if key in self.histories:
+            self.histories[key].clear()
+
+        if key not in self.fixed_keys:
+            del self.index[key]
+            del self.current[key]
+            self.key_set.discard(key)
+            self.always_expired.discard(key)
+            self.keys[slot] = None
+            self.expirations[slot] = None
+            self.free_slots.append(slot)
+
+    def touch(self, key):
+        """ Make the key's entry the most recently used. """
+        del self.lru[key]
+        self.lru[key] = None
+
+    def evict(self):
+        """ Evict the least recently used entry. """
+        key, _ = self.lru.popitem(last=False)
+        self.evicted += 1
+        self.clear_slot(self.index[key])
+
+    def expire(self, timestamp):
+        """ Remove the values that have expired. Each pop is O(log n). """
+        expiry_heap = self.expiry_heap
+        while expiry_heap and expiry_heap[0][0] <= timestamp:
+            expiration, slot = heapq.heappop(expiry_heap)
+            if self.heap_expirations[slot] != expiration:
+                continue
+            self.heap_expirations[slot] = None
+
+            value_timestamp = self.timestamps[slot]
+            expires_after = self.expirations[slot]
+            if value_timestamp is None or expires_after is None:
+                continue
+            expiration = value_timestamp + expires_after
+            if expiration > timestamp:
+                # Updated since the entry was pushed.
+                self.heap_expirations[slot] = expiration
+                heapq.heappush(expiry_heap, (expiration, slot))
+                continue
+
+            self.expired += 1
+            self.clear_slot(slot)
+
+    def convert(self, key, value, from_unit_system, to_unit_system):
+        """ Convert the key's value from one unit system to another. """
+        if value is None or from_unit_system == to_unit_system:
+            return value
+
+        converter_key = (key, from_unit_system, to_unit_system)
+        try:
+            converter = self.converters[converter_key]
+        except KeyError:
+            converter = get_converter(key, from_unit_system, to_unit_system)
+            self.converters[converter_key] = converter
+
+        if converter is None:
+            return value
+        return converter(value)
+
+    def get_value(self, key, timestamp, expires_after, unit_system=None):
+        """ Get the cached value, converted to unit_system if it is given. """
+        slot = self.index.get(key)
+        if slot is not None:
+            value_timestamp = self.timestamps[slot]
+            if value_timestamp is not None and (expires_after is None or timestamp - value_timestamp < expires_after):
+                self.hits += 1
+                if self.max_entries is not None:
+                    self.touch(key)
+                if unit_system is None:
+                    return self.values[slot]
+                return self.convert(key, self.values[slot], self.unit_system, unit_system)
+
+        self.misses += 1
         return None
 
     def update_value(self, key, value, unit_system, timestamp):
-        """ Update the cached value. """
-        if unit_system != self.unit_system:
-            raise ValueError("Unit system does not match unit system of the cache. %s vs %s"
-                             % (unit_system, self.unit_system))
-        self.cached_values[key] = {}
-        self.cached_values[key]['value'] = value
-        self.cached_values[key]['timestamp'] = timestamp
+        """ Update the cached value, converting it to the unit system of the cache. """
+        value = self.convert(key, value, unit_system, self.unit_system)
+        self.set_slot(self.add_key(key), value, timestamp)
+
+    def update_record(self, record, timestamp):
+        """ Update the cache with the keys in the record and fill in the keys missing from the record.
+            Missing keys whose cached value has expired, or that have never been cached, are set to None. """
+        if self.expiry_heap and self.expiry_heap[0][0] <= timestamp:
+            self.expire(timestamp)
+
+        evicted = self.evicted
+        unit_system = record.get('usUnits', self.unit_system)
+        present = self.key_set.intersection(record)
+        if present and self.hold_keys:
+            present.difference_update([key for key in self.hold_keys.intersection(present) if record[key] is None])
+        if present:
+            index = self.index
+            if unit_system == self.unit_system:
+                for key in present:
+                    self.set_slot(index[key], record[key], timestamp)
+            else:
+                for key in present:
+                    self.set_slot(index[key], self.convert(key, record[key], unit_system, self.unit_system), timestamp)
+
+        present_count = len(present)
+        if self.evicted != evicted:
+            # Evicting may have released some of the keys.
+            present_count = len(self.key_set.intersection(present))
+        missing_count = len(self.key_set) - present_count
+        if not missing_count:
+            return
+
+        hits = len(self.valid) - len(self.valid.intersection(present))
+        self.hits += hits
+        self.misses += missing_count - hits
+        if hits and self.max_entries is not None:
+            for key in self.valid.difference(present):
+                self.touch(key)
+
+        if unit_system == self.unit_system:
+            # The present keys were just set in 'current', so only the ones that always expire,
+            # or that were evicted by this record, need to be put back.
+            kept = None
+            if self.evicted != evicted:
+                kept = {key: record[key] for key in present}
+            elif self.always_expired and present:
+                kept = {key: record[key] for key in self.always_expired.intersection(present)}
+            record.update(self.current)
+            if kept:
+                record.update(kept)
+        else:
+            current = self.current
+            for key in self.key_set.difference(present):
+                record[key] = self.convert(key, current[key], self.unit_system, unit_system)
+
+        if self.linear_keys:
+            for key in self.linear_keys.difference(present):
+                if key in self.valid:
+                    value = self.histories[key].estimate(timestamp)
+                    record[key] = self.convert(key, value, self.unit_system, unit_system)
 
     def update_timestamp(self, key, timestamp):
         """ Update the ts. """
-        if key in self.cached_values:
-            self.cached_values[key]['timestamp'] = timestamp
+        if key in self:
+            slot = self.index[key]
+            self.set_slot(slot, self.values[slot], timestamp)
 
     def remove_value(self, key):
         """ Remove a cached value. """
-        if key in self.cached_values:
-            del self.cached_values[key]
+        if key in self:
+            self.clear_slot(self.index[key])
 
     def clear_cache(self):
         """ Clear the cache """
-        self.cached_values = {}
+        for slot, key in enumerate(self.keys):
+            if key is not None and self.timestamps[slot] is not None:
+                self.clear_slot(slot)
+        self.expiry_heap = []
+
+    def snapshot(self):
+        """ Get a copy of the slots, and their unit system, that snapshot_state turns into the state to save.
+            Only the lists are copied, so that it is cheap enough for the engine thread. """
+        return self.unit_system, self.keys[:], self.values[:], self.timestamps[:]
+
+    def load_snapshot(self, snapshot, timestamp, expirations):
+        """ Load previously saved values, skipping the ones that are not cached or have expired.
+            The values are converted to the unit system of the cache.
+            A snapshot without its unit system is not loaded. """
+        if 'usUnits' not in snapshot or 'values' not in snapshot:
+            if snapshot:
+                loginf("Not loading a snapshot without its unit system.")
+            return
+        unit_system = snapshot['usUnits']
+        for key, (value, value_timestamp) in snapshot['values'].items():
+            if key not in expirations:
+                continue
+            expires_after = expirations[key]
+            if expires_after is not None and timestamp - value_timestamp >= expires_after:
+                continue
+            value = self.convert(key, value, unit_system, self.unit_system)
+            self.set_slot(self.add_key(key, expires_after), value, value_timestamp)
+
+class FieldCacheXtype(weewx.xtypes.XType):
+    """ XType that answers lookups of the cached fields from the last archive record, instead of the database.
+        Only the values as they were written to the archive record, filled or not, are served,
+        stamped with the record's dateTime. """
+    def __init__(self, fields):
+        self.fields = fields
+        # The dateTime, unit system, and cached field values of the last archive record.
+        # Replaced as a whole, so that the report thread always sees a consistent record.
+        self.archived = None
+
+    def update(self, record):
+        """ Keep the cached fields of an archive record, after it has been filled. """
+        self.archived = (record['dateTime'],
+                         record.get('usUnits'),
+                         {field: record[field] for field in self.fields if record.get(field) is not None})
+
+    def get_value(self, obs_type, aggregate_type=None):
+        """ The dateTime and ValueTuple of an archived value, None if there is no such value. """
+        archived = self.archived
+        if archived is None or obs_type not in archived[2]:
+            return None
+        date_time, unit_system, values = archived
+        unit_type, group = weewx.units.getStandardUnitType(unit_system, obs_type, aggregate_type)
+        return date_time, weewx.units.ValueTuple(values[obs_type], unit_type, group)
+
+    def get_scalar(self, obs_type, record, db_manager=None, **option_dict):
+        """ The value of a cached field that is not an archive column, for the last archive record.
+            WeeWX only asks for the fields that are missing from the record it fetched. """
+        if record is None:
+            raise weewx.UnknownType(obs_type)
+        value = self.get_value(obs_type)
+        if value is None or value[0] != record['dateTime']:
+            raise weewx.UnknownType(obs_type)
+        return value[1]
+
+    def get_aggregate(self, obs_type, timespan, aggregate_type, db_manager, **option_dict):
+        """ The 'last' value of a timespan that includes the last archive record. """
+        if aggregate_type != 'last':
+            raise weewx.UnknownAggregation(aggregate_type)
+        value = self.get_value(obs_type, aggregate_type)
+        if value is None or not timespan.start < value[0] <= timespan.stop:
+            raise weewx.UnknownAggregation(aggregate_type)
+        return value[1]
 
 class FieldCache(StdService):
     """ Fill in any missing field data with data from the previous record. """
@@ -130,32 +589,127 @@ class FieldCache(StdService):
         for field in fieldcache_dict.get('fields', {}):
             self.fields[field] = {}
             self.fields[field]['expires_after'] = to_float(fields_dict[field].get('expires_after', None))
+            self.fields[field]['fill'] = fields_dict[field].get('fill', 'last').strip().lower()
+            if self.fields[field]['fill'] not in FILL_MODES:
+                raise ValueError("FieldCache: Unknown fill for %s: %s" % (field, self.fields[field]['fill']))
 
         loginf(fieldcache_dict)
-        self.cache = Cache(unit_system)
-
-        self.bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_record)
+        self.cache = Cache(unit_system,
+                           {field: self.fields[field]['expires_after'] for field in self.fields},
+                           to_int(fieldcache_dict.get('max_entries', None)),
+                           {field: self.fields[field]['fill'] for field in self.fields})
+
+        self.snapshot_thread = None
+        snapshot_file = fieldcache_dict.get('snapshot_file', None)
+        if snapshot_file is not None and snapshot_file != 'None':
+            snapshot_file = os.path.join(config_dict.get('WEEWX_ROOT', ''), snapshot_file)
+            expirations = {field: self.fields[field]['expires_after'] for field in self.fields}
+            self.cache.load_snapshot(read_state(snapshot_file), time.time(), expirations)
+            self.snapshot_thread = StateThread(snapshot_file, 'FieldCacheSnapshot', prepare=snapshot_state)
+            self.snapshot_thread.start()
+
+        self.seed_window = to_int(fieldcache_dict.get('seed_window', 604800))
+        data_binding = fieldcache_dict.get('data_binding', None)
+        if data_binding is not None and data_binding != 'None':
+            db_manager = self.engine.db_binder.get_manager(data_binding=data_binding, initialize=True)
+            self.seed_cache(db_manager, time.time())
+
+        self.xtype = None
+        if to_bool(fieldcache_dict.get('xtype', False)):
+            self.xtype = FieldCacheXtype(list(self.fields))
+            weewx.xtypes.xtypes.insert(0, self.xtype)
+
+        self.binding = option_as_list(fieldcache_dict.get('binding', ['archive']))
+        self.loop_stats = HandlerStats(1000)
+
+        self.bind(weewx.END_ARCHIVE_PERIOD, self.end_archive_period)
+
+        if 'loop' in self.binding:
+            self.bind(weewx.NEW_LOOP_PACKET, self.new_loop_packet)
+
+        if 'archive' in self.binding:
+            self.bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_record)
+
+    def shutDown(self): # need to override parent - pylint: disable=invalid-name
+        """Run when an engine shutdown is requested."""
+        if self.xtype:
+            weewx.xtypes.xtypes.remove(self.xtype)
+        if self.snapshot_thread:
+            self.snapshot_thread.stop()
+
+    def seed_cache(self, db_manager, timestamp):
+        """ Fill the fields that are not cached with their most recent non-null value in the archive.
+            All of the fields are filled by a single pass backwards through the archive,
+            that stops as soon as every field has a value or the oldest unexpired record is reached.
+            No record older than seed_window seconds is read, so that a field with no value does not walk the whole archive. """
+        fields = []
+        for field in self.fields:
+            expires_after = self.fields[field]['expires_after']
+            if field in db_manager.sqlkeys and field not in self.cache and expires_after != 0:
+                fields.append(field)
+        if not fields:
+            return
+
+        expirations = [self.fields[field]['expires_after'] for field in fields]
+        window = self.seed_window
+        if None not in expirations:
+            window = min(window, max(expirations))
+        start = timestamp - window
+
+        sql_stmt = "SELECT dateTime, %s FROM %s WHERE dateTime > ? AND (%s) ORDER BY dateTime DESC;" \
+            % (', '.join(fields),
+               db_manager.table_name,
+               ' OR '.join(["%s IS NOT NULL" % field for field in fields]))
+
+        remaining = dict(zip(fields, expirations))
+        filled = 0
+        rows = db_manager.genSql(sql_stmt, (start,))
+        try:
+            for row in rows:
+                date_time = row[0]
+                for field, value in zip(fields, row[1:]):
+                    if value is None or field not in remaining:
+                        continue
+                    expires_after = remaining.pop(field)
+                    if expires_after is None or timestamp - date_time < expires_after:
+                        self.cache.update_value(field, value, db_manager.std_unit_system, date_time)
+                        filled += 1
+                if not remaining:
+                    break
+        except weedb.DatabaseError as exception:
+            logerr("Unable to fill cache from the archive: %s" % exception)
+        finally:
+            rows.close()
+
+        loginf("Filled %i fields from the archive." % filled)
+
+    def new_loop_packet(self, event):
+        """ Handle the new loop packet event. """
+        start = perf_counter()
+        self.cache.update_record(event.packet, event.packet.get('dateTime', time.time()))
+        self.loop_stats.add(perf_counter() - start)
+
+    def end_archive_period(self, _event):
+        """ Handle the end of archive period event. """
+        logdbg("Cache statistics: %s" % self.cache.stats())
+        if 'loop' in self.binding:
+            logdbg("Loop packet handling in microseconds: %s" % self.loop_stats.summary())
+            self.loop_stats.reset()
+
+        if self.snapshot_thread and 'archive' not in self.binding:
+            self.snapshot_thread.save(self.cache.snapshot())
 
     def new_archive_record(self, event):
         """ Handle the new archive record event. """
-        target_data = {}
-
-        for field in self.fields:
-            if field in event.record:
-                self.cache.update_value(field,
-                                        event.record[field],
-                                        event.record['usUnits'],
-                                        time.time())
-            else:
-                target_data[field] = self.cache.get_value(field,
-                                                          time.time(),
-                                                          self.fields[field]['expires_after'])
+        self.cache.update_record(event.record, event.record.get('dateTime', time.time()))
+        if self.xtype:
+            self.xtype.update(event.record)
 
-        event.record.update(target_data)
+        if self.snapshot_thread:
+            self.snapshot_thread.save(self.cache.snapshot())
 
 # A mini integration "test"
 if __name__ == "__main__":
-    import os
     import weeutil.weeutil
     import weeutil.logger
     from weewx.engine import StdEngine # pylint: disable=ungrouped-imports
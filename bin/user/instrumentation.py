@@ -0,0 +1,197 @@
+#
+#    Copyright (c) 2024 Rich Bell <bellrichm@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+
+'''
+WeeWX service to time the event handlers of the other WeeWX services.
+
+Prerequistes:
+Python 3.7+
+WeeWX 5.x+
+
+Installation:
+    1. Put this file in the bin/user directory.
+    2. Update weewx.conf [Instrumentation] as needed to configure the service.
+    3. Add the service, user.instrumentation.Instrumentation, to the start of the 'prep_services' service group.
+       Only the handlers bound after this service is created, and the ones already bound, are timed.
+       So it should be the first service.
+
+Overview:
+Every handler bound with bind() is wrapped to time its calls.
+Each archive period, the number of calls and the p50, p95, and max latency of each handler are logged,
+and optionally added to the archive record.
+The summary is made after all the other archive record handlers, so that it includes their calls for the record.
+Because the record has been saved by then, the summary added to a record is the one of the previous archive period.
+Recording a call is a counter increment and a list append, the percentiles are only computed for the summary.
+When a handler has more than max_samples calls in an archive period, a random sample of max_samples calls is kept.
+
+Configuration:
+[Instrumentation]
+    # Whether to time the handlers.
+    # Default is True.
+    enable = True
+    # The most latencies of a handler that are kept for the percentiles in an archive period.
+    # Default is 1000.
+    max_samples = 1000
+    # Whether to add the summary of the previous archive period to the archive record.
+    # The fields are {field_prefix}{event}_{service}_{handler}_{count|p50|p95|max}, the latencies are in microseconds.
+    # Default is False.
+    add_to_record = False
+    # The prefix of the archive record fields.
+    # Default is instrumentation_.
+    field_prefix = instrumentation_
+'''
+
+import logging
+import random
+import time
+
+import weewx
+import weewx.engine
+from weeutil.weeutil import to_bool, to_int
+
+VERSION = '0.1.0'
+
+log = logging.getLogger(__name__)
+
+class HandlerStats(object):
+    ''' The number of calls and a sample of the latencies of a handler in an archive period.'''
+    __slots__ = ('max_samples', 'count', 'maximum', 'samples')
+
+    def __init__(self, max_samples):
+        self.max_samples = max_samples
+        self.count = 0
+        self.maximum = 0.0
+        self.samples = []
+
+    def add(self, latency):
+        ''' Record a call. Once max_samples are kept, each new latency replaces a random sample with probability max_samples/count.'''
+        self.count += 1
+        if latency > self.maximum:
+            self.maximum = latency
+        if self.count <= self.max_samples:
+            self.samples.append(latency)
+        else:
+            i = random.randrange(self.count)
+            if i < self.max_samples:
+                self.samples[i] = latency
+
+    def reset(self):
+        ''' Start a new archive period.'''
+        self.count = 0
+        self.maximum = 0.0
+        self.samples = []
+
+    def summary(self):
+        ''' The count and the p50, p95, and max latencies, in microseconds. None if there were no calls.'''
+        if not self.count:
+            return None
+        samples = sorted(self.samples)
+        return {
+            'count': self.count,
+            'p50': samples[int(0.50 * (len(samples) - 1))] * 1000000,
+            'p95': samples[int(0.95 * (len(samples) - 1))] * 1000000,
+            'max': self.maximum * 1000000,
+        }
+
+def handler_name(event_type, callback):
+    ''' The name of a handler, {event}_{service}_{handler}.'''
+    name = getattr(callback, '__name__', callback.__class__.__name__)
+    owner = getattr(callback, '__self__', None)
+    if owner is not None:
+        name = "%s_%s" % (owner.__class__.__name__, name)
+    return "%s_%s" % (getattr(event_type, '__name__', event_type), name)
+
+def timed(callback, stats):
+    ''' Wrap a handler to record the latency of each call.'''
+    perf_counter = time.perf_counter
+    add = stats.add
+
+    def wrapper(event):
+        start = perf_counter()
+        try:
+            return callback(event)
+        finally:
+            add(perf_counter() - start)
+
+    wrapper.__wrapped__ = callback
+    return wrapper
+
+class Instrumentation(weewx.engine.StdService):
+    ''' Time the event handlers of the WeeWX services.'''
+    def __init__(self, engine, config_dict):
+        log.info("Version is: %s", VERSION)
+        super(Instrumentation, self).__init__(engine, config_dict)
+
+        service_dict = config_dict.get('Instrumentation', {})
+        self.handler_stats = {}
+        self.engine_bind = None
+        if not to_bool(service_dict.get('enable', True)):
+            log.info("Instrumentation is not enabled.")
+            return
+
+        self.summaries = {}
+        self.max_samples = to_int(service_dict.get('max_samples', 1000))
+        self.add_to_record = to_bool(service_dict.get('add_to_record', False))
+        self.field_prefix = service_dict.get('field_prefix', 'instrumentation_')
+
+        # Wrap the handlers that are already bound, and the ones bound from now on.
+        for event_type, callbacks in engine.callbacks.items():
+            for i, callback in enumerate(callbacks):
+                callbacks[i] = self.wrap(event_type, callback)
+        self.engine_bind = engine.bind
+        engine.bind = self.bind_timed
+
+        # Bound with the engine's bind, so that they are not timed.
+        if self.add_to_record:
+            self.engine_bind(weewx.NEW_ARCHIVE_RECORD, self.add_summaries)
+        # All the services have been created by startup, so the summary is bound after their handlers.
+        self.engine_bind(weewx.STARTUP, self.startup)
+
+    def shutDown(self):
+        """Run when an engine shutdown is requested."""
+        if self.engine_bind is not None:
+            self.engine.bind = self.engine_bind
+            self.engine_bind = None
+
+    def wrap(self, event_type, callback):
+        ''' Wrap a handler, each is tracked under a unique name.'''
+        name = handler_name(event_type, callback)
+        unique_name = name
+        i = 1
+        while unique_name in self.handler_stats:
+            i += 1
+            unique_name = "%s_%i" % (name, i)
+
+        stats = HandlerStats(self.max_samples)
+        self.handler_stats[unique_name] = stats
+        return timed(callback, stats)
+
+    def bind_timed(self, event_type, callback):
+        ''' Bind a timed handler.'''
+        self.engine_bind(event_type, self.wrap(event_type, callback))
+
+    def startup(self, _event):
+        ''' Bind the summary, after the handlers of all the services.'''
+        self.engine_bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_record)
+
+    def add_summaries(self, event):
+        ''' Add the summary of the previous archive period to the record.'''
+        for name, summary in self.summaries.items():
+            for stat, value in summary.items():
+                event.record["%s%s_%s" % (self.field_prefix, name, stat)] = value
+
+    def new_archive_record(self, _event):
+        ''' Log the summary of the archive period and start a new one.'''
+        self.summaries = {}
+        for name, stats in self.handler_stats.items():
+            summary = stats.summary()
+            stats.reset()
+            if summary is None:
+                continue
+
+            log.info("%s: count %i, p50 %.1f us, p95 %.1f us, max %.1f us",
+                     name, summary['count'], summary['p50'], summary['p95'], summary['max'])
+            self.summaries[name] = summary
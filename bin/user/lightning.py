@@ -6,15 +6,264 @@
 
 '''
 WeeWX service to augment lightning data.
+
+Installation:
+    Put this file, and statefile.py, in the bin/user directory.
+
+Overview:
+Adds the first, last, min, and max strike distance and time of the archive period
+to the loop packets that have a strike distance.
+These are reset when a packet starts a new archive period, not when WeeWX restarts its loop.
+With a state_file, they are saved when WeeWX shuts down, and reloaded when WeeWX starts in the same period.
+The archive period is the interval of the archive records, [StdArchive] archive_interval until the first one arrives.
+Adds rolling strike statistics to every loop packet: the strike count and closest strike of each window,
+and a histogram of the strike distances in the longest window.
+These are kept in a ring buffer of per bucket_seconds buckets, so the memory is fixed and each packet is O(1).
+
+Configuration:
+[Lightning]
+    # The loop packet field with the strike distance.
+    lightning_distance_field_name = lightning_distance
+    # The file to save the archive period's first, last, min, and max to.
+    # A relative path is relative to WEEWX_ROOT.
+    # Default is None, the state is not saved.
+    state_file = None
+    # The loop packet field with the number of strikes in the packet.
+    # If the packet does not have it, a packet with a strike distance is one strike.
+    strike_count_field_name = lightning_strike_count
+
+    # The lengths, in minutes, of the rolling windows.
+    rolling_windows = 5, 15, 60
+    # The length, in seconds, of a ring buffer bucket. The windows move a bucket at a time.
+    bucket_seconds = 60
+    # The field names of each window's strike count and closest strike distance.
+    # {minutes} is replaced by the window length.
+    rolling_count_field_name = lightning_strike_count_{minutes}m
+    rolling_closest_field_name = lightning_closest_distance_{minutes}m
+    # The lower edges of the distance histogram's bins. The last bin has no upper edge.
+    histogram_bins = 0, 5, 10, 20, 40
+    # The field names of the bins' strike counts.
+    # {low} and {high} are replaced by the edges of the bin, the high edge of the last bin is 'max'.
+    histogram_field_name = lightning_distance_{low}_{high}_count
+
+    # The storm trend is a least squares line through the (time, distance) of the strikes in the trend window.
+    # The sums of the fit are updated as strikes enter and leave the window, so each strike is O(1).
+    # The length, in minutes, of the trend window.
+    trend_window = 15
+    # The fewest strikes in the window to compute a trend.
+    trend_min_strikes = 5
+    # The field name of the storm's speed in km/h, positive when approaching and negative when receding.
+    storm_speed_field_name = lightning_storm_speed
+    # The field name of the estimated seconds until the storm arrives, only set when it is approaching.
+    storm_eta_field_name = lightning_storm_eta
 '''
 
 import logging
 
+import collections
+import os
+import time
+
 import weewx
 import weewx.engine
+import weewx.units
+from weeutil.weeutil import option_as_list, startOfInterval, to_int, to_float
+from user.statefile import read_state, write_state
 
 log = logging.getLogger(__name__)
 
+class RollingStrikes(object):
+    ''' The strike counts and closest strike of rolling windows, and a distance histogram of the longest window.
+    The strikes are kept in a ring buffer of buckets covering the longest window.
+    The window totals are updated as strikes arrive and as buckets leave the windows.'''
+    __slots__ = ('bucket_seconds', 'windows', 'bins', 'bucket_count', 'current_bucket',
+                 'counts', 'closest', 'histograms',
+                 'window_counts', 'window_closest', 'closest_stale', 'histogram')
+
+    def __init__(self, window_seconds, bucket_seconds, bins):
+        self.bucket_seconds = bucket_seconds
+        # The number of buckets in each window
+        self.windows = [max(1, int(seconds // bucket_seconds)) for seconds in window_seconds]
+        self.bins = sorted(bins)
+        self.bucket_count = max(self.windows)
+        self.current_bucket = None
+
+        self.counts = [0] * self.bucket_count
+        self.closest = [None] * self.bucket_count
+        self.histograms = [[0] * len(self.bins) for _ in range(self.bucket_count)]
+
+        self.window_counts = [0] * len(self.windows)
+        self.window_closest = [None] * len(self.windows)
+        self.closest_stale = [False] * len(self.windows)
+        self.histogram = [0] * len(self.bins)
+
+    def clear(self):
+        ''' Forget all the strikes.'''
+        self.current_bucket = None
+        for i in range(self.bucket_count):
+            self.counts[i] = 0
+            self.closest[i] = None
+            self.histograms[i] = [0] * len(self.bins)
+        for i in range(len(self.windows)):
+            self.window_counts[i] = 0
+            self.window_closest[i] = None
+            self.closest_stale[i] = False
+        self.histogram = [0] * len(self.bins)
+
+    def advance(self, timestamp):
+        ''' Move the windows to the bucket of the timestamp.'''
+        bucket = int(timestamp // self.bucket_seconds)
+        if self.current_bucket is None or bucket - self.current_bucket >= self.bucket_count:
+            self.clear()
+            self.current_bucket = bucket
+            return
+
+        while self.current_bucket < bucket:
+            self.current_bucket += 1
+            for i, window in enumerate(self.windows):
+                # The bucket that leaves the window
+                slot = (self.current_bucket - window) % self.bucket_count
+                self.window_counts[i] -= self.counts[slot]
+                if self.closest[slot] is not None and self.closest[slot] == self.window_closest[i]:
+                    self.closest_stale[i] = True
+
+            slot = self.current_bucket % self.bucket_count
+            histogram = self.histograms[slot]
+            for j, count in enumerate(histogram):
+                self.histogram[j] -= count
+                histogram[j] = 0
+            self.counts[slot] = 0
+            self.closest[slot] = None
+
+    def add(self, timestamp, distance, count=1):
+        ''' Add strikes. Strikes older than the current bucket are counted in the current bucket.'''
+        self.advance(timestamp)
+        slot = self.current_bucket % self.bucket_count
+
+        self.counts[slot] += count
+        for i in range(len(self.windows)):
+            self.window_counts[i] += count
+
+        if distance is None:
+            return
+
+        if self.closest[slot] is None or distance < self.closest[slot]:
+            self.closest[slot] = distance
+        for i in range(len(self.windows)):
+            if not self.closest_stale[i] and (self.window_closest[i] is None or distance < self.window_closest[i]):
+                self.window_closest[i] = distance
+
+        j = len(self.bins) - 1
+        while j > 0 and distance < self.bins[j]:
+            j -= 1
+        self.histograms[slot][j] += count
+        self.histogram[j] += count
+
+    def get_closest(self, i):
+        ''' The closest strike of window i, rescanning its buckets only when the closest strike left the window.'''
+        if self.closest_stale[i]:
+            closest = None
+            for k in range(self.windows[i]):
+                distance = self.closest[(self.current_bucket - k) % self.bucket_count]
+                if distance is not None and (closest is None or distance < closest):
+                    closest = distance
+            self.window_closest[i] = closest
+            self.closest_stale[i] = False
+        return self.window_closest[i]
+
+class StormTrend(object):
+    ''' A least squares fit of distance against time over the strikes in a sliding window.
+    The sums of the fit are updated as strikes enter and leave the window.
+    Times are relative to an origin that is moved, by adjusting the sums, as the window moves.'''
+    __slots__ = ('window_seconds', 'min_strikes', 'strikes', 'origin',
+                 'count', 'sum_t', 'sum_d', 'sum_tt', 'sum_td')
+
+    def __init__(self, window_seconds, min_strikes):
+        self.window_seconds = window_seconds
+        self.min_strikes = max(2, min_strikes)
+        self.strikes = collections.deque()
+        self.origin = None
+        self.count = 0
+        self.sum_t = 0.0
+        self.sum_d = 0.0
+        self.sum_tt = 0.0
+        self.sum_td = 0.0
+
+    def add(self, timestamp, distance):
+        ''' Add a strike.'''
+        self.expire(timestamp)
+        if self.origin is None:
+            self.origin = timestamp
+        elif timestamp - self.origin > self.window_seconds:
+            self.move_origin(timestamp - self.window_seconds)
+
+        t = timestamp - self.origin
+        self.strikes.append((timestamp, distance))
+        self.count += 1
+        self.sum_t += t
+        self.sum_d += distance
+        self.sum_tt += t * t
+        self.sum_td += t * distance
+
+    def expire(self, timestamp):
+        ''' Remove the strikes that have left the window.'''
+        strikes = self.strikes
+        cutoff = timestamp - self.window_seconds
+        while strikes and strikes[0][0] <= cutoff:
+            strike_time, distance = strikes.popleft()
+            t = strike_time - self.origin
+            self.count -= 1
+            self.sum_t -= t
+            self.sum_d -= distance
+            self.sum_tt -= t * t
+            self.sum_td -= t * distance
+
+        if not strikes:
+            self.origin = None
+            self.count = 0
+            self.sum_t = 0.0
+            self.sum_d = 0.0
+            self.sum_tt = 0.0
+            self.sum_td = 0.0
+
+    def move_origin(self, origin):
+        ''' Make the times relative to a new origin, keeping them small.'''
+        shift = origin - self.origin
+        self.sum_tt -= 2 * shift * self.sum_t - self.count * shift * shift
+        self.sum_td -= shift * self.sum_d
+        self.sum_t -= self.count * shift
+        self.origin = origin
+
+    def fit(self):
+        ''' The slope, in distance per second, and the intercept at the origin. None if there are too few strikes.'''
+        if self.count < self.min_strikes:
+            return None
+        denominator = self.count * self.sum_tt - self.sum_t * self.sum_t
+        if denominator <= 0:
+            return None
+        slope = (self.count * self.sum_td - self.sum_t * self.sum_d) / denominator
+        intercept = (self.sum_d - slope * self.sum_t) / self.count
+        return slope, intercept
+
+    def get_trend(self, timestamp):
+        ''' The approach speed, in distance per hour, and the seconds until arrival, which is None unless approaching.'''
+        fit = self.fit()
+        if fit is None:
+            return None, None
+        slope, intercept = fit
+        speed = -slope * 3600
+        eta = None
+        if slope < 0:
+            distance = intercept + slope * (timestamp - self.origin)
+            eta = max(0.0, distance / -slope)
+        return speed, eta
+
+# The archive period's values that are saved in the state file.
+STATE_NAMES = ('last_lightning_distance', 'last_lightning_time',
+               'first_lightning_distance', 'first_lightning_time',
+               'min_lightning_distance', 'min_lightning_time',
+               'max_lightning_distance', 'max_lightning_time')
+
 class Lightning(weewx.engine.StdService):
     ''' Save additional lightning event data to the WeeWX packet.'''
     def __init__(self, engine, config_dict):
@@ -45,11 +294,81 @@ class Lightning(weewx.engine.StdService):
         self.max_distance_field_name = service_dict.get('max_distance_field_name', 'lightning_max_distance')
         self.max_det_time_field_name = service_dict.get('max_det_time_field_name', 'lightning_max_det_time')
 
-        self.bind(weewx.PRE_LOOP, self.pre_loop)
+        self.strike_count_field_name = service_dict.get('strike_count_field_name', 'lightning_strike_count')
+
+        rolling_windows = [to_int(minutes) for minutes in option_as_list(service_dict.get('rolling_windows', [5, 15, 60]))]
+        bucket_seconds = to_int(service_dict.get('bucket_seconds', 60))
+        histogram_bins = [to_float(edge) for edge in option_as_list(service_dict.get('histogram_bins', [0, 5, 10, 20, 40]))]
+        self.rolling_strikes = RollingStrikes([minutes * 60 for minutes in rolling_windows], bucket_seconds, histogram_bins)
+
+        rolling_count_field_name = service_dict.get('rolling_count_field_name', 'lightning_strike_count_{minutes}m')
+        rolling_closest_field_name = service_dict.get('rolling_closest_field_name', 'lightning_closest_distance_{minutes}m')
+        self.rolling_count_field_names = [rolling_count_field_name.format(minutes=minutes) for minutes in rolling_windows]
+        self.rolling_closest_field_names = [rolling_closest_field_name.format(minutes=minutes) for minutes in rolling_windows]
+
+        histogram_field_name = service_dict.get('histogram_field_name', 'lightning_distance_{low}_{high}_count')
+        edges = self.rolling_strikes.bins
+        self.histogram_field_names = [histogram_field_name.format(low='%g' % edges[j],
+                                                                  high='%g' % edges[j + 1] if j + 1 < len(edges) else 'max')
+                                      for j in range(len(edges))]
+
+        self.storm_trend = StormTrend(to_int(service_dict.get('trend_window', 15)) * 60,
+                                      to_int(service_dict.get('trend_min_strikes', 5)))
+        self.storm_speed_field_name = service_dict.get('storm_speed_field_name', 'lightning_storm_speed')
+        self.storm_eta_field_name = service_dict.get('storm_eta_field_name', 'lightning_storm_eta')
+
+        # Used until the first archive record gives the actual interval.
+        self.archive_interval = to_int(config_dict.get('StdArchive', {}).get('archive_interval', 300))
+        # The start of the archive period of the first, last, min, and max.
+        self.period_start = None
+
+        self.state_file = None
+        state_file = service_dict.get('state_file', None)
+        if state_file is not None and state_file != 'None':
+            self.state_file = os.path.join(config_dict.get('WEEWX_ROOT', ''), state_file)
+            self.load_state(read_state(self.state_file), time.time())
+
         self.bind(weewx.NEW_LOOP_PACKET, self.new_loop_packet)
+        self.bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_record)
 
-    def pre_loop(self, _event):
-        ''' Handle the WeeWX PRE_LOOP event. '''
+    def shutDown(self):
+        """Run when an engine shutdown is requested."""
+        if self.state_file:
+            self.save_state()
+            self.state_file = None
+
+    def load_state(self, state, timestamp):
+        ''' Restore a saved state, if it is of the timestamp's archive period.'''
+        period_start = startOfInterval(timestamp, self.archive_interval)
+        if state.get('period_start') != period_start:
+            log.debug("Not loading the state of period %s in period %s", state.get('period_start'), period_start)
+            return
+
+        self.period_start = period_start
+        for name in STATE_NAMES:
+            setattr(self, name, state.get(name))
+        log.info("Loaded the state of period %s", period_start)
+
+    def save_state(self):
+        ''' Write the current state.'''
+        state = {name: getattr(self, name) for name in STATE_NAMES}
+        state['period_start'] = self.period_start
+        try:
+            write_state(self.state_file, state)
+        except (IOError, OSError) as exception:
+            log.error("Unable to write state file %s: %s", self.state_file, exception)
+
+    def check_period(self, date_time):
+        ''' Reset the first, last, min, and max when a packet starts a new archive period.'''
+        period_start = startOfInterval(date_time, self.archive_interval)
+        if self.period_start is None:
+            self.period_start = period_start
+        elif period_start > self.period_start:
+            self.period_start = period_start
+            self.reset()
+
+    def reset(self):
+        ''' Forget the archive period's first, last, min, and max.'''
         self.last_lightning_distance = None
         self.last_lightning_time = None
         self.first_lightning_distance = None
@@ -61,38 +380,34 @@ class Lightning(weewx.engine.StdService):
 
     def new_loop_packet(self, event):
         ''' Handle the WeeWX POST_LOOP event.'''
+        self.check_period(event.packet['dateTime'])
+        self.add_rolling_strikes(event.packet)
+        self.add_storm_trend(event.packet)
+
         if self.lightning_distance_field_name not in event.packet:
             return
 
-        log.info(event.packet)
-        log.info(self.last_lightning_distance)
-        log.info(self.last_lightning_time)
-        log.info(self.first_lightning_distance)
-        log.info(self.first_lightning_time)
-        log.info(self.min_lightning_distance)
-        log.info(self.min_lightning_time)
-        log.info(self.max_lightning_distance)
-        log.info(self.max_lightning_time)
+        log.debug("Incoming packet is: %s", event.packet)
 
         date_time = event.packet['dateTime']
         lightning_distance = event.packet[self.lightning_distance_field_name]
 
-        log.info("Setting last lightning distance %s and time %s", lightning_distance, date_time)
+        log.debug("Setting last lightning distance %s and time %s", lightning_distance, date_time)
         self.last_lightning_distance = lightning_distance
         self.last_lightning_time = date_time
 
         if self.first_lightning_distance is None:
-            log.info("Setting first lightning distance %s and time %s", lightning_distance, date_time)
+            log.debug("Setting first lightning distance %s and time %s", lightning_distance, date_time)
             self.first_lightning_distance = lightning_distance
             self.first_lightning_time = date_time
 
         if self.min_lightning_distance is None or lightning_distance <= self.min_lightning_distance:
-            log.info("Setting min lightning distance %s and time %s", lightning_distance, date_time)
+            log.debug("Setting min lightning distance %s and time %s", lightning_distance, date_time)
             self.min_lightning_distance = lightning_distance
             self.min_lightning_time = date_time
 
         if self.max_lightning_distance is None or lightning_distance >= self.max_lightning_distance:
-            log.info("Setting max lightning distance %s and time %s", lightning_distance, date_time)
+            log.debug("Setting max lightning distance %s and time %s", lightning_distance, date_time)
             self.max_lightning_distance = lightning_distance
             self.max_lightning_time = date_time
 
@@ -105,4 +420,44 @@ class Lightning(weewx.engine.StdService):
         event.packet[self.max_distance_field_name] = self.max_lightning_distance
         event.packet[self.max_det_time_field_name] = self.max_lightning_time
 
-        log.info(event.packet)
+        log.debug("Outgoing packet is: %s", event.packet)
+
+    def new_archive_record(self, event):
+        ''' Handle the WeeWX NEW_ARCHIVE_RECORD event.'''
+        self.archive_interval = event.record['interval'] * 60
+
+    def add_rolling_strikes(self, packet):
+        ''' Update the rolling windows with the packet's strikes, and add their statistics to the packet.'''
+        rolling_strikes = self.rolling_strikes
+        date_time = packet['dateTime']
+        lightning_distance = packet.get(self.lightning_distance_field_name)
+        strike_count = packet.get(self.strike_count_field_name)
+        if strike_count is None and lightning_distance is not None:
+            strike_count = 1
+
+        if strike_count:
+            rolling_strikes.add(date_time, lightning_distance, strike_count)
+        else:
+            rolling_strikes.advance(date_time)
+
+        for i, field_name in enumerate(self.rolling_count_field_names):
+            packet[field_name] = rolling_strikes.window_counts[i]
+        for i, field_name in enumerate(self.rolling_closest_field_names):
+            packet[field_name] = rolling_strikes.get_closest(i)
+        for j, field_name in enumerate(self.histogram_field_names):
+            packet[field_name] = rolling_strikes.histogram[j]
+
+    def add_storm_trend(self, packet):
+        ''' Update the storm trend with the packet's strike, and add the storm's speed and time to arrival to the packet.'''
+        date_time = packet['dateTime']
+        lightning_distance = packet.get(self.lightning_distance_field_name)
+        if lightning_distance is not None:
+            # The trend is in km, whatever the packet's units.
+            distance_unit = weewx.units.std_groups[packet.get('usUnits', weewx.METRIC)]['group_distance']
+            if distance_unit != 'km':
+                lightning_distance = weewx.units.conversionDict[distance_unit]['km'](lightning_distance)
+            self.storm_trend.add(date_time, lightning_distance)
+        else:
+            self.storm_trend.expire(date_time)
+
+        packet[self.storm_speed_field_name], packet[self.storm_eta_field_name] = self.storm_trend.get_trend(date_time)
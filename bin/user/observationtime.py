@@ -25,9 +25,31 @@ In addition to capturing the value, the time that the value was observed is also
 Important:
 - The daily summaries cannot be used to get the time (observation_time_name) of the value.
   This is because the daily summary will have the min/max of the time, not the time of the min/max value.
+  Instead, with day_summaries enabled, the service keeps its own per day table, 'observationtime_day',
+  of the value and time of each configured aggregate. Long timespans (month, year, alltime) are then answered
+  from it, with only the partial days at the edges read from the archive.
+  To build the table for existing data, run:
+      PYTHONPATH=bin python bin/user/observationtime.py /path/to/weewx.conf --binding wx_binding --batch-days 30
 
 Configuration:
 [ObservationTime]
+    # Whether to keep the per day summary table of the aggregates' values and times.
+    # Default is False.
+    day_summaries = False
+    # Whether to manage an index on (observation_name, dateTime, observation_time_name) of each min and max aggregate.
+    # These let the min/max queries of long timespans (180 days or more) read the first row of the index
+    # instead of sorting every row of the timespan.
+    # none - do nothing. verify - log the missing indexes. create - create the missing indexes.
+    # Unless none, the indexes are used when they all exist and the query plans of each observation's aggregates are logged.
+    # Default is none.
+    indexes = none
+    # The longest timespan, in seconds, whose statistics (stddev, p50, p90, p99) the xtype serves.
+    # Default is 31622400, 366 days.
+    statistics_max_span = 31622400
+    # The binding of the database that holds the day summary table and the indexes.
+    # Default is wx_binding.
+    data_binding = wx_binding
+
     [[observations]]
         # The first observation whose 'event' value and time will be captured.
         # For example: lightning_distance, windGust, etc.
@@ -60,6 +82,18 @@ Configuration:
                 # The name of the WeeWX to store the max observation's time.
                 # For example: lightning_max_det_time, windGust_max_time, etc.                                
                 observation_time_name =
+            # The statistics of the observation's values in the archive period: count, stddev, p50, p90, and p99.
+            # These have no time, only the name of the WeeWX field to store the value.
+            # count and stddev use Welford's algorithm, the percentiles are estimated together with the extended P-square algorithm.
+            # So the memory used does not grow with the number of loop packets.
+            # The standard deviation is the sample standard deviation.
+            # The xtype serves stddev and the percentiles of the observation's archive values, for example $day.windGust.p90
+            # They are computed by the database, for timespans up to statistics_max_span.
+            # count is left to WeeWX's own count aggregate, which is the count of the archive values.
+            [[[[p90]]]]
+                # The name of the WeeWX to store the observation's 90th percentile.
+                # For example: windGust_p90.
+                observation_name =
         # The next observation whose 'event' value and time will be captured.
         [[[REPLACE_ME_TOO]]]
                 
@@ -119,18 +153,507 @@ weewx.units.obs_group_dict['lightning_min_det_time'] = 'group_time'
 
 # ToDo: Decide if the aggregate types should be new/unique, or to continue to override WeeWX's existing types.
 
+import argparse
+import bisect
+import collections
 import logging
+import math
+import threading
+
+import configobj
 
 import weewx
 import weewx.engine
+import weewx.manager
 import weedb
 
-from weeutil.weeutil import to_bool
+import weeutil.logger
+import weeutil.weeutil
+from weeutil.weeutil import to_bool, to_int
 
 VERSION = '0.2.0'
 
 log = logging.getLogger(__name__)
 
+# The aggregates that have a time, and the statistics that do not.
+TIME_TYPES = ('first', 'last', 'min', 'max')
+PERCENTILES = {'p50': 0.50, 'p90': 0.90, 'p99': 0.99}
+STATISTIC_TYPES = ('count', 'stddev') + tuple(PERCENTILES)
+# The statistics served by the xtype, count is WeeWX's.
+XTYPE_STATISTIC_TYPES = ('stddev',) + tuple(PERCENTILES)
+
+def time_types(observation_data):
+    ''' The configured aggregates of an observation that have a time.'''
+    return {observation_type: observation_type_data
+            for observation_type, observation_type_data in observation_data.items()
+            if observation_type in TIME_TYPES}
+
+def percentile(sorted_values, quantile):
+    ''' The quantile of the sorted values, interpolated between the two closest ranks. None if there are no values.'''
+    if not sorted_values:
+        return None
+    rank = quantile * (len(sorted_values) - 1)
+    lower = int(rank)
+    if lower + 1 >= len(sorted_values):
+        return sorted_values[lower]
+    return sorted_values[lower] + (rank - lower) * (sorted_values[lower + 1] - sorted_values[lower])
+
+class RunningStats(object):
+    ''' The count, mean, and sample standard deviation of an observation, using Welford's algorithm.'''
+    __slots__ = ('count', 'mean', 'm2')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        ''' Add an observation.'''
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def stddev(self):
+        ''' The sample standard deviation, None until there are two observations.'''
+        if self.count < 2:
+            return None
+        return math.sqrt(self.m2 / (self.count - 1))
+
+class P2Quantiles(object):
+    ''' Estimate several quantiles in constant memory, using the extended P-square algorithm of Raatikainen.
+    The 2m + 3 markers of m quantiles track the min, the max, each quantile, and the quantiles halfway between them,
+    so all of the quantiles are updated by one pass over the markers.
+    Until there is an observation per marker, the quantiles are interpolated from the observations.'''
+    __slots__ = ('quantiles', 'count', 'heights', 'positions', 'fractions')
+
+    def __init__(self, quantiles):
+        self.quantiles = sorted(quantiles)
+        self.count = 0
+        self.heights = []
+        fractions = [0.0]
+        previous = 0.0
+        for quantile in self.quantiles:
+            fractions.extend([(previous + quantile) / 2, quantile])
+            previous = quantile
+        fractions.extend([(previous + 1) / 2, 1.0])
+        # The desired position of each marker is its fraction of the observations.
+        self.fractions = fractions
+        self.positions = list(range(len(fractions)))
+
+    def add(self, value):
+        ''' Add an observation.'''
+        heights = self.heights
+        marker_count = len(self.fractions)
+        if self.count < marker_count:
+            self.count += 1
+            bisect.insort(heights, value)
+            return
+
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[-1]:
+            heights[-1] = value
+            cell = marker_count - 2
+        else:
+            cell = bisect.bisect_right(heights, value) - 1
+
+        positions = self.positions
+        for i in range(cell + 1, marker_count):
+            positions[i] += 1
+        last = self.count
+        self.count += 1
+
+        for i in range(1, marker_count - 1):
+            difference = self.fractions[i] * last - positions[i]
+            if (difference >= 1 and positions[i + 1] - positions[i] > 1) or \
+               (difference <= -1 and positions[i - 1] - positions[i] < -1):
+                step = 1 if difference > 0 else -1
+                height = self.parabolic(i, step)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = heights[i] + step * (heights[i + step] - heights[i]) / (positions[i + step] - positions[i])
+                heights[i] = height
+                positions[i] += step
+
+    def parabolic(self, i, step):
+        ''' The piecewise parabolic prediction of marker i's height after moving it a step.'''
+        heights = self.heights
+        positions = self.positions
+        return heights[i] + step / (positions[i + 1] - positions[i - 1]) * \
+            ((positions[i] - positions[i - 1] + step) * (heights[i + 1] - heights[i]) / (positions[i + 1] - positions[i]) +
+             (positions[i + 1] - positions[i] - step) * (heights[i] - heights[i - 1]) / (positions[i] - positions[i - 1]))
+
+    def value(self, quantile):
+        ''' The estimated quantile, None if there are no observations.'''
+        if self.count > len(self.fractions):
+            return self.heights[2 * self.quantiles.index(quantile) + 2]
+        return percentile(self.heights, quantile)
+
+class ObservationAggregate(object):
+    ''' The first, last, min, and max value and time of an observation, and its configured statistics, updated incrementally.'''
+    __slots__ = ('first_value', 'first_time', 'last_value', 'last_time',
+                 'min_value', 'min_time', 'max_value', 'max_time',
+                 'stats', 'quantiles')
+
+    def __init__(self, aggregate_types=()):
+        self.first_value = None
+        self.first_time = None
+        self.last_value = None
+        self.last_time = None
+        self.min_value = None
+        self.min_time = None
+        self.max_value = None
+        self.max_time = None
+
+        self.stats = None
+        if 'count' in aggregate_types or 'stddev' in aggregate_types:
+            self.stats = RunningStats()
+        self.quantiles = None
+        quantiles = [quantile for aggregate_type, quantile in PERCENTILES.items() if aggregate_type in aggregate_types]
+        if quantiles:
+            self.quantiles = P2Quantiles(quantiles)
+
+    def add(self, value, timestamp):
+        ''' Add an observation. Ties for min and max go to the later observation.'''
+        if self.first_time is None:
+            self.first_value = value
+            self.first_time = timestamp
+
+        self.last_value = value
+        self.last_time = timestamp
+
+        if self.min_value is None or value <= self.min_value:
+            self.min_value = value
+            self.min_time = timestamp
+
+        if self.max_value is None or value >= self.max_value:
+            self.max_value = value
+            self.max_time = timestamp
+
+        if self.stats is not None:
+            self.stats.add(value)
+        if self.quantiles is not None:
+            self.quantiles.add(value)
+
+    def get(self, aggregate_type):
+        ''' Get the value and time of an aggregate type. The time is None if there were no observations.'''
+        if aggregate_type == 'first':
+            return self.first_value, self.first_time
+        if aggregate_type == 'last':
+            return self.last_value, self.last_time
+        if aggregate_type == 'min':
+            return self.min_value, self.min_time
+        if aggregate_type == 'max':
+            return self.max_value, self.max_time
+        raise ValueError("Unknown aggregate type: %s" % aggregate_type)
+
+    def get_statistic(self, aggregate_type):
+        ''' Get the value of a configured statistic, None if there are not enough observations.'''
+        if aggregate_type == 'count' and self.stats is not None:
+            return self.stats.count
+        if aggregate_type == 'stddev' and self.stats is not None:
+            return self.stats.stddev()
+        if aggregate_type in PERCENTILES and self.quantiles is not None and PERCENTILES[aggregate_type] in self.quantiles.quantiles:
+            return self.quantiles.value(PERCENTILES[aggregate_type])
+        raise ValueError("Unknown aggregate type: %s" % aggregate_type)
+
+class AggregatePeriod(object):
+    ''' The aggregates of the observations in an archive period, start < dateTime <= stop.'''
+    __slots__ = ('start', 'stop', 'aggregates')
+
+    def __init__(self, start, stop, observations):
+        self.start = start
+        self.stop = stop
+        self.aggregates = {observation: ObservationAggregate(observation_data)
+                           for observation, observation_data in observations.items()}
+
+DAY_TABLE = 'observationtime_day'
+
+# One row per day, configured time observation (obs_type), and the archive record (row_time) that is the aggregate.
+# 'dateTime' is the start of the day, the day covers start < archive dateTime <= start of the next day.
+DAY_TABLE_SCHEMA = "CREATE TABLE IF NOT EXISTS %s (" \
+    "dateTime INTEGER NOT NULL, obs_type VARCHAR(64) NOT NULL, " \
+    "value REAL, time INTEGER, row_time INTEGER NOT NULL, " \
+    "PRIMARY KEY (dateTime, obs_type));" % DAY_TABLE
+
+def next_day(timestamp):
+    ''' The start of the day after the day of the timestamp.'''
+    return weeutil.weeutil.startOfDay(weeutil.weeutil.startOfDay(timestamp) + 36 * 3600)
+
+def combine(aggregate_type, candidates):
+    ''' Combine (value, time, dateTime) candidates of an aggregate type, None candidates are skipped.
+    Like the archive queries, ties for min and max go to the later dateTime.'''
+    result = None
+    for candidate in candidates:
+        if candidate is None:
+            continue
+        if result is None:
+            result = candidate
+            continue
+
+        value, _, date_time = candidate
+        if aggregate_type == 'first':
+            better = date_time < result[2]
+        elif aggregate_type == 'last':
+            better = date_time > result[2]
+        elif aggregate_type == 'min':
+            better = value < result[0] or (value == result[0] and date_time > result[2])
+        elif aggregate_type == 'max':
+            better = value > result[0] or (value == result[0] and date_time > result[2])
+        else:
+            raise ValueError("Unknown aggregate type: %s" % aggregate_type)
+
+        if better:
+            result = candidate
+
+    return result
+
+SQL_STMTS = {
+    'first': "SELECT {primary_observation}, {input}, dateTime FROM {table_name} "
+        "WHERE dateTime > {start} AND dateTime <= {stop} AND {primary_observation} IS NOT NULL "
+        "ORDER BY dateTime ASC LIMIT 1",
+    'last': "SELECT {primary_observation}, {input}, dateTime FROM {table_name} "
+        "WHERE dateTime > {start} AND dateTime <= {stop} AND {primary_observation} IS NOT NULL "
+        "ORDER BY dateTime DESC LIMIT 1",
+    'min': "SELECT {primary_observation}, {input}, dateTime FROM {table_name} "
+        "WHERE dateTime > {start} AND dateTime <= {stop} AND {primary_observation} IS NOT NULL "
+        "ORDER BY {primary_observation} ASC, dateTime DESC LIMIT 1",
+    'max': "SELECT {primary_observation}, {input}, dateTime FROM {table_name} "
+        "WHERE dateTime > {start} AND dateTime <= {stop} AND {primary_observation} IS NOT NULL "
+        "ORDER BY {primary_observation} DESC, dateTime DESC LIMIT 1",
+}
+
+# The min and max queries of long timespans when the indexes exist.
+# The unary plus keeps the database from choosing the dateTime range over the index,
+# so that the index is read in order and the first row in the timespan is the aggregate.
+INDEXED_SQL_STMTS = {
+    'min': "SELECT {primary_observation}, {input}, dateTime FROM {table_name} "
+        "WHERE +dateTime > {start} AND +dateTime <= {stop} AND {primary_observation} IS NOT NULL "
+        "ORDER BY {primary_observation} ASC, dateTime DESC LIMIT 1",
+    'max': "SELECT {primary_observation}, {input}, dateTime FROM {table_name} "
+        "WHERE +dateTime > {start} AND +dateTime <= {stop} AND {primary_observation} IS NOT NULL "
+        "ORDER BY {primary_observation} DESC, dateTime DESC LIMIT 1",
+}
+
+# The columns of the covering index of each aggregate type, ordered like the query's ORDER BY.
+# The first and last queries are answered by the dateTime primary key.
+INDEX_COLUMNS = {
+    'min': "{observation_name}, dateTime DESC, {observation_time_name}",
+    'max': "{observation_name}, dateTime, {observation_time_name}",
+}
+
+# Timespans at least this long are forced to use the indexes, for shorter ones the database chooses.
+# On a seasonal value, the index read in order can pass most of the other seasons' rows before reaching the timespan.
+# With two years of five minute records (utils/benchmarkObservationTime.py), forcing the index was slower
+# at 90 days or less, and faster from 180 days, where the timespan holds a whole season's extremes.
+INDEX_MIN_SPAN = 180 * 24 * 3600
+
+DAY_SQL_STMTS = {
+    'first': "SELECT value, time, row_time FROM {table_name} "
+        "WHERE dateTime >= {start} AND dateTime < {stop} AND obs_type = '{input}' "
+        "ORDER BY row_time ASC LIMIT 1",
+    'last': "SELECT value, time, row_time FROM {table_name} "
+        "WHERE dateTime >= {start} AND dateTime < {stop} AND obs_type = '{input}' "
+        "ORDER BY row_time DESC LIMIT 1",
+    'min': "SELECT value, time, row_time FROM {table_name} "
+        "WHERE dateTime >= {start} AND dateTime < {stop} AND obs_type = '{input}' "
+        "ORDER BY value ASC, row_time DESC LIMIT 1",
+    'max': "SELECT value, time, row_time FROM {table_name} "
+        "WHERE dateTime >= {start} AND dateTime < {stop} AND obs_type = '{input}' "
+        "ORDER BY value DESC, row_time DESC LIMIT 1",
+}
+
+def aggregates_sql(sql_stmts, table_name, observation_types, start, stop):
+    ''' The query of the (value, time, dateTime) of each of an observation's configured aggregate types.
+    Each aggregate is a single row subquery, so that the LIMIT applies to it alone.'''
+    union_stmts = []
+    for observation_type, observation_type_data in observation_types.items():
+        interpolation_dict = {
+            'start': start,
+            'stop': stop,
+            'table_name': table_name,
+            'input': observation_type_data['observation_time_name'],
+            'primary_observation': observation_type_data['observation_name']
+        }
+        union_stmts.append("SELECT '{observation_type}', {observation_type}_row.* FROM ({sql_stmt}) AS {observation_type}_row"
+                           .format(observation_type=observation_type,
+                                   sql_stmt=sql_stmts[observation_type].format(**interpolation_dict)))
+
+    return ' UNION ALL '.join(union_stmts) + ';'
+
+def query_aggregates(db_manager, sql_stmts, table_name, observation_types, start, stop):
+    ''' Get the (value, time, dateTime) of each of an observation's configured aggregate types, using one query.'''
+    aggregates = {observation_type: None for observation_type in observation_types}
+    for row in db_manager.genSql(aggregates_sql(sql_stmts, table_name, observation_types, start, stop)):
+        aggregates[row[0]] = tuple(row[1:])
+    return aggregates
+
+def index_name(observation_type_data):
+    ''' The name of the index of an aggregate's observation.'''
+    return 'observationtime_%s' % observation_type_data['observation_name']
+
+def get_index_names(db_manager):
+    ''' The names of the indexes on the archive table.'''
+    if getattr(db_manager.connection, 'dbtype', None) == 'mysql':
+        return {row[2] for row in db_manager.genSql("SHOW INDEX FROM %s;" % db_manager.table_name)}
+    return {row[0] for row in db_manager.genSql("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?;",
+                                                (db_manager.table_name,))}
+
+def manage_indexes(db_manager, observations, create):
+    ''' Verify, and optionally create, the covering index of each configured min and max aggregate.
+    Returns the names of the indexes that are missing.'''
+    existing_indexes = get_index_names(db_manager)
+    missing_indexes = []
+    for observation_data in observations.values():
+        for observation_type, observation_type_data in observation_data.items():
+            if observation_type not in INDEX_COLUMNS:
+                continue
+            name = index_name(observation_type_data)
+            if name in existing_indexes:
+                continue
+            if create:
+                log.info("Creating index %s", name)
+                db_manager.getSql("CREATE INDEX %s ON %s (%s);"
+                                  % (name, db_manager.table_name, INDEX_COLUMNS[observation_type].format(**observation_type_data)))
+                existing_indexes.add(name)
+            else:
+                log.info("Index %s does not exist", name)
+                missing_indexes.append(name)
+
+    return missing_indexes
+
+def explain_aggregates(db_manager, sql_stmts, observation_types, start, stop):
+    ''' The query plan of the query of an observation's aggregates.'''
+    explain = 'EXPLAIN' if getattr(db_manager.connection, 'dbtype', None) == 'mysql' else 'EXPLAIN QUERY PLAN'
+    sql_stmt = aggregates_sql(sql_stmts, db_manager.table_name, observation_types, start, stop)
+    return [tuple(row) for row in db_manager.genSql("%s %s" % (explain, sql_stmt))]
+
+# The window ordering that ranks the row of each aggregate type first in its bucket.
+# Rows without the aggregate's observation are ranked last.
+SERIES_ORDER = {
+    'first': "{primary_observation} IS NULL, dateTime ASC",
+    'last': "{primary_observation} IS NULL, dateTime DESC",
+    'min': "{primary_observation} IS NULL, {primary_observation} ASC, dateTime DESC",
+    'max': "{primary_observation} IS NULL, {primary_observation} DESC, dateTime DESC",
+}
+
+def query_series(db_manager, observation_types, buckets):
+    ''' Get the (value, time, dateTime) of each of an observation's configured aggregate types in each bucket.
+    The buckets are a list of (start, stop) and each aggregate type is ranked by a window function,
+    so that all the buckets and aggregate types are computed by one query.'''
+    row_constructor = 'ROW(%d, %d)' if getattr(db_manager.connection, 'dbtype', None) == 'mysql' else '(%d, %d)'
+
+    columns = []
+    ranks = []
+    for observation_type, observation_type_data in observation_types.items():
+        columns.append(observation_type_data['observation_name'])
+        columns.append(observation_type_data['observation_time_name'])
+        order = SERIES_ORDER[observation_type].format(primary_observation=observation_type_data['observation_name'])
+        ranks.append("ROW_NUMBER() OVER (PARTITION BY bucket_start ORDER BY {order}) AS {observation_type}_rank"
+                     .format(order=order, observation_type=observation_type))
+
+    sql_stmt = "WITH buckets (bucket_start, bucket_stop) AS (VALUES {bucket_values}) " \
+        "SELECT * FROM (" \
+        "SELECT bucket_start, dateTime, {columns}, {ranks} " \
+        "FROM buckets JOIN {table_name} ON dateTime > bucket_start AND dateTime <= bucket_stop" \
+        ") AS ranked_rows WHERE {rank_filter};".format(
+            bucket_values=', '.join(row_constructor % bucket for bucket in buckets),
+            columns=', '.join(columns),
+            ranks=', '.join(ranks),
+            table_name=db_manager.table_name,
+            rank_filter=' OR '.join("%s_rank = 1" % observation_type for observation_type in observation_types))
+
+    series = {bucket[0]: {observation_type: None for observation_type in observation_types} for bucket in buckets}
+    rank_offset = 2 + len(columns)
+    for row in db_manager.genSql(sql_stmt):
+        for i, observation_type in enumerate(observation_types):
+            value = row[2 + 2 * i]
+            if row[rank_offset + i] == 1 and value is not None:
+                series[row[0]][observation_type] = (value, row[3 + 2 * i], row[1])
+    return series
+
+class DaySummaries(object):
+    ''' Per day value and time of the first, last, min, and max of the configured observations.
+    The rows of the current day are kept in memory, and written when an archive record changes them.'''
+    def __init__(self, db_manager, observations):
+        self.db_manager = db_manager
+        self.observations = {observation: time_types(observation_data)
+                             for observation, observation_data in observations.items()}
+        self.day = None
+        self.rows = {}
+
+        self.db_manager.getSql(DAY_TABLE_SCHEMA)
+
+    def load(self, day):
+        ''' Load the rows of a day.'''
+        self.day = day
+        self.rows = {}
+        for row in self.db_manager.genSql("SELECT obs_type, value, time, row_time FROM %s WHERE dateTime = ?;" % DAY_TABLE, (day,)):
+            self.rows[row[0]] = tuple(row[1:])
+
+    def update(self, record):
+        ''' Update the day's rows with an archive record.'''
+        date_time = record['dateTime']
+        day = weeutil.weeutil.startOfArchiveDay(date_time)
+        if day != self.day:
+            self.load(day)
+
+        changed = []
+        for observation_data in self.observations.values():
+            for observation_type, observation_type_data in observation_data.items():
+                value = record.get(observation_type_data['observation_name'])
+                if value is None:
+                    continue
+                obs_type = observation_type_data['observation_time_name']
+                candidate = (value, record.get(obs_type), date_time)
+                row = self.rows.get(obs_type)
+                if combine(observation_type, [row, candidate]) is not row:
+                    self.rows[obs_type] = candidate
+                    changed.append(obs_type)
+
+        if changed:
+            with weedb.Transaction(self.db_manager.connection) as cursor:
+                for obs_type in changed:
+                    self.write_row(cursor, day, obs_type, self.rows[obs_type])
+
+    @staticmethod
+    def write_row(cursor, day, obs_type, row):
+        ''' Write a day's row.'''
+        cursor.execute("REPLACE INTO %s (dateTime, obs_type, value, time, row_time) VALUES (?, ?, ?, ?, ?);" % DAY_TABLE,
+                       (day, obs_type) + tuple(row))
+
+    def backfill(self, batch_days=30):
+        ''' Build the rows from the archive, committing every batch_days days.'''
+        first_timestamp = self.db_manager.firstGoodStamp()
+        last_timestamp = self.db_manager.lastGoodStamp()
+        if first_timestamp is None:
+            return 0
+
+        days = 0
+        day = weeutil.weeutil.startOfArchiveDay(first_timestamp)
+        while day < last_timestamp:
+            with weedb.Transaction(self.db_manager.connection) as cursor:
+                for _ in range(batch_days):
+                    if day >= last_timestamp:
+                        break
+                    stop = next_day(day)
+                    for observation_data in self.observations.values():
+                        if not observation_data:
+                            continue
+                        aggregates = query_aggregates(self.db_manager, SQL_STMTS, self.db_manager.table_name,
+                                                      observation_data, day, stop)
+                        for observation_type, aggregate in aggregates.items():
+                            if aggregate is not None:
+                                self.write_row(cursor, day, observation_data[observation_type]['observation_time_name'],
+                                               aggregate)
+                    day = stop
+                    days += 1
+            log.info("Backfilled through %s", weeutil.weeutil.timestamp_to_string(day))
+
+        self.day = None
+        return days
+
 class ObservationTime(weewx.engine.StdService):
     ''' Save the times and values of the first, last, min, and max of an observation.'''
     def __init__(self, engine, config_dict):
@@ -141,160 +664,405 @@ class ObservationTime(weewx.engine.StdService):
         service_dict = config_dict.get('ObservationTime', {})
         self.observations = service_dict.get('observations', {})
         log.debug("The configuration is: %s", self.observations)
-        for _observation, observation_data in self.observations.items():
-            observation_data['data'] = {}
 
-        if to_bool(service_dict.get('augment_loop', True)):
+        # Used until the first archive record gives the actual interval.
+        self.archive_interval = to_int(config_dict.get('StdArchive', {}).get('archive_interval', 300))
+        # The period being accumulated, and the previous period if its archive record has not been processed yet.
+        self.current_period = None
+        self.previous_period = None
+
+        self.day_summaries = None
+        use_day_summaries = to_bool(service_dict.get('day_summaries', False))
+        indexes = service_dict.get('indexes', 'none').lower()
+        if indexes not in ('none', 'verify', 'create'):
+            raise ValueError("Invalid value for indexes: %s" % indexes)
+
+        if use_day_summaries or indexes != 'none':
+            data_binding = service_dict.get('data_binding', 'wx_binding')
+            db_manager = self.engine.db_binder.get_manager(data_binding=data_binding, initialize=True)
+            if use_day_summaries:
+                self.day_summaries = DaySummaries(db_manager, self.observations)
+
+        self.augment_loop = to_bool(service_dict.get('augment_loop', True))
+        if self.augment_loop:
             self.bind(weewx.NEW_LOOP_PACKET, self.new_loop_packet)
-            self.bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_record)
+        self.bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_record)
 
-        self.observation_time_xtype = ObservationTimeXtype(self.observations)
+        statistics_max_span = to_int(service_dict.get('statistics_max_span', 366 * 24 * 3600))
+        self.observation_time_xtype = ObservationTimeXtype(self.observations,
+                                                           use_day_summaries=use_day_summaries,
+                                                           use_indexes=indexes != 'none',
+                                                           statistics_max_span=statistics_max_span)
         weewx.xtypes.xtypes.insert(0, self.observation_time_xtype)
 
+        if indexes != 'none':
+            self.check_indexes(db_manager, indexes == 'create')
+
     def shutDown(self):
         """Run when an engine shutdown is requested."""
         weewx.xtypes.xtypes.remove(self.observation_time_xtype)
 
-    def new_loop_packet(self, event):
-        ''' Handle the WeeWX POST_LOOP event.'''
-        #log.debug("Processing packet is: %s", event.packet)
+    def check_indexes(self, db_manager, create):
+        ''' Verify or create the indexes, and report the query plans of a day and of all of each observation's aggregates.'''
+        manage_indexes(db_manager, self.observations, create)
+
+        start = db_manager.firstGoodStamp()
+        stop = db_manager.lastGoodStamp()
+        if stop is None:
+            return
         for observation, observation_data in self.observations.items():
-            if observation not in event.packet:
+            observation_types = time_types(observation_data)
+            if not observation_types:
                 continue
+            for timespan in (weeutil.weeutil.TimeSpan(stop - 24 * 3600, stop), weeutil.weeutil.TimeSpan(start - 1, stop)):
+                try:
+                    sql_stmts = self.observation_time_xtype.get_sql_stmts(timespan, db_manager)
+                    for row in explain_aggregates(db_manager, sql_stmts, observation_types, timespan.start, timespan.stop):
+                        log.info("Query plan of %s over %s seconds: %s", observation, timespan.length, row)
+                except weedb.DatabaseError as exception:
+                    log.error("Could not get the query plan of %s: %s", observation, exception)
 
-            #log.debug("Processing observation: %s %s", observation, observation_data)
-            observation_value = event.packet[observation]
-            observation_time = event.packet['dateTime']
+    def new_loop_packet(self, event):
+        ''' Handle the WeeWX POST_LOOP event.'''
+        observation_time = event.packet['dateTime']
 
-            #log.debug("Processing observation: %s current value: %s and current time: %s", observation, observation_value, observation_time)
-            if observation_value is None:
-                continue
+        period = self.current_period
+        if period is None or observation_time > period.stop:
+            # The packet starts a new period, the current one is kept until its archive record is processed.
+            self.previous_period = period
+            start = weeutil.weeutil.startOfInterval(observation_time, self.archive_interval)
+            period = AggregatePeriod(start, start + self.archive_interval, self.observations)
+            self.current_period = period
+        elif observation_time <= period.start:
+            period = self.previous_period
+            if period is None or observation_time <= period.start:
+                return
 
-            observation_data['data'][str(observation_time)] = {}
-            observation_data['data'][str(observation_time)]['value'] = observation_value
-            observation_data['data'][str(observation_time)]['time'] = observation_time
+        aggregates = period.aggregates
+        for observation in aggregates:
+            observation_value = event.packet.get(observation)
+            if observation_value is not None:
+                aggregates[observation].add(observation_value, observation_time)
 
     def new_archive_record(self, event):
         '''Handle the WeeWX NEW_ARCHIVE_RECORD event. '''
         log.debug("Incoming record is: %s", event.record)
-        value_types = ['first', 'last', 'min', 'max']
-
-        end_time_stamp = event.record['dateTime']
-        interval = event.record['interval']
-        start_timestamp = end_time_stamp - interval * 60
-
-        for observation, observation_data in self.observations.items():
-            #log.debug("Processing observation: %s %s", observation, observation_data)
-            log.debug("Processing observation: %s", observation)
-            values = {}
-            for value_type in value_types:
-                values[value_type] = None
-
-            #log.debug("Incoming raw archive data is: %s", observation_data['data'])
-            for key, value in observation_data['data'].items():
-                observation_time =  value['time']
-                observation_value =  value['value']
-
-                # Observation value belongs to previous archive record,
-                if observation_time <= start_timestamp:
-                    del observation_data['data'][key]
-                    continue
+        self.observation_time_xtype.invalidate(event.record['dateTime'])
 
-                # Observation value belongs to next archive record
-                if observation_time > end_time_stamp:
-                    break
+        if self.augment_loop:
+            self.add_aggregates(event.record)
 
-                if values['first'] is None:
-                    values['first'] = {}
-                    values['first']['timestamp'] = observation_time
-                    values['first']['data_value'] = observation_value
+        if self.day_summaries:
+            self.day_summaries.update(event.record)
 
-                if values['last'] is None:
-                    values['last'] = {}
-                values['last']['timestamp'] = observation_time
-                values['last']['data_value'] = observation_value
+        log.debug("Outgoing record is: %s", event.record)
 
-                if values['min'] is None or observation_value <= values['min']['data_value']:
-                    values['min'] = {}
-                    values['min']['timestamp'] = observation_time
-                    values['min']['data_value'] = observation_value
+    def add_aggregates(self, record):
+        ''' Add the aggregates of the loop packets in the record's archive period to the record.'''
+        end_time_stamp = record['dateTime']
+        self.archive_interval = record['interval'] * 60
 
-                if values['max'] is None or observation_value >= values['max']['data_value']:
-                    values['max'] = {}
-                    values['max']['timestamp'] = observation_time
-                    values['max']['data_value'] = observation_value
+        period = None
+        if self.previous_period is not None and self.previous_period.stop == end_time_stamp:
+            period = self.previous_period
+        elif self.current_period is not None and self.current_period.stop == end_time_stamp:
+            period = self.current_period
+            self.current_period = None
+        self.previous_period = None
 
-                del observation_data['data'][key]
+        # Periods that ended before this record have no record to go to.
+        if self.current_period is not None and self.current_period.stop <= end_time_stamp:
+            self.current_period = None
 
-            #log.debug("Outgoing raw archive data is: %s", observation_data['data'])
-            log.debug("Data values are: %s", values)
+        if period is None:
+            log.debug("No observations for record: %s", end_time_stamp)
+            return
 
+        for observation, observation_data in self.observations.items():
+            aggregate = period.aggregates[observation]
             for observation_type in observation_data:
-                if observation_type == 'data':
+                if observation_type in STATISTIC_TYPES:
+                    observation_value = aggregate.get_statistic(observation_type)
+                    if observation_value is not None:
+                        record[observation_data[observation_type]['observation_name']] = observation_value
                     continue
-                observation_name = observation_data[observation_type]['observation_name']
-                observation_time_name = observation_data[observation_type]['observation_time_name']
-                if values[observation_type] is not None:
-                    event.record[observation_name] = values[observation_type]['data_value']
-                    event.record[observation_time_name] = values[observation_type]['timestamp']
 
-        log.debug("Outgoing record is: %s", event.record)
+                observation_value, observation_time = aggregate.get(observation_type)
+                if observation_time is not None:
+                    record[observation_data[observation_type]['observation_name']] = observation_value
+                    record[observation_data[observation_type]['observation_time_name']] = observation_time
 
 
 class ObservationTimeXtype(weewx.xtypes.XType):
-    ''' XType to add the aggregate types to get the dependent time observation's data.'''
-    def __init__(self, observations):
+    ''' XType to add the aggregate types to get the dependent time observation's data.
+    The configured aggregates of an observation are all computed by one query per timespan.
+    When the day summaries are used, the whole days of the timespan come from the day summary table
+    and only the partial days at the edges from the archive.
+    A series of an aggregate is computed, for every bucket and aggregate type, by one windowed query.
+    The statistics (stddev, p50, p90, p99) of an observation's archive values are computed by the database,
+    the count and sum of squares by one query and the values at the ranks of the percentiles by another.
+    Timespans longer than statistics_max_span are not served.
+    The results are memoized, keyed by (database, observation, start, stop[, aggregate interval]),
+    until an archive record inside the timespan arrives or the memo is full.'''
+    def __init__(self, observations, max_memoized=100, use_day_summaries=False, use_indexes=False,
+                 statistics_max_span=366 * 24 * 3600):
         self.observation_time_names = {}
-        for _observation, observation_data in observations.items():
-            for observation_type, observation_type_data in observation_data.items():
-                if observation_type == 'data':
-                    continue
+        self.observations = {}
+        # The statistics of each observation, computed from the observation's archive values.
+        self.statistics = {}
+        for observation, observation_data in observations.items():
+            self.observations[observation] = {}
+            statistic_types = [observation_type for observation_type in observation_data
+                               if observation_type in XTYPE_STATISTIC_TYPES]
+            if statistic_types:
+                self.statistics[observation] = statistic_types
+            for observation_type, observation_type_data in time_types(observation_data).items():
                 observation_time_name = observation_type_data['observation_time_name']
                 self.observation_time_names[observation_time_name] = {}
+                self.observation_time_names[observation_time_name]['observation'] = observation
                 self.observation_time_names[observation_time_name]['observation_name'] = observation_type_data['observation_name']
                 self.observation_time_names[observation_time_name]['observation_type'] = observation_type
+                self.observations[observation][observation_type] = observation_type_data
 
-        self.sql_stmts = {
-            'first': "SELECT {input} FROM {table_name} "
-                "WHERE dateTime > {start} AND dateTime <= {stop} AND {primary_observation} IS NOT NULL "
-                "ORDER BY dateTime ASC LIMIT 1;",
-            'last': "SELECT {input} FROM {table_name} "
-                "WHERE dateTime > {start} AND dateTime <= {stop} AND {primary_observation} IS NOT NULL "
-                "ORDER BY dateTime DESC LIMIT 1;",
-            'min': "SELECT {input} FROM {table_name} "
-                "WHERE dateTime > {start} AND dateTime <= {stop} AND {primary_observation} IS NOT NULL "
-                "ORDER BY {primary_observation} ASC, dateTime DESC LIMIT 1;",
-            'max': "SELECT {input} FROM {table_name} "
-                "WHERE dateTime > {start} AND dateTime <= {stop} AND {primary_observation} IS NOT NULL "
-                "ORDER BY {primary_observation} DESC, dateTime DESC LIMIT 1;",
-        }
+        self.statistics_max_span = statistics_max_span
 
-    def get_aggregate(self, obs_type, timespan, aggregate_type, db_manager, **option_dict):
+        self.use_day_summaries = use_day_summaries
+        # Whether each database has the day summary table.
+        self.day_tables = {}
+        self.use_indexes = use_indexes
+        # Whether each database has all the indexes.
+        self.indexed_databases = {}
+        self.indexed_sql_stmts = dict(SQL_STMTS)
+        self.indexed_sql_stmts.update(INDEXED_SQL_STMTS)
+
+        self.max_memoized = max_memoized
+        self.memoized = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def invalidate(self, timestamp):
+        ''' Forget the memoized aggregates of the timespans that include the timestamp.'''
+        with self.lock:
+            for memo_key in [memo_key for memo_key in self.memoized if memo_key[2] < timestamp <= memo_key[3]]:
+                del self.memoized[memo_key]
+
+    def has_day_table(self, db_manager):
+        ''' Whether the database has the day summary table.'''
+        if not self.use_day_summaries:
+            return False
+        if db_manager.database_name not in self.day_tables:
+            self.day_tables[db_manager.database_name] = DAY_TABLE in db_manager.connection.tables()
+        return self.day_tables[db_manager.database_name]
+
+    def has_indexes(self, db_manager):
+        ''' Whether the database has all the indexes.'''
+        if not self.use_indexes:
+            return False
+        if db_manager.database_name not in self.indexed_databases:
+            index_names = get_index_names(db_manager)
+            self.indexed_databases[db_manager.database_name] = all(
+                index_name(observation_type_data) in index_names
+                for observation_data in self.observations.values()
+                for observation_type, observation_type_data in observation_data.items()
+                if observation_type in INDEX_COLUMNS)
+        return self.indexed_databases[db_manager.database_name]
+
+    def get_sql_stmts(self, timespan, db_manager):
+        ''' The aggregate queries for the timespan.'''
+        if timespan.length >= INDEX_MIN_SPAN and self.has_indexes(db_manager):
+            return self.indexed_sql_stmts
+        return SQL_STMTS
+
+    def get_aggregates(self, observation, timespan, db_manager):
+        ''' Get the (value, time, dateTime) of each configured aggregate of an observation.'''
+        memo_key = (db_manager.database_name, observation, timespan.start, timespan.stop)
+        with self.lock:
+            aggregates = self.memoized.get(memo_key)
+        if aggregates is not None:
+            return aggregates
+
+        observation_types = self.observations[observation]
+        aggregates = None
+        if self.has_day_table(db_manager):
+            full_start = timespan.start
+            if not weeutil.weeutil.isStartOfDay(full_start):
+                full_start = next_day(full_start)
+            full_stop = weeutil.weeutil.startOfDay(timespan.stop)
+            if full_start < full_stop:
+                parts = [query_aggregates(db_manager, DAY_SQL_STMTS, DAY_TABLE, observation_types, full_start, full_stop)]
+                if timespan.start < full_start:
+                    parts.append(query_aggregates(db_manager, SQL_STMTS, db_manager.table_name, observation_types,
+                                                  timespan.start, full_start))
+                if full_stop < timespan.stop:
+                    parts.append(query_aggregates(db_manager, SQL_STMTS, db_manager.table_name, observation_types,
+                                                  full_stop, timespan.stop))
+                aggregates = {observation_type: combine(observation_type, [part[observation_type] for part in parts])
+                              for observation_type in observation_types}
+
+        if aggregates is None:
+            aggregates = query_aggregates(db_manager, self.get_sql_stmts(timespan, db_manager), db_manager.table_name,
+                                          observation_types, timespan.start, timespan.stop)
+
+        self.memoize(memo_key, aggregates)
+        return aggregates
+
+    def memoize(self, memo_key, value):
+        ''' Save a result, forgetting the oldest when the memo is full.'''
+        with self.lock:
+            self.memoized[memo_key] = value
+            while len(self.memoized) > self.max_memoized:
+                self.memoized.popitem(last=False)
+
+    def get_buckets(self, timespan, aggregate_interval, db_manager):
+        ''' The (start, stop) of the aggregation intervals of the timespan that can have data.'''
+        first_timestamp = db_manager.first_timestamp
+        last_timestamp = db_manager.last_timestamp
+        buckets = []
+        for bucket in weeutil.weeutil.intervalgen(timespan.start, timespan.stop, aggregate_interval):
+            if first_timestamp is None or bucket.stop <= first_timestamp:
+                continue
+            if last_timestamp is None or bucket.start >= last_timestamp:
+                break
+            buckets.append((bucket.start, bucket.stop))
+        return buckets
+
+    def get_series_aggregates(self, observation, timespan, aggregate_interval, db_manager):
+        ''' Get the buckets and the (value, time, dateTime) of each configured aggregate of an observation in each bucket.'''
+        memo_key = (db_manager.database_name, observation, timespan.start, timespan.stop, aggregate_interval)
+        with self.lock:
+            series = self.memoized.get(memo_key)
+        if series is not None:
+            return series
+
+        buckets = self.get_buckets(timespan, aggregate_interval, db_manager)
+        aggregates = {}
+        if buckets:
+            aggregates = query_series(db_manager, self.observations[observation], buckets)
+        series = (buckets, aggregates)
+
+        self.memoize(memo_key, series)
+        return series
+
+    def get_series(self, obs_type, timespan, db_manager, aggregate_type=None, aggregate_interval=None, **option_dict):
         if obs_type not in self.observation_time_names:
             raise weewx.UnknownType(obs_type)
 
-        if aggregate_type != self.observation_time_names[obs_type]['observation_type']:
+        # Without aggregation, the times are just the archive column.
+        if aggregate_type is None or aggregate_type != self.observation_time_names[obs_type]['observation_type']:
             raise weewx.UnknownAggregation(aggregate_type)
 
+        try:
+            buckets, aggregates = self.get_series_aggregates(self.observation_time_names[obs_type]['observation'],
+                                                             timespan, aggregate_interval, db_manager)
+        except weedb.NoColumnError:
+            raise weewx.UnknownType(obs_type) from weedb.NoColumnError
+
+        start_vec = []
+        stop_vec = []
+        data_vec = []
+        for bucket_start, bucket_stop in buckets:
+            start_vec.append(bucket_start)
+            stop_vec.append(bucket_stop)
+            aggregate = aggregates[bucket_start][aggregate_type]
+            data_vec.append(aggregate[1] if aggregate is not None else None)
+
+        unit_type, group = weewx.units.getStandardUnitType(db_manager.std_unit_system, obs_type, aggregate_type)
+        return (weewx.units.ValueTuple(start_vec, 'unix_epoch', 'group_time'),
+                weewx.units.ValueTuple(stop_vec, 'unix_epoch', 'group_time'),
+                weewx.units.ValueTuple(data_vec, unit_type, group))
+
+    def get_statistics(self, observation, timespan, db_manager):
+        ''' Get the {aggregate type: value} of the configured statistics of an observation's archive values.'''
+        memo_key = (db_manager.database_name, observation, timespan.start, timespan.stop, 'statistics')
+        with self.lock:
+            statistics = self.memoized.get(memo_key)
+        if statistics is not None:
+            return statistics
+
         interpolation_dict = {
+            'observation': observation,
+            'table_name': db_manager.table_name,
             'start': timespan.start,
             'stop': timespan.stop,
-            'table_name': db_manager.table_name,
-            'input': obs_type,
-            'primary_observation': self.observation_time_names[obs_type]['observation_name']
         }
+        where = "WHERE dateTime > {start} AND dateTime <= {stop} AND {observation} IS NOT NULL".format(**interpolation_dict)
+        count, sum_squares = db_manager.getSql(
+            "SELECT COUNT(*), SUM(({observation} - mean) * ({observation} - mean)) FROM {table_name}, "
+            "(SELECT AVG({observation}) AS mean FROM {table_name} {where}) AS mean_row {where};"
+            .format(where=where, **interpolation_dict))
 
-        sql_stmt = self.sql_stmts[aggregate_type].format(**interpolation_dict)
+        statistics = {}
+        quantiles = [aggregate_type for aggregate_type in self.statistics[observation] if aggregate_type in PERCENTILES]
+        if count and quantiles:
+            positions = {aggregate_type: PERCENTILES[aggregate_type] * (count - 1) for aggregate_type in quantiles}
+            ranks = set()
+            for position in positions.values():
+                ranks.add(int(position))
+                ranks.add(min(int(position) + 1, count - 1))
+
+            # Each rank is a single row subquery, so that the LIMIT applies to it alone.
+            sql_stmt = ' UNION ALL '.join(
+                "SELECT {rank}, rank{rank}.* FROM (SELECT {observation} FROM {table_name} {where} "
+                "ORDER BY {observation} LIMIT 1 OFFSET {rank}) AS rank{rank}".format(rank=rank, where=where, **interpolation_dict)
+                for rank in sorted(ranks))
+            rank_values = dict(db_manager.genSql(sql_stmt + ';'))
+            for aggregate_type, position in positions.items():
+                lower = rank_values[int(position)]
+                upper = rank_values[min(int(position) + 1, count - 1)]
+                statistics[aggregate_type] = lower + (position - int(position)) * (upper - lower)
+
+        if 'stddev' in self.statistics[observation] and count > 1:
+            statistics['stddev'] = math.sqrt(sum_squares / (count - 1))
+
+        self.memoize(memo_key, statistics)
+        return statistics
+
+    def get_aggregate(self, obs_type, timespan, aggregate_type, db_manager, **option_dict):
+        if obs_type in self.statistics and aggregate_type in self.statistics[obs_type]:
+            if timespan.length > self.statistics_max_span:
+                raise weewx.UnknownAggregation(aggregate_type)
+            try:
+                statistics = self.get_statistics(obs_type, timespan, db_manager)
+            except weedb.NoColumnError:
+                raise weewx.UnknownType(obs_type) from weedb.NoColumnError
+
+            unit_type, group = weewx.units.getStandardUnitType(db_manager.std_unit_system, obs_type, aggregate_type)
+            return weewx.units.ValueTuple(statistics.get(aggregate_type), unit_type, group)
+
+        if obs_type not in self.observation_time_names:
+            raise weewx.UnknownType(obs_type)
+
+        if aggregate_type != self.observation_time_names[obs_type]['observation_type']:
+            raise weewx.UnknownAggregation(aggregate_type)
 
         try:
-            row = db_manager.getSql(sql_stmt)
+            aggregates = self.get_aggregates(self.observation_time_names[obs_type]['observation'], timespan, db_manager)
         except weedb.NoColumnError:
             raise weewx.UnknownType(obs_type) from weedb.NoColumnError
 
-        if not row or None in row:
-            aggregate_value = None
-        else:
-            aggregate_value = row[0]
+        aggregate_value = None
+        if aggregates[aggregate_type] is not None:
+            aggregate_value = aggregates[aggregate_type][1]
 
         unit_type, group = weewx.units.getStandardUnitType(db_manager.std_unit_system, obs_type, aggregate_type)
         return weewx.units.ValueTuple(aggregate_value, unit_type, group)
+
+def main():
+    ''' Build the day summary table from the archive.'''
+    parser = argparse.ArgumentParser(description="Build the ObservationTime day summary table from the archive.")
+    parser.add_argument("config_file", help="The WeeWX configuration file.")
+    parser.add_argument("--binding", default='wx_binding', help="The data binding. Default is wx_binding.")
+    parser.add_argument("--batch-days", type=int, default=30,
+                        help="The number of days written in each transaction. Default is 30.")
+    options = parser.parse_args()
+
+    config_dict = configobj.ConfigObj(options.config_file, file_error=True)
+    weeutil.logger.setup('observationtime', config_dict)
+
+    observations = config_dict.get('ObservationTime', {}).get('observations', {})
+    with weewx.manager.open_manager_with_config(config_dict, options.binding) as db_manager:
+        day_summaries = DaySummaries(db_manager, observations)
+        days = day_summaries.backfill(options.batch_days)
+    print("Backfilled %s days." % days)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+#
+#    Copyright (c) 2020-2021 Rich Bell <bellrichm@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+"""
+Announce the rows committed by the ExternalQueue service, and wait for the announcements,
+on a Unix domain socket or a named pipe.
+
+Installation:
+    Put this file in the bin/user directory, with externalqueue.py.
+"""
+
+import errno
+import logging
+import os
+import select
+import socket
+import stat
+import time
+
+log = logging.getLogger(__name__)
+
+# How often, in seconds, Notifications.wait tries to connect when the service is not running.
+RECONNECT_INTERVAL = 1
+
+def get_notify_path(config_dict):
+    """ The path of the socket or named pipe of the announcements. A relative path is relative to WEEWX_ROOT. """
+    service_dict = config_dict.get('ExternalQueue', {})
+    return os.path.join(config_dict.get('WEEWX_ROOT', ''), service_dict.get('notify_path', os.path.join('archive', 'ext_queue.notify')))
+
+def format_notification(first_id, last_id):
+    """ The announcement of the committed rows. """
+    return ('%i %i\n' % (first_id, last_id)).encode('ascii')
+
+class SocketNotifier:
+    """ Announce the committed rows to the consumers connected to a Unix domain socket, without ever waiting on them. """
+    def __init__(self, path):
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            # Left by a previous run.
+            os.remove(path)
+        self.path = path
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(16)
+        self.server.setblocking(False)
+        self.clients = []
+
+    def accept(self):
+        """ Accept the consumers that have connected. """
+        while True:
+            try:
+                client, _ = self.server.accept()
+            except OSError as exception:
+                if exception.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            client.setblocking(False)
+            self.clients.append(client)
+
+    def notify(self, first_id, last_id):
+        """ Send the ids to each consumer. A consumer that cannot take it all now is disconnected. """
+        self.accept()
+        message = format_notification(first_id, last_id)
+        for client in list(self.clients):
+            try:
+                sent = client.send(message)
+            except OSError:
+                sent = 0
+            if sent != len(message):
+                log.debug("Disconnecting a consumer that is not keeping up, or has gone")
+                self.clients.remove(client)
+                client.close()
+
+    def close(self):
+        """ Disconnect the consumers and remove the socket. """
+        for client in self.clients:
+            client.close()
+        self.clients = []
+        self.server.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class FifoNotifier:
+    """ Announce the committed rows on a named pipe, without ever waiting on its consumer. """
+    def __init__(self, path):
+        if not os.path.exists(path):
+            os.mkfifo(path)
+        self.path = path
+        self.file_descriptor = None
+
+    def notify(self, first_id, last_id):
+        """ Write the ids, if there is a consumer and room in the pipe. """
+        if self.file_descriptor is None:
+            try:
+                self.file_descriptor = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as exception:
+                if exception.errno == errno.ENXIO:
+                    # No consumer.
+                    return
+                raise
+
+        try:
+            # Less than PIPE_BUF bytes, so it is written whole or not at all.
+            os.write(self.file_descriptor, format_notification(first_id, last_id))
+        except OSError as exception:
+            if exception.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                # The consumer is behind, it will read from its cursor.
+                return
+            # The consumer has gone, open the pipe again for the next one.
+            os.close(self.file_descriptor)
+            self.file_descriptor = None
+
+    def close(self):
+        """ Close the pipe. """
+        if self.file_descriptor is not None:
+            os.close(self.file_descriptor)
+            self.file_descriptor = None
+
+class Notifications:
+    """ Wait for the announcements of the ExternalQueue service, on its socket or named pipe. """
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+        self.file_descriptor = None
+        self.buffer = b''
+        self.open()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etyp, einst, etb):
+        self.close()
+
+    def open(self):
+        """ Connect to the socket, or open the named pipe. Returns whether it is open. """
+        try:
+            if stat.S_ISFIFO(os.stat(self.path).st_mode):
+                # Opened for writing too, so that the pipe is never at end of file when the service restarts.
+                self.file_descriptor = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+            else:
+                self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.connection.connect(self.path)
+                self.file_descriptor = self.connection.fileno()
+        except OSError:
+            self.close()
+            return False
+        return True
+
+    def close(self):
+        """ Disconnect, or close the named pipe. """
+        if self.connection is not None:
+            self.connection.close()
+        elif self.file_descriptor is not None:
+            os.close(self.file_descriptor)
+        self.connection = None
+        self.file_descriptor = None
+        self.buffer = b''
+
+    def fileno(self):
+        """ The file descriptor to select on. None when not connected. """
+        return self.file_descriptor
+
+    def wait(self, timeout=None):
+        """ Wait up to timeout seconds, or with no timeout until there are, for rows to be committed.
+            When the service is not running, it connects once the service starts.
+            Returns the first and last id of the rows announced, None if there were none. """
+        deadline = None if timeout is None else time.time() + timeout
+        while self.file_descriptor is None and not self.open():
+            # The service is not running, try again every RECONNECT_INTERVAL seconds until it is, or the timeout.
+            remaining = RECONNECT_INTERVAL if deadline is None else min(deadline - time.time(), RECONNECT_INTERVAL)
+            if remaining <= 0:
+                return None
+            time.sleep(remaining)
+
+        while b'\n' not in self.buffer:
+            remaining = None if deadline is None else max(deadline - time.time(), 0)
+            readable, _, _ = select.select([self.file_descriptor], [], [], remaining)
+            if not readable:
+                return None
+            try:
+                data = os.read(self.file_descriptor, 4096)
+            except OSError as exception:
+                if exception.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    continue
+                raise
+            if not data:
+                # The service has stopped, connect again on the next wait.
+                self.close()
+                return None
+            self.buffer += data
+
+        lines, self.buffer = self.buffer.rsplit(b'\n', 1)
+        ids = [[int(row_id) for row_id in line.split()] for line in lines.split(b'\n')]
+        return min(row_ids[0] for row_ids in ids), max(row_ids[1] for row_ids in ids)
@@ -0,0 +1,189 @@
+#
+#    Copyright (c) 2020-2021 Rich Bell <bellrichm@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+"""
+The rows read from the ExternalQueue, and the packed and delta encodings of their records.
+
+Installation:
+    Put this file in the bin/user directory, with externalqueue.py.
+"""
+
+import collections
+import json
+import struct
+import zlib
+
+QueueRow = collections.namedtuple('QueueRow', ['id', 'dateTime', 'dataType', 'record'])
+
+PACKED_COMPRESSED = 0x01
+PACKED_FLAGS = struct.Struct('<B')
+PACKED_COUNT = struct.Struct('<H')
+# The struct format of each type code.
+# n is None, and has no value. s is a string, and j anything else as json, both are a length followed by the utf-8 bytes.
+PACKED_FORMATS = {'d': 'd', 'q': 'q', '?': '?', 'n': '', 's': 'I', 'j': 'I'}
+PACKED_INT_MIN = -2**63
+PACKED_INT_MAX = 2**63 - 1
+packed_structs = {} # confirm to standards pylint: disable=invalid-name
+
+def get_packed_struct(type_codes):
+    """ The struct of the field ids and values of a record with these type codes. """
+    packed_struct = packed_structs.get(type_codes)
+    if packed_struct is None:
+        if len(packed_structs) > 1000:
+            packed_structs.clear()
+        packed_struct = struct.Struct('<' + 'H' * len(type_codes) + ''.join([PACKED_FORMATS[code] for code in type_codes]))
+        packed_structs[type_codes] = packed_struct
+    return packed_struct
+
+def encode_packed(record, field_ids, compress=False):
+    """ Encode a record, field_ids maps each field name to its id.
+        The encoding is the flags, the number of fields, a type code per field,
+        the field ids and values, and the strings. All but the flags are compressed when compress is set. """
+    ids = []
+    type_codes = []
+    values = []
+    strings = []
+    for name, value in record.items():
+        ids.append(field_ids[name])
+        if value is None:
+            type_codes.append('n')
+            continue
+        if isinstance(value, bool):
+            type_codes.append('?')
+        elif isinstance(value, int) and PACKED_INT_MIN <= value <= PACKED_INT_MAX:
+            type_codes.append('q')
+        elif isinstance(value, float):
+            type_codes.append('d')
+        else:
+            if isinstance(value, str):
+                type_codes.append('s')
+            else:
+                type_codes.append('j')
+                value = json.dumps(value)
+            value = value.encode('utf-8')
+            strings.append(value)
+            value = len(value)
+        values.append(value)
+
+    type_codes = ''.join(type_codes)
+    body = PACKED_COUNT.pack(len(ids)) + type_codes.encode('ascii') + get_packed_struct(type_codes).pack(*(ids + values)) \
+        + b''.join(strings)
+    if compress:
+        return PACKED_FLAGS.pack(PACKED_COMPRESSED) + zlib.compress(body)
+    return PACKED_FLAGS.pack(0) + body
+
+def decode_packed(data, field_names):
+    """ Decode a record encoded by encode_packed, field_names maps each field id to its name. """
+    flags, = PACKED_FLAGS.unpack_from(data, 0)
+    body = data[PACKED_FLAGS.size:]
+    if flags & PACKED_COMPRESSED:
+        body = zlib.decompress(body)
+
+    count, = PACKED_COUNT.unpack_from(body, 0)
+    offset = PACKED_COUNT.size
+    type_codes = body[offset:offset + count].decode('ascii')
+    offset += count
+    packed_struct = get_packed_struct(type_codes)
+    unpacked = packed_struct.unpack_from(body, offset)
+    offset += packed_struct.size
+
+    record = {}
+    values = iter(unpacked[count:])
+    for field_id, type_code in zip(unpacked[:count], type_codes):
+        if type_code == 'n':
+            value = None
+        else:
+            value = next(values)
+            if type_code in 'sj':
+                string = body[offset:offset + value].decode('utf-8')
+                offset += value
+                value = string if type_code == 's' else json.loads(string)
+        record[field_names[field_id]] = value
+    return record
+
+class FieldDictionary:
+    """ The ids of the field names of the packed records, kept in the {table}_fields table. """
+    def __init__(self, dbm):
+        self.table_name = '%s_fields' % dbm.table_name
+        dbm.connection.execute("CREATE TABLE IF NOT EXISTS %s (id INTEGER NOT NULL PRIMARY KEY, name STRING NOT NULL UNIQUE);"
+                               % self.table_name)
+        self.ids = {}
+        self.names = {}
+        self.load(dbm)
+
+    def load(self, dbm):
+        """ Read the field names. """
+        self.ids = {}
+        self.names = {}
+        for field_id, name in dbm.genSql("SELECT id, name FROM %s;" % self.table_name):
+            self.ids[name] = field_id
+            self.names[field_id] = name
+
+    def add(self, cursor, record):
+        """ Add the new field names of a record, in the caller's transaction. """
+        for name in record:
+            if name not in self.ids:
+                cursor.execute("INSERT INTO %s (name) VALUES (?);" % self.table_name, (name,))
+                cursor.execute("SELECT id FROM %s WHERE name = ?;" % self.table_name, (name,))
+                field_id = cursor.fetchone()[0]
+                self.ids[name] = field_id
+                self.names[field_id] = name
+
+    def decode(self, dbm, data):
+        """ Decode a packed record, reading the field names again if one was added since they were read. """
+        try:
+            return decode_packed(data, self.names)
+        except KeyError:
+            self.load(dbm)
+            return decode_packed(data, self.names)
+
+DELTA_DATA_TYPE = 'loop_delta'
+# The fields of the previous packet that are not in the packet.
+DELTA_REMOVED = '_removed'
+
+def delta_record(previous, record):
+    """ The fields of the record that are not in, or differ from, the previous record. """
+    delta = {}
+    for name, value in record.items():
+        if name not in previous or previous[name] != value:
+            delta[name] = value
+    delta['dateTime'] = record['dateTime']
+    removed = [name for name in previous if name not in record]
+    if removed:
+        delta[DELTA_REMOVED] = removed
+    return delta
+
+def apply_delta(previous, delta):
+    """ The record that delta_record was given. """
+    record = dict(previous)
+    for name in delta.get(DELTA_REMOVED, []):
+        del record[name]
+    record.update(delta)
+    record.pop(DELTA_REMOVED, None)
+    return record
+
+class PacketBuilder:
+    """ Rebuild the full loop packets from the keyframes and the deltas. """
+    def __init__(self):
+        self.packet = None
+
+    def build(self, row):
+        """ The row with the full packet. None for a delta without its keyframe. """
+        if row.dataType == 'loop':
+            self.packet = row.record
+        elif row.dataType == DELTA_DATA_TYPE:
+            if self.packet is None:
+                return None
+            self.packet = apply_delta(self.packet, row.record)
+            return row._replace(dataType='loop', record=self.packet)
+        return row
+
+def reconstruct(rows):
+    """ Rebuild the full loop packets of an iterable of rows, in id order. The deltas before the first keyframe are skipped. """
+    builder = PacketBuilder()
+    for row in rows:
+        row = builder.build(row)
+        if row is not None:
+            yield row
@@ -0,0 +1,304 @@
+#
+#    Copyright (c) 2020-2021 Rich Bell <bellrichm@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+"""
+The segment log backend of the ExternalQueue service, an append only log of records in segment files.
+
+Installation:
+    Put this file in the bin/user directory, with externalqueue.py.
+"""
+
+import bisect
+import itertools
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+
+from user.queuerecord import QueueRow
+
+log = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = '.log'
+INDEX_SUFFIX = '.index'
+SEGMENT_DATA_TYPES = ['loop', 'archive']
+SEGMENT_TYPE_CODES = {data_type: type_code for type_code, data_type in enumerate(SEGMENT_DATA_TYPES)}
+# A record is the length of the data, the id, dateTime and data type code, followed by the data.
+SEGMENT_RECORD = struct.Struct('<IQqB')
+# An index entry is the id, dateTime, and offset of a record.
+SEGMENT_INDEX = struct.Struct('<QqQ')
+
+def get_segment_directory(config_dict):
+    """ The directory of the segment log. A relative path is relative to WEEWX_ROOT. """
+    service_dict = config_dict.get('ExternalQueue', {})
+    return os.path.join(config_dict.get('WEEWX_ROOT', ''), service_dict.get('segment_directory', os.path.join('archive', 'ext_queue')))
+
+def get_segment_path(directory, first_id):
+    """ The segment file, named by the id of its first record. """
+    return os.path.join(directory, '%020i%s' % (first_id, SEGMENT_SUFFIX))
+
+def get_index_path(segment_path):
+    """ The index file of a segment. """
+    return segment_path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+
+def list_segments(directory):
+    """ The ids of the first record of the segments, oldest first. """
+    return sorted([int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX)])
+
+def read_segment_index(index_path):
+    """ The index entries of a segment. """
+    try:
+        with open(index_path, 'rb') as file_ptr:
+            data = file_ptr.read()
+    except OSError:
+        return []
+    return [SEGMENT_INDEX.unpack_from(data, offset)
+            for offset in range(0, len(data) - SEGMENT_INDEX.size + 1, SEGMENT_INDEX.size)]
+
+def scan_segment(buffer, offset, end):
+    """ Yield the id, dateTime, data type code, and the start and end of the data, of the complete records from offset to end. """
+    header_size = SEGMENT_RECORD.size
+    while offset + header_size <= end:
+        length, row_id, date_time, type_code = SEGMENT_RECORD.unpack_from(buffer, offset)
+        start = offset + header_size
+        if start + length > end:
+            return
+        yield row_id, date_time, type_code, start, start + length
+        offset = start + length
+
+class SegmentLog:
+    """ An append only log of records, in segment files that roll at segment_size bytes.
+        Each segment has a sparse index, an entry every index_interval bytes, starting with its first record. """
+    def __init__(self, directory, segment_size=16777216, index_interval=65536):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.index_interval = index_interval
+        self.segment_file = None
+        self.index_file = None
+        self.offset = 0
+        self.index_offset = None
+
+        segments = list_segments(directory)
+        if segments:
+            self.recover(segments[-1])
+        else:
+            self.next_id = 1
+            self.open_segment(1)
+
+    def open_segment(self, first_id):
+        """ Open a segment to append to. """
+        segment_path = get_segment_path(self.directory, first_id)
+        self.segment_file = open(segment_path, 'ab') # pylint: disable=consider-using-with
+        self.index_file = open(get_index_path(segment_path), 'ab') # pylint: disable=consider-using-with
+        self.offset = self.segment_file.tell()
+
+    def recover(self, first_id):
+        """ Continue the last segment, after its last complete record. """
+        segment_path = get_segment_path(self.directory, first_id)
+        with open(segment_path, 'rb') as file_ptr:
+            data = file_ptr.read()
+        index = [entry for entry in read_segment_index(get_index_path(segment_path)) if entry[2] < len(data)]
+
+        start = index[-1][2] if index else 0
+        self.next_id = index[-1][0] if index else first_id
+        end = start
+        for row_id, _, _, _, record_end in scan_segment(data, start, len(data)):
+            self.next_id = row_id + 1
+            end = record_end
+        if end < len(data):
+            log.info("Truncating %i bytes of an incomplete record from %s", len(data) - end, segment_path)
+
+        with open(segment_path, 'r+b') as file_ptr:
+            file_ptr.truncate(end)
+        with open(get_index_path(segment_path), 'wb') as file_ptr:
+            for entry in index:
+                if entry[2] < end:
+                    file_ptr.write(SEGMENT_INDEX.pack(*entry))
+                    self.index_offset = entry[2]
+        self.open_segment(first_id)
+
+    def roll(self):
+        """ Close the segment and start a new one. """
+        self.close()
+        self.index_offset = None
+        self.open_segment(self.next_id)
+
+    def append(self, rows):
+        """ Append a batch of (data type, dateTime, data) rows and flush them. """
+        for data_type, date_time, data in rows:
+            size = SEGMENT_RECORD.size + len(data)
+            if self.offset and self.offset + size > self.segment_size:
+                self.roll()
+            if self.index_offset is None or self.offset - self.index_offset >= self.index_interval:
+                self.index_file.write(SEGMENT_INDEX.pack(self.next_id, date_time, self.offset))
+                self.index_offset = self.offset
+            self.segment_file.write(SEGMENT_RECORD.pack(len(data), self.next_id, date_time, SEGMENT_TYPE_CODES[data_type]))
+            self.segment_file.write(data)
+            self.offset += size
+            self.next_id += 1
+        # The records before the index, so that an index entry is never ahead of its record.
+        self.segment_file.flush()
+        self.index_file.flush()
+
+    def prune(self, max_rows=0, max_age=0, max_bytes=0):
+        """ Delete the oldest closed segments that are past the limits. Returns the number of records deleted. """
+        segments = list_segments(self.directory)
+        sizes = {}
+        for first_id in segments:
+            segment_path = get_segment_path(self.directory, first_id)
+            sizes[first_id] = os.path.getsize(segment_path) + os.path.getsize(get_index_path(segment_path))
+        total_size = sum(sizes.values())
+
+        deleted = 0
+        while len(segments) > 1:
+            first_id, next_first_id = segments[0], segments[1]
+            prune = False
+            if max_rows and self.next_id - next_first_id >= max_rows:
+                prune = True
+            if max_bytes and total_size > max_bytes:
+                prune = True
+            if max_age:
+                # The first record of a segment is always indexed.
+                index = read_segment_index(get_index_path(get_segment_path(self.directory, next_first_id)))
+                if index and index[0][1] <= time.time() - max_age:
+                    prune = True
+            if not prune:
+                break
+
+            segment_path = get_segment_path(self.directory, first_id)
+            os.remove(segment_path)
+            os.remove(get_index_path(segment_path))
+            deleted += next_first_id - first_id
+            total_size -= sizes[first_id]
+            segments.pop(0)
+
+        return deleted
+
+    def close(self):
+        """ Close the segment. """
+        self.segment_file.close()
+        self.index_file.close()
+
+class SegmentLogReader:
+    """ Read a segment log, by a cursor on the record id, like QueueReader.
+        The closed segments are memory mapped once, the segment being written is mapped on each read, as it grows. """
+    def __init__(self, directory, name='default', data_type=None, delete_acked=False):
+        if delete_acked:
+            raise ValueError("delete_acked is not supported by the segment log, use max_rows, max_age, or max_bytes")
+        self.directory = directory
+        self.name = name
+        self.data_type = data_type
+        # The buffer, size, index, and index ids of the closed segments.
+        self.segments = {}
+
+        self.consumer_file = os.path.join(directory, '%s.consumer' % name)
+        try:
+            with open(self.consumer_file, 'r', encoding='utf-8') as file_ptr:
+                self.acked = json.load(file_ptr)['acked']
+        except (OSError, ValueError, KeyError):
+            self.acked = 0
+        self.position = self.acked
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etyp, einst, etb):
+        self.close()
+
+    def close(self):
+        """ Unmap the segments. """
+        for buffer, _, _, _ in self.segments.values():
+            buffer.close()
+        self.segments = {}
+
+    def get_segment(self, first_id, closed):
+        """ The buffer, size, index, and index ids of a segment. """
+        if first_id in self.segments:
+            return self.segments[first_id]
+
+        segment_path = get_segment_path(self.directory, first_id)
+        with open(segment_path, 'rb') as file_ptr:
+            size = os.fstat(file_ptr.fileno()).st_size
+            buffer = mmap.mmap(file_ptr.fileno(), size, access=mmap.ACCESS_READ) if size else b''
+        index = [entry for entry in read_segment_index(get_index_path(segment_path)) if entry[2] < size]
+        segment = (buffer, size, index, [entry[0] for entry in index])
+        if closed and size:
+            self.segments[first_id] = segment
+        return segment
+
+    def records(self, after):
+        """ Yield the rows after the id after, oldest first. """
+        first_ids = list_segments(self.directory)
+        for first_id in list(self.segments):
+            if first_id not in first_ids:
+                self.segments.pop(first_id)[0].close()
+
+        for i in range(max(bisect.bisect_right(first_ids, after + 1) - 1, 0), len(first_ids)):
+            buffer, size, index, index_ids = self.get_segment(first_ids[i], i < len(first_ids) - 1)
+            entry = bisect.bisect_right(index_ids, after + 1) - 1
+            offset = index[entry][2] if entry >= 0 else 0
+            for row_id, date_time, type_code, start, end in scan_segment(buffer, offset, size):
+                if row_id <= after:
+                    continue
+                data_type = SEGMENT_DATA_TYPES[type_code]
+                if self.data_type is not None and data_type != self.data_type:
+                    continue
+                yield QueueRow(row_id, date_time, data_type, json.loads(buffer[start:end].decode('utf-8')))
+
+    def seek(self, date_time):
+        """ The id to read after, with dequeue or stream, to start at the first record at or after date_time. """
+        first_ids = list_segments(self.directory)
+        first_times = []
+        for i, first_id in enumerate(first_ids):
+            index = self.get_segment(first_id, i < len(first_ids) - 1)[2]
+            first_times.append(index[0][1] if index else date_time)
+
+        after = 0
+        segment = bisect.bisect_left(first_times, date_time) - 1
+        if segment >= 0:
+            index = self.get_segment(first_ids[segment], segment < len(first_ids) - 1)[2]
+            entry = max(bisect.bisect_left([entry[1] for entry in index], date_time) - 1, 0)
+            after = index[entry][0] - 1
+
+        for row in self.records(after):
+            if row.dateTime >= date_time:
+                return row.id - 1
+            after = row.id
+        return after
+
+    def dequeue(self, count=100):
+        """ Get up to count rows after the cursor, oldest first, and move the cursor past them. """
+        rows = list(itertools.islice(self.records(self.position), count))
+        if rows:
+            self.position = rows[-1].id
+        return rows
+
+    def stream(self, after=0, stop=None):
+        """ Yield the rows after the id after, up to and including the id stop. The cursor is not moved. """
+        for row in self.records(after):
+            if stop is not None and row.id > stop:
+                return
+            yield row
+
+    def ack(self, row_id=None):
+        """ Acknowledge the rows up to and including row_id. The default is all of the dequeued rows. """
+        if row_id is None:
+            row_id = self.position
+        if row_id <= self.acked:
+            return
+
+        temp_file = self.consumer_file + '.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as file_ptr:
+            json.dump({'acked': row_id}, file_ptr)
+        os.rename(temp_file, self.consumer_file)
+        self.acked = row_id
+
+    def rewind(self):
+        """ Move the cursor back to the last acknowledged row, the unacknowledged rows are dequeued again. """
+        self.position = self.acked
@@ -0,0 +1,79 @@
+#
+#    Copyright (c) 2024 Rich Bell <bellrichm@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+
+'''
+Save the state of a WeeWX service to a JSON file, so that it survives a restart of WeeWX.
+Used by the FieldCache and Lightning services.
+
+Installation:
+    Put this file in the bin/user directory, with the services that use it.
+'''
+
+import json
+import logging
+import os
+import threading
+
+log = logging.getLogger(__name__)
+
+def read_state(state_file):
+    ''' Read a saved state, an empty state is returned if the file does not exist or cannot be read.'''
+    try:
+        with open(state_file, 'r', encoding='utf-8') as file_ptr:
+            return json.load(file_ptr)
+    except (IOError, OSError, ValueError) as exception:
+        log.info("Unable to read state file %s: %s", state_file, exception)
+        return {}
+
+def write_state(state_file, state):
+    ''' Write a state. It is written and synced to a temporary file that then replaces the state file,
+    so after a crash the state file is either the previous state or this one.'''
+    temp_file = state_file + '.tmp'
+    with open(temp_file, 'w', encoding='utf-8') as file_ptr:
+        json.dump(state, file_ptr, separators=(',', ':'))
+        file_ptr.flush()
+        os.fsync(file_ptr.fileno())
+    os.rename(temp_file, state_file)
+
+class StateThread(threading.Thread):
+    ''' Write the states off of the engine thread, checking for a new state every interval seconds.
+    Only the most recent state is written. Saving a state only replaces the state to write,
+    so the engine thread never waits on, or wakes, this thread.
+    When prepare is given, it turns a saved state into the state to write, on this thread.'''
+    def __init__(self, state_file, name='StateFile', prepare=None, interval=1):
+        super(StateThread, self).__init__(name=name)
+        self.daemon = True
+        self.state_file = state_file
+        self.prepare = prepare
+        self.interval = interval
+        self.state = None
+        self.stopping = threading.Event()
+
+    def save(self, state):
+        ''' Set the state to write, replacing any state that has not been written yet.'''
+        self.state = state
+
+    def stop(self):
+        ''' Write any unwritten state and stop the thread.'''
+        self.stopping.set()
+        self.join(10)
+
+    def run(self):
+        written = None
+        while True:
+            stop = self.stopping.wait(self.interval)
+            state = self.state
+            if state is not None and state is not written:
+                written = state
+                try:
+                    if self.prepare is not None:
+                        state = self.prepare(state)
+                    write_state(self.state_file, state)
+                except (IOError, OSError) as exception:
+                    log.error("Unable to write state file %s: %s", self.state_file, exception)
+
+            if stop:
+                return
@@ -12,9 +12,11 @@ import string
 import time
 
 import unittest
+import weewx
+import weewx.units
 
 #import test_weewx_stubs # used to set up stubs - pylint: disable=unused-import
-from user.fieldcache import Cache
+from user.fieldcache import Cache, History, snapshot_state
 
 class Test_clear_cache(unittest.TestCase):
     def test_cache_is_cleared(self):
@@ -51,10 +53,25 @@ class Test_update_value(unittest.TestCase):
         value = round(random.uniform(1, 100), 2)
         timestamp = time.time()
 
-        unit_system_mismatch = random.randint(11, 20)
+        unit_system_mismatch = random.choice([unit for unit in range(11, 20) if unit not in weewx.units.std_groups])
         self.assertRaises(ValueError,
                           SUT.update_value, key, value, unit_system_mismatch, timestamp)
 
+    def test_value_is_converted(self):
+        SUT = Cache(weewx.US)
+
+        SUT.update_value('outTemp', 100.0, weewx.METRIC, time.time())
+        self.assertAlmostEqual(SUT.cached_values['outTemp']['value'], 212.0)
+
+    def test_conversion_is_memoized(self):
+        SUT = Cache(weewx.US)
+
+        SUT.update_value('outTemp', 100.0, weewx.METRIC, time.time())
+        converter = SUT.converters[('outTemp', weewx.METRIC, weewx.US)]
+        SUT.update_value('outTemp', 0.0, weewx.METRIC, time.time())
+        self.assertIs(SUT.converters[('outTemp', weewx.METRIC, weewx.US)], converter)
+        self.assertEqual(len(SUT.converters), 1)
+
 class Test_get_value(unittest.TestCase):
     def test_key_not_in_cache(self):
         unit_system = random.randint(1, 10)
@@ -97,6 +114,14 @@ class Test_get_value(unittest.TestCase):
         cached_value = SUT.get_value(key, timestamp + 1, 0)
         self.assertIsNone(cached_value)
 
+    def test_get_data_in_other_unit_system(self):
+        SUT = Cache(weewx.US)
+        timestamp = time.time()
+        SUT.update_value('outTemp', 212.0, weewx.US, timestamp)
+
+        cached_value = SUT.get_value('outTemp', timestamp, None, weewx.METRIC)
+        self.assertAlmostEqual(cached_value, 100.0)
+
 class Test_update_timestamp(unittest.TestCase):
     def test_key_does_not_exist(self):
         # somewhat silly test
@@ -144,5 +169,370 @@ class Test_remove_value(unittest.TestCase):
         SUT.remove_value(key)
         self.assertNotIn(key, SUT.cached_values)
 
+class Test_update_record(unittest.TestCase):
+    def test_values_are_cached(self):
+        unit_system = random.randint(1, 10)
+        key = ''.join([random.choice(string.ascii_letters + string.digits) for n in range(32)])
+        SUT = Cache(unit_system, {key: None})
+        value = round(random.uniform(1, 100), 2)
+        timestamp = time.time()
+
+        SUT.update_record({'usUnits': unit_system, key: value}, timestamp)
+        self.assertEqual(SUT.cached_values[key], {'value': value, 'timestamp': timestamp})
+
+    def test_missing_values_are_filled(self):
+        unit_system = random.randint(1, 10)
+        key = ''.join([random.choice(string.ascii_letters + string.digits) for n in range(32)])
+        SUT = Cache(unit_system, {key: None})
+        value = round(random.uniform(1, 100), 2)
+        timestamp = time.time()
+        SUT.update_value(key, value, unit_system, timestamp)
+
+        record = {'usUnits': unit_system}
+        SUT.update_record(record, timestamp + 1)
+        self.assertEqual(record[key], value)
+
+    def test_expired_values_are_none(self):
+        unit_system = random.randint(1, 10)
+        key = ''.join([random.choice(string.ascii_letters + string.digits) for n in range(32)])
+        SUT = Cache(unit_system, {key: 60})
+        value = round(random.uniform(1, 100), 2)
+        timestamp = time.time()
+        SUT.update_value(key, value, unit_system, timestamp)
+
+        record = {'usUnits': unit_system}
+        SUT.update_record(record, timestamp + 60)
+        self.assertIn(key, record)
+        self.assertIsNone(record[key])
+
+    def test_always_expired_value_is_not_changed(self):
+        unit_system = random.randint(1, 10)
+        key = ''.join([random.choice(string.ascii_letters + string.digits) for n in range(32)])
+        other_key = ''.join([random.choice(string.ascii_letters + string.digits) for n in range(32)])
+        SUT = Cache(unit_system, {key: 0, other_key: None})
+        value = round(random.uniform(1, 100), 2)
+
+        record = {'usUnits': unit_system, key: value}
+        SUT.update_record(record, time.time())
+        self.assertEqual(record[key], value)
+        self.assertIsNone(record[other_key])
+
+        record = {'usUnits': unit_system}
+        SUT.update_record(record, time.time())
+        self.assertIsNone(record[key])
+
+    def test_value_expires_between_records(self):
+        unit_system = random.randint(1, 10)
+        key = ''.join([random.choice(string.ascii_letters + string.digits) for n in range(32)])
+        SUT = Cache(unit_system, {key: 60})
+        value = round(random.uniform(1, 100), 2)
+        timestamp = time.time()
+        SUT.update_record({'usUnits': unit_system, key: value}, timestamp)
+
+        record = {'usUnits': unit_system}
+        SUT.update_record(record, timestamp + 59)
+        self.assertEqual(record[key], value)
+
+        record = {'usUnits': unit_system}
+        SUT.update_record(record, timestamp + 60)
+        self.assertIsNone(record[key])
+
+    def test_record_in_other_unit_system(self):
+        SUT = Cache(weewx.US, {'outTemp': None, 'barometer': None})
+        timestamp = time.time()
+        SUT.update_record({'usUnits': weewx.US, 'outTemp': 212.0}, timestamp)
+
+        record = {'usUnits': weewx.METRIC, 'barometer': 1000.0}
+        SUT.update_record(record, timestamp)
+        self.assertAlmostEqual(record['outTemp'], 100.0)
+        self.assertAlmostEqual(SUT.cached_values['barometer']['value'], 29.53, 2)
+
+    def test_keys_not_cached_are_ignored(self):
+        unit_system = random.randint(1, 10)
+        key = ''.join([random.choice(string.ascii_letters + string.digits) for n in range(32)])
+        SUT = Cache(unit_system, {})
+        value = round(random.uniform(1, 100), 2)
+
+        record = {'usUnits': unit_system, key: value}
+        SUT.update_record(record, time.time())
+        self.assertEqual(SUT.cached_values, {})
+        self.assertEqual(record, {'usUnits': unit_system, key: value})
+
+    def test_mismatch_unit_system(self):
+        unit_system = random.randint(1, 10)
+        key = ''.join([random.choice(string.ascii_letters + string.digits) for n in range(32)])
+        SUT = Cache(unit_system, {key: None})
+        value = round(random.uniform(1, 100), 2)
+
+        unit_system_mismatch = random.choice([unit for unit in range(11, 20) if unit not in weewx.units.std_groups])
+        self.assertRaises(ValueError,
+                          SUT.update_record, {'usUnits': unit_system_mismatch, key: value}, time.time())
+
+class Test_max_entries(unittest.TestCase):
+    def test_least_recently_updated_is_evicted(self):
+        unit_system = random.randint(1, 10)
+        SUT = Cache(unit_system, max_entries=2)
+        timestamp = time.time()
+
+        SUT.update_value('key1', 1, unit_system, timestamp)
+        SUT.update_value('key2', 2, unit_system, timestamp)
+        SUT.update_value('key1', 11, unit_system, timestamp)
+        SUT.update_value('key3', 3, unit_system, timestamp)
+
+        self.assertEqual(sorted(SUT.cached_values), ['key1', 'key3'])
+        self.assertEqual(SUT.evicted, 1)
+
+    def test_read_refreshes_entry(self):
+        unit_system = random.randint(1, 10)
+        SUT = Cache(unit_system, max_entries=2)
+        timestamp = time.time()
+
+        SUT.update_value('key1', 1, unit_system, timestamp)
+        SUT.update_value('key2', 2, unit_system, timestamp)
+        self.assertEqual(SUT.get_value('key1', timestamp, None), 1)
+        SUT.update_value('key3', 3, unit_system, timestamp)
+
+        self.assertEqual(sorted(SUT.cached_values), ['key1', 'key3'])
+
+    def test_fill_refreshes_entry(self):
+        unit_system = random.randint(1, 10)
+        SUT = Cache(unit_system, {'key1': None, 'key2': None, 'key3': None}, max_entries=2)
+        timestamp = time.time()
+
+        SUT.update_record({'usUnits': unit_system, 'key1': 1}, timestamp)
+        SUT.update_record({'usUnits': unit_system, 'key2': 2}, timestamp)
+        # key2 is updated, and then key1 is filled.
+        record = {'usUnits': unit_system, 'key2': 22}
+        SUT.update_record(record, timestamp)
+        self.assertEqual(record['key1'], 1)
+        SUT.update_record({'usUnits': unit_system, 'key3': 3}, timestamp)
+
+        self.assertEqual(sorted(SUT.cached_values), ['key1', 'key3'])
+
+    def test_evicted_slot_is_reused(self):
+        unit_system = random.randint(1, 10)
+        SUT = Cache(unit_system, max_entries=1)
+        timestamp = time.time()
+
+        SUT.update_value('key1', 1, unit_system, timestamp)
+        SUT.update_value('key2', 2, unit_system, timestamp)
+        SUT.update_value('key3', 3, unit_system, timestamp)
+        SUT.update_value('key4', 4, unit_system, timestamp)
+
+        self.assertEqual(len(SUT.keys), 2)
+        self.assertEqual(SUT.cached_values, {'key4': {'value': 4, 'timestamp': timestamp}})
+
+    def test_record_value_is_kept_when_evicted(self):
+        unit_system = random.randint(1, 10)
+        SUT = Cache(unit_system, {'key1': None, 'key2': None}, max_entries=1)
+        timestamp = time.time()
+
+        record = {'usUnits': unit_system, 'key1': 1, 'key2': 2}
+        SUT.update_record(record, timestamp)
+
+        self.assertEqual(record['key1'], 1)
+        self.assertEqual(record['key2'], 2)
+        self.assertEqual(len(SUT.cached_values), 1)
+
+class Test_expire(unittest.TestCase):
+    def test_expired_values_are_removed(self):
+        unit_system = random.randint(1, 10)
+        SUT = Cache(unit_system, {'key1': 60, 'key2': 120})
+        timestamp = time.time()
+        SUT.update_record({'usUnits': unit_system, 'key1': 1, 'key2': 2}, timestamp)
+
+        SUT.expire(timestamp + 60)
+
+        self.assertEqual(list(SUT.cached_values), ['key2'])
+        self.assertEqual(SUT.expired, 1)
+        self.assertEqual(len(SUT.expiry_heap), 1)
+
+    def test_updated_value_is_not_removed(self):
+        unit_system = random.randint(1, 10)
+        SUT = Cache(unit_system, {'key1': 60})
+        timestamp = time.time()
+        SUT.update_record({'usUnits': unit_system, 'key1': 1}, timestamp)
+        SUT.update_record({'usUnits': unit_system, 'key1': 11}, timestamp + 30)
+
+        SUT.expire(timestamp + 60)
+
+        self.assertEqual(SUT.cached_values['key1']['value'], 11)
+        self.assertEqual(SUT.expired, 0)
+        self.assertEqual(len(SUT.expiry_heap), 1)
+
+class Test_stats(unittest.TestCase):
+    def test_hits_and_misses_are_counted(self):
+        unit_system = random.randint(1, 10)
+        SUT = Cache(unit_system, {'key1': None, 'key2': None, 'key3': None})
+        timestamp = time.time()
+        SUT.update_record({'usUnits': unit_system, 'key1': 1}, timestamp)
+        SUT.update_record({'usUnits': unit_system, 'key2': 2}, timestamp)
+
+        stats = SUT.stats()
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 3)
+
+class Test_fill(unittest.TestCase):
+    def test_unknown_fill(self):
+        unit_system = random.randint(1, 10)
+        self.assertRaises(ValueError, Cache, unit_system, {'key1': None}, None, {'key1': 'foo'})
+
+    def test_last_fills_none(self):
+        unit_system = random.randint(1, 10)
+        SUT = Cache(unit_system, {'key1': None}, fills={'key1': 'last'})
+        timestamp = time.time()
+        SUT.update_record({'usUnits': unit_system, 'key1': 1.0}, timestamp)
+        SUT.update_record({'usUnits': unit_system, 'key1': None}, timestamp + 1)
+
+        record = {'usUnits': unit_system}
+        SUT.update_record(record, timestamp + 2)
+        self.assertIsNone(record['key1'])
+
+    def test_hold_until_expiry_ignores_none(self):
+        unit_system = random.randint(1, 10)
+        SUT = Cache(unit_system, {'key1': 60}, fills={'key1': 'hold_until_expiry'})
+        timestamp = time.time()
+        SUT.update_record({'usUnits': unit_system, 'key1': 1.0}, timestamp)
+
+        record = {'usUnits': unit_system, 'key1': None}
+        SUT.update_record(record, timestamp + 1)
+        self.assertEqual(record['key1'], 1.0)
+
+        record = {'usUnits': unit_system, 'key1': None}
+        SUT.update_record(record, timestamp + 60)
+        self.assertIsNone(record['key1'])
+
+    def test_linear_extrapolates(self):
+        unit_system = random.randint(1, 10)
+        SUT = Cache(unit_system, {'key1': None}, fills={'key1': 'linear'})
+        timestamp = time.time()
+        SUT.update_record({'usUnits': unit_system, 'key1': 10.0}, timestamp)
+        SUT.update_record({'usUnits': unit_system, 'key1': 12.0}, timestamp + 60)
+
+        record = {'usUnits': unit_system}
+        SUT.update_record(record, timestamp + 90)
+        self.assertAlmostEqual(record['key1'], 13.0)
+
+    def test_linear_with_one_value(self):
+        unit_system = random.randint(1, 10)
+        SUT = Cache(unit_system, {'key1': None}, fills={'key1': 'linear'})
+        timestamp = time.time()
+        SUT.update_record({'usUnits': unit_system, 'key1': 10.0}, timestamp)
+
+        record = {'usUnits': unit_system}
+        SUT.update_record(record, timestamp + 90)
+        self.assertEqual(record['key1'], 10.0)
+
+    def test_linear_long_gap(self):
+        unit_system = random.randint(1, 10)
+        SUT = Cache(unit_system, {'key1': None}, fills={'key1': 'linear'})
+        timestamp = time.time()
+        SUT.update_record({'usUnits': unit_system, 'key1': 10.0}, timestamp)
+        SUT.update_record({'usUnits': unit_system, 'key1': 12.0}, timestamp + 60)
+
+        record = {'usUnits': unit_system}
+        SUT.update_record(record, timestamp + 3 * 24 * 3600)
+        # Followed for the 60 seconds the values span, then held.
+        self.assertAlmostEqual(record['key1'], 14.0)
+
+class Test_History(unittest.TestCase):
+    def test_oldest_value_is_replaced(self):
+        SUT = History()
+        for i in range(History.size + 2):
+            SUT.add(i * 10, float(i))
+
+        # the oldest remaining value is at time 20, value 2.0
+        self.assertAlmostEqual(SUT.estimate(5 * 10), 5.0)
+        self.assertAlmostEqual(SUT.estimate(3 * 10 + 5), 3.5)
+        self.assertEqual(SUT.count, History.size)
+
+    def test_extrapolation_is_limited(self):
+        SUT = History()
+        for i in range(History.size):
+            SUT.add(i * 10, float(i))
+
+        # the values span 30 seconds, to time 30
+        self.assertAlmostEqual(SUT.estimate(50), 5.0)
+        self.assertAlmostEqual(SUT.estimate(60), 6.0)
+        self.assertAlmostEqual(SUT.estimate(1000), 6.0)
+
+    def test_empty(self):
+        SUT = History()
+        self.assertIsNone(SUT.estimate(time.time()))
+
+class Test_load_snapshot(unittest.TestCase):
+    def test_value_is_loaded(self):
+        unit_system = random.randint(1, 10)
+        SUT = Cache(unit_system)
+        key = ''.join([random.choice(string.ascii_letters + string.digits) for n in range(32)])
+        value = round(random.uniform(1, 100), 2)
+        timestamp = time.time()
+
+        SUT.load_snapshot({'usUnits': unit_system, 'values': {key: [value, timestamp]}}, timestamp + 1, {key: None})
+        self.assertEqual(SUT.cached_values[key]['value'], value)
+        self.assertEqual(SUT.cached_values[key]['timestamp'], timestamp)
+
+    def test_expired_value_is_not_loaded(self):
+        unit_system = random.randint(1, 10)
+        SUT = Cache(unit_system)
+        key = ''.join([random.choice(string.ascii_letters + string.digits) for n in range(32)])
+        value = round(random.uniform(1, 100), 2)
+        timestamp = time.time()
+
+        SUT.load_snapshot({'usUnits': unit_system, 'values': {key: [value, timestamp]}}, timestamp + 60, {key: 60})
+        self.assertNotIn(key, SUT.cached_values)
+
+    def test_field_not_cached_is_not_loaded(self):
+        unit_system = random.randint(1, 10)
+        SUT = Cache(unit_system)
+        key = ''.join([random.choice(string.ascii_letters + string.digits) for n in range(32)])
+        value = round(random.uniform(1, 100), 2)
+        timestamp = time.time()
+
+        SUT.load_snapshot({'usUnits': unit_system, 'values': {key: [value, timestamp]}}, timestamp, {})
+        self.assertNotIn(key, SUT.cached_values)
+
+    def test_value_is_converted(self):
+        SUT = Cache(weewx.METRIC)
+        timestamp = time.time()
+
+        SUT.load_snapshot({'usUnits': weewx.US, 'values': {'outTemp': [212.0, timestamp]}}, timestamp, {'outTemp': None})
+        self.assertAlmostEqual(SUT.cached_values['outTemp']['value'], 100.0)
+
+    def test_snapshot_without_unit_system_is_not_loaded(self):
+        unit_system = random.randint(1, 10)
+        SUT = Cache(unit_system)
+        timestamp = time.time()
+
+        SUT.load_snapshot({'outTemp': [212.0, timestamp]}, timestamp, {'outTemp': None})
+        self.assertEqual(SUT.cached_values, {})
+
+    def test_snapshot_round_trip(self):
+        unit_system = random.randint(1, 10)
+        SUT = Cache(unit_system)
+        key = ''.join([random.choice(string.ascii_letters + string.digits) for n in range(32)])
+        value = round(random.uniform(1, 100), 2)
+        timestamp = time.time()
+        SUT.update_value(key, value, unit_system, timestamp)
+
+        snapshot = snapshot_state(SUT.snapshot())
+        SUT.clear_cache()
+        SUT.load_snapshot(snapshot, timestamp, {key: None})
+        self.assertEqual(SUT.get_value(key, timestamp, None), value)
+
+    def test_snapshot_is_a_copy(self):
+        unit_system = random.randint(1, 10)
+        SUT = Cache(unit_system, max_entries=1)
+        timestamp = time.time()
+        SUT.update_value('key1', 1.0, unit_system, timestamp)
+
+        snapshot = SUT.snapshot()
+        # Evicts key1 and reuses its slot.
+        SUT.update_value('key2', 2.0, unit_system, timestamp)
+
+        self.assertEqual(snapshot_state(snapshot), {'usUnits': unit_system, 'values': {'key1': [1.0, timestamp]}})
+        self.assertEqual(snapshot_state(SUT.snapshot()), {'usUnits': unit_system, 'values': {'key2': [2.0, timestamp]}})
+
 if __name__ == '__main__':
     unittest.main(exit=False)
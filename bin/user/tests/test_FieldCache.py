@@ -9,12 +9,21 @@
 # pylint: disable=too-few-public-methods
 
 import configobj
+import os
 import random
+import shutil
 import string
+import tempfile
+import time
 import mock
 import unittest
 
-from user.fieldcache import FieldCache
+import weewx
+import weewx.manager
+import weewx.xtypes
+from weeutil.weeutil import TimeSpan
+
+from user.fieldcache import FieldCache, FieldCacheXtype
 class NEW_LOOP_PACKET(object):
     """Event issued when a new LOOP packet is available. The event contains
     attribute 'packet', which is the new LOOP packet."""
@@ -53,7 +62,7 @@ class Test_new_archive_record(unittest.TestCase):
             event = Event(NEW_ARCHIVE_RECORD, record=record)
 
             SUT.new_archive_record(event)
-            SUT.cache.get_value.assert_called_once()
+            SUT.cache.update_record.assert_called_once_with(record, mock.ANY)
 
     @staticmethod
     def test_field_exists():
@@ -81,7 +90,306 @@ class Test_new_archive_record(unittest.TestCase):
             event = Event(NEW_ARCHIVE_RECORD, record=record)
 
             SUT.new_archive_record(event)
-            SUT.cache.update_value.assert_called_once()
+            SUT.cache.update_record.assert_called_once_with(record, mock.ANY)
+
+class Test_new_loop_packet(unittest.TestCase):
+    def test_loop_binding(self):
+        mock_StdEngine = mock.Mock()
+        fieldname = ''.join([random.choice(string.ascii_letters + string.digits) for n in range(32)])
+        config_dict = {
+            'FieldCache': {
+                'binding': 'loop',
+                'fields': {
+                    fieldname: {}
+                }
+            }
+        }
+
+        config = configobj.ConfigObj(config_dict)
+
+        SUT = FieldCache(mock_StdEngine, config)
+
+        bound_events = [call[0][0] for call in mock_StdEngine.bind.call_args_list]
+        self.assertIn(weewx.NEW_LOOP_PACKET, bound_events)
+        self.assertNotIn(weewx.NEW_ARCHIVE_RECORD, bound_events)
+
+    def test_missing_field_is_filled(self):
+        mock_StdEngine = mock.Mock()
+        fieldname = ''.join([random.choice(string.ascii_letters + string.digits) for n in range(32)])
+        value = round(random.uniform(1, 100), 2)
+        config_dict = {
+            'FieldCache': {
+                'binding': 'loop',
+                'fields': {
+                    fieldname: {}
+                }
+            }
+        }
+
+        config = configobj.ConfigObj(config_dict)
+
+        SUT = FieldCache(mock_StdEngine, config)
+
+        SUT.new_loop_packet(Event(NEW_LOOP_PACKET, packet={'usUnits': 1, fieldname: value}))
+        packet = {'usUnits': 1}
+        SUT.new_loop_packet(Event(NEW_LOOP_PACKET, packet=packet))
+
+        self.assertEqual(packet[fieldname], value)
+        self.assertEqual(SUT.loop_stats.count, 2)
+
+    def test_linear_uses_packet_time(self):
+        mock_StdEngine = mock.Mock()
+        fieldname = ''.join([random.choice(string.ascii_letters + string.digits) for n in range(32)])
+        config_dict = {
+            'FieldCache': {
+                'binding': 'loop',
+                'fields': {
+                    fieldname: {'fill': 'linear'}
+                }
+            }
+        }
+
+        config = configobj.ConfigObj(config_dict)
+
+        SUT = FieldCache(mock_StdEngine, config)
+
+        # A burst of packets, processed as they are caught up, a minute apart by their dateTime.
+        start = int(time.time()) - 3600
+        for i in range(4):
+            SUT.new_loop_packet(Event(NEW_LOOP_PACKET, packet={'dateTime': start + i * 60, 'usUnits': 1, fieldname: 20.0 + i / 10}))
+        packet = {'dateTime': start + 240, 'usUnits': 1}
+        SUT.new_loop_packet(Event(NEW_LOOP_PACKET, packet=packet))
+
+        self.assertAlmostEqual(packet[fieldname], 20.4)
+
+class Test_xtype(unittest.TestCase):
+    def test_xtype_is_registered(self):
+        mock_StdEngine = mock.Mock()
+        config_dict = {
+            'FieldCache': {
+                'xtype': True,
+                'fields': {
+                    'field1': {}
+                }
+            }
+        }
+
+        SUT = FieldCache(mock_StdEngine, configobj.ConfigObj(config_dict))
+        self.assertIn(SUT.xtype, weewx.xtypes.xtypes)
+
+        SUT.shutDown()
+        self.assertNotIn(SUT.xtype, weewx.xtypes.xtypes)
+
+    def test_archive_record_is_served(self):
+        mock_StdEngine = mock.Mock()
+        config_dict = {
+            'FieldCache': {
+                'xtype': True,
+                'fields': {
+                    'outTemp': {}
+                }
+            }
+        }
+        SUT = FieldCache(mock_StdEngine, configobj.ConfigObj(config_dict))
+        now = int(time.time())
+        value = random.uniform(0, 100)
+        SUT.new_archive_record(Event(NEW_ARCHIVE_RECORD, record={'dateTime': now - 300, 'usUnits': weewx.US, 'outTemp': value}))
+        SUT.new_archive_record(Event(NEW_ARCHIVE_RECORD, record={'dateTime': now, 'usUnits': weewx.US}))
+        SUT.shutDown()
+
+        self.assertEqual(SUT.xtype.get_scalar('outTemp', {'dateTime': now, 'usUnits': weewx.US})[0], value)
+
+    def test_get_scalar(self):
+        now = int(time.time())
+        SUT = FieldCacheXtype(['outTemp'])
+        SUT.update({'dateTime': now, 'usUnits': weewx.US, 'outTemp': 212.0})
+
+        value_tuple = SUT.get_scalar('outTemp', {'dateTime': now, 'usUnits': weewx.US})
+        self.assertEqual(value_tuple, weewx.units.ValueTuple(212.0, 'degree_F', 'group_temperature'))
+
+    def test_get_scalar_other_record(self):
+        now = int(time.time())
+        SUT = FieldCacheXtype(['outTemp'])
+        SUT.update({'dateTime': now, 'usUnits': weewx.US, 'outTemp': 212.0})
+
+        self.assertRaises(weewx.UnknownType, SUT.get_scalar, 'outTemp', {'dateTime': now - 300, 'usUnits': weewx.US})
+        self.assertRaises(weewx.UnknownType, SUT.get_scalar, 'outTemp', {'dateTime': now + 300, 'usUnits': weewx.US})
+
+    def test_get_scalar_no_value(self):
+        now = int(time.time())
+        SUT = FieldCacheXtype(['outTemp'])
+        self.assertRaises(weewx.UnknownType, SUT.get_scalar, 'outTemp', {'dateTime': now, 'usUnits': weewx.US})
+
+        SUT.update({'dateTime': now, 'usUnits': weewx.US, 'outTemp': None})
+        self.assertRaises(weewx.UnknownType, SUT.get_scalar, 'outTemp', {'dateTime': now, 'usUnits': weewx.US})
+
+    def test_get_aggregate_last(self):
+        now = int(time.time())
+        SUT = FieldCacheXtype(['outTemp'])
+        SUT.update({'dateTime': now, 'usUnits': weewx.US, 'outTemp': 212.0})
+        db_manager = mock.Mock()
+
+        self.assertEqual(SUT.get_aggregate('outTemp', TimeSpan(now - 3600, now), 'last', db_manager)[0], 212.0)
+        db_manager.getSql.assert_not_called()
+
+    def test_get_aggregate_not_in_timespan(self):
+        now = int(time.time())
+        SUT = FieldCacheXtype(['outTemp'])
+        SUT.update({'dateTime': now, 'usUnits': weewx.US, 'outTemp': 212.0})
+        db_manager = mock.Mock()
+
+        self.assertRaises(weewx.UnknownAggregation,
+                          SUT.get_aggregate, 'outTemp', TimeSpan(now - 3600, now - 1), 'last', db_manager)
+        self.assertRaises(weewx.UnknownAggregation,
+                          SUT.get_aggregate, 'outTemp', TimeSpan(now, now + 3600), 'last', db_manager)
+        self.assertRaises(weewx.UnknownAggregation,
+                          SUT.get_aggregate, 'outTemp', TimeSpan(now - 3600, now), 'max', db_manager)
+
+class Test_snapshot(unittest.TestCase):
+    def setUp(self):
+        self.weewx_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.weewx_root)
+
+    def test_cache_survives_restart(self):
+        mock_StdEngine = mock.Mock()
+        fieldname = ''.join([random.choice(string.ascii_letters + string.digits) for n in range(32)])
+        value = round(random.uniform(1, 100), 2)
+        config_dict = {
+            'WEEWX_ROOT': self.weewx_root,
+            'FieldCache': {
+                'snapshot_file': 'fieldcache.json',
+                'fields': {
+                    fieldname: {}
+                }
+            }
+        }
+
+        config = configobj.ConfigObj(config_dict)
+
+        SUT = FieldCache(mock_StdEngine, config)
+        record = {
+            'usUnits': 1,
+            fieldname: value
+        }
+        SUT.new_archive_record(Event(NEW_ARCHIVE_RECORD, record=record))
+        SUT.shutDown()
+
+        self.assertTrue(os.path.exists(os.path.join(self.weewx_root, 'fieldcache.json')))
+
+        SUT = FieldCache(mock_StdEngine, config)
+        record = {
+            'usUnits': 1,
+        }
+        SUT.new_archive_record(Event(NEW_ARCHIVE_RECORD, record=record))
+        SUT.shutDown()
+
+        self.assertEqual(record[fieldname], value)
+
+    def test_expired_values_are_dropped(self):
+        mock_StdEngine = mock.Mock()
+        fieldname = ''.join([random.choice(string.ascii_letters + string.digits) for n in range(32)])
+        value = round(random.uniform(1, 100), 2)
+        config_dict = {
+            'WEEWX_ROOT': self.weewx_root,
+            'FieldCache': {
+                'snapshot_file': 'fieldcache.json',
+                'fields': {
+                    fieldname: {
+                        'expires_after': 60
+                    }
+                }
+            }
+        }
+        with open(os.path.join(self.weewx_root, 'fieldcache.json'), 'w') as file_ptr:
+            file_ptr.write('{"%s": [%s, %s]}' % (fieldname, value, time.time() - 120))
+
+        config = configobj.ConfigObj(config_dict)
+
+        SUT = FieldCache(mock_StdEngine, config)
+        SUT.shutDown()
+
+        self.assertNotIn(fieldname, SUT.cache.cached_values)
+
+class Test_seed_cache(unittest.TestCase):
+    def setUp(self):
+        self.weewx_root = tempfile.mkdtemp()
+        schema = [('dateTime', 'INTEGER NOT NULL UNIQUE PRIMARY KEY'),
+                  ('usUnits', 'INTEGER NOT NULL'),
+                  ('interval', 'INTEGER NOT NULL'),
+                  ('field1', 'REAL'),
+                  ('field2', 'REAL'),
+                  ('field3', 'REAL')]
+        database_dict = {
+            'driver': 'weedb.sqlite',
+            'database_name': 'archive.sdb',
+            'SQLITE_ROOT': self.weewx_root,
+        }
+        self.db_manager = weewx.manager.Manager.open_with_create(database_dict, schema=schema)
+        self.now = int(time.time())
+
+    def tearDown(self):
+        self.db_manager.close()
+        shutil.rmtree(self.weewx_root)
+
+    def add_record(self, date_time, **fields):
+        record = {
+            'dateTime': date_time,
+            'usUnits': weewx.US,
+            'interval': 5,
+        }
+        record.update(fields)
+        self.db_manager.addRecord(record)
+
+    def create_service(self, fields, **options):
+        mock_StdEngine = mock.Mock()
+        mock_StdEngine.db_binder.get_manager.return_value = self.db_manager
+        config_dict = {
+            'FieldCache': {
+                'data_binding': 'wx_binding',
+                'fields': fields
+            }
+        }
+        config_dict['FieldCache'].update(options)
+        return FieldCache(mock_StdEngine, configobj.ConfigObj(config_dict))
+
+    def test_most_recent_values_are_cached(self):
+        self.add_record(self.now - 900, field1=1.0, field2=2.0)
+        self.add_record(self.now - 600, field1=11.0)
+        self.add_record(self.now - 300, field3=33.0)
+
+        SUT = self.create_service({'field1': {}, 'field2': {}, 'field3': {}})
+
+        self.assertEqual(SUT.cache.cached_values['field1'], {'value': 11.0, 'timestamp': self.now - 600})
+        self.assertEqual(SUT.cache.cached_values['field2'], {'value': 2.0, 'timestamp': self.now - 900})
+        self.assertEqual(SUT.cache.cached_values['field3'], {'value': 33.0, 'timestamp': self.now - 300})
+
+    def test_expired_values_are_not_cached(self):
+        self.add_record(self.now - 900, field1=1.0, field2=2.0)
+        self.add_record(self.now - 300, field1=11.0)
+
+        SUT = self.create_service({'field1': {'expires_after': 600}, 'field2': {'expires_after': 600}})
+
+        self.assertEqual(SUT.cache.cached_values['field1'], {'value': 11.0, 'timestamp': self.now - 300})
+        self.assertNotIn('field2', SUT.cache.cached_values)
+
+    def test_values_before_window_are_not_cached(self):
+        self.add_record(self.now - 7200, field1=1.0, field2=2.0)
+        self.add_record(self.now - 300, field1=11.0)
+
+        SUT = self.create_service({'field1': {}, 'field2': {}}, seed_window=3600)
+
+        self.assertEqual(SUT.cache.cached_values['field1'], {'value': 11.0, 'timestamp': self.now - 300})
+        self.assertNotIn('field2', SUT.cache.cached_values)
+
+    def test_unknown_field_is_not_cached(self):
+        self.add_record(self.now - 300, field1=1.0)
+
+        SUT = self.create_service({'field1': {}, 'field4': {}})
+
+        self.assertEqual(SUT.cache.cached_values['field1'], {'value': 1.0, 'timestamp': self.now - 300})
+        self.assertNotIn('field4', SUT.cache.cached_values)
 
 if __name__ == '__main__':
     unittest.main(exit=False)
@@ -0,0 +1,979 @@
+#
+#    Copyright (c) 2020-2021 Rich Bell <bellrichm@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+# pylint: disable=missing-docstring
+# pylint: disable=invalid-name
+
+import json
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+import unittest
+import mock
+
+import weedb
+import weewx
+import weewx.manager
+
+import user.externalqueue
+import user.queuenotify
+import user.queuerecord
+import user.segmentlog
+
+def build_config(sqlite_root, service_dict=None):
+    return {
+        'WEEWX_ROOT': sqlite_root,
+        'ExternalQueue': service_dict or {},
+        'DataBindings': {
+            'ext_queue_binding': {
+                'database': 'ext_queue_sqlite',
+                'table_name': 'archive',
+                'manager': 'weewx.manager.Manager',
+                'schema': 'user.externalqueue.schema',
+            },
+        },
+        'Databases': {
+            'ext_queue_sqlite': {
+                'database_name': 'ext_queue.sdb',
+                'database_type': 'SQLite',
+            },
+        },
+        'DatabaseTypes': {
+            'SQLite': {
+                'driver': 'weedb.sqlite',
+                'SQLITE_ROOT': sqlite_root,
+            },
+        },
+    }
+
+def create_engine(config_dict):
+    engine = mock.Mock()
+    engine.db_binder.get_manager.side_effect = \
+        lambda data_binding, initialize: weewx.manager.open_manager_with_config(config_dict, data_binding, initialize)
+    return engine
+
+def read_rows(config_dict):
+    with weewx.manager.open_manager_with_config(config_dict, 'ext_queue_binding') as db_manager:
+        return list(db_manager.genSql("SELECT dateTime, dataType, data FROM archive ORDER BY rowid;"))
+
+def send_packets(SUT, count):
+    packets = []
+    start = int(time.time())
+    for i in range(count):
+        packet = {'dateTime': start + i, 'usUnits': weewx.US, 'outTemp': random.uniform(0, 100)}
+        packets.append(packet)
+        SUT.new_loop_packet(weewx.Event(weewx.NEW_LOOP_PACKET, packet=packet))
+    return packets
+
+def write_records(config_dict, data_types):
+    writer = user.externalqueue.QueueWriter(config_dict, 'ext_queue_binding', queue_size=0)
+    writer.start()
+    records = []
+    start = int(time.time())
+    for i, data_type in enumerate(data_types):
+        record = {'dateTime': start + i, 'usUnits': weewx.US, 'outTemp': random.uniform(0, 100)}
+        records.append((data_type, record))
+        writer.put(data_type, record)
+    writer.stop()
+    return records
+
+class TestPacked(unittest.TestCase):
+    def setUp(self):
+        self.record = {
+            'dateTime': int(time.time()),
+            'usUnits': weewx.US,
+            'outTemp': random.uniform(-40, 120),
+            'rain': None,
+            'flag': random.choice([True, False]),
+            'station': 'station%i' % random.randint(1, 100),
+            'large': 2**70,
+            'list': [random.randint(1, 100), 'a'],
+        }
+        self.field_ids = {}
+        for name in self.record:
+            self.field_ids[name] = random.randint(1, 65535)
+        self.field_names = {field_id: name for name, field_id in self.field_ids.items()}
+
+    def test_round_trip(self):
+        data = user.queuerecord.encode_packed(self.record, self.field_ids)
+
+        self.assertEqual(user.queuerecord.decode_packed(data, self.field_names), self.record)
+
+    def test_compressed_round_trip(self):
+        data = user.queuerecord.encode_packed(self.record, self.field_ids, compress=True)
+
+        self.assertEqual(user.queuerecord.decode_packed(data, self.field_names), self.record)
+
+    def test_smaller_than_json(self):
+        record = {'dateTime': int(time.time()), 'usUnits': weewx.US}
+        field_ids = {'dateTime': 1, 'usUnits': 2}
+        for i in range(80):
+            record['observation%i' % i] = random.uniform(0, 100)
+            field_ids['observation%i' % i] = i + 3
+
+        self.assertLess(len(user.queuerecord.encode_packed(record, field_ids)), len(json.dumps(record)) / 2)
+
+class TestExternalQueue(unittest.TestCase):
+    def setUp(self):
+        self.sqlite_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.sqlite_root)
+
+    def test_flush_on_shutdown(self):
+        config_dict = build_config(self.sqlite_root, {'batch_size': '1000', 'batch_interval': '60000'})
+        SUT = user.externalqueue.ExternalQueue(create_engine(config_dict), config_dict)
+        packets = send_packets(SUT, random.randint(1, 100))
+
+        SUT.shutDown()
+
+        rows = read_rows(config_dict)
+        self.assertEqual(len(rows), len(packets))
+        for row, packet in zip(rows, packets):
+            self.assertEqual(row[0], packet['dateTime'])
+            self.assertEqual(row[1], 'loop')
+            self.assertEqual(json.loads(row[2]), packet)
+
+    def test_batches(self):
+        batch_size = random.randint(2, 10)
+        config_dict = build_config(self.sqlite_root, {'batch_size': str(batch_size), 'batch_interval': '60000'})
+        SUT = user.externalqueue.ExternalQueue(create_engine(config_dict), config_dict)
+        writer = SUT.writer
+        packet_count = batch_size * random.randint(2, 5)
+        send_packets(SUT, packet_count)
+
+        SUT.shutDown()
+
+        metrics = writer.metrics.as_dict()
+        self.assertEqual(metrics['rows'], packet_count)
+        self.assertEqual(metrics['max_batch'], batch_size)
+        self.assertLessEqual(metrics['batches'], packet_count)
+        self.assertEqual(metrics['dropped'], 0)
+
+    def test_batch_interval(self):
+        config_dict = build_config(self.sqlite_root, {'batch_size': '1000', 'batch_interval': '10'})
+        SUT = user.externalqueue.ExternalQueue(create_engine(config_dict), config_dict)
+        send_packets(SUT, 1)
+
+        deadline = time.time() + 5
+        while SUT.writer.metrics.batches == 0 and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(SUT.writer.metrics.batches, 1)
+        SUT.shutDown()
+        self.assertEqual(len(read_rows(config_dict)), 1)
+
+    def test_full_queue_drops(self):
+        queue_size = random.randint(1, 10)
+        config_dict = build_config(self.sqlite_root)
+        writer = user.externalqueue.QueueWriter(config_dict, 'ext_queue_binding', queue_size=queue_size)
+        # Not started, so nothing is taken off of the queue.
+        for i in range(queue_size):
+            self.assertTrue(writer.put('loop', {'dateTime': i}))
+        self.assertFalse(writer.put('loop', {'dateTime': queue_size}))
+
+        metrics = writer.metrics.as_dict()
+        self.assertEqual(metrics['max_depth'], queue_size)
+        self.assertEqual(metrics['dropped'], 1)
+
+    def test_stop_full_queue(self):
+        config_dict = build_config(self.sqlite_root)
+        writer = user.externalqueue.QueueWriter(config_dict, 'ext_queue_binding', queue_size=1)
+        writer.start()
+        with mock.patch.object(writer, 'get_batch', side_effect=lambda wait: time.sleep(10)):
+            writer.put('loop', {'dateTime': 1})
+            writer.put('loop', {'dateTime': 2})
+
+            start = time.time()
+            self.assertFalse(writer.stop(timeout=0.5))
+            self.assertLess(time.time() - start, 5)
+
+    def test_open_fails(self):
+        config_dict = build_config(self.sqlite_root)
+        SUT = user.externalqueue.ExternalQueue(create_engine(config_dict), config_dict)
+        SUT.writer.stop()
+        writer = user.externalqueue.QueueWriter(config_dict, 'ext_queue_binding')
+        SUT.writer = writer
+        with mock.patch.object(writer, 'open_storage', side_effect=weedb.OperationalError('open failed')):
+            with mock.patch.object(user.externalqueue, 'logerr') as mock_logerr:
+                writer.start()
+                writer.join(5)
+                self.assertFalse(writer.is_alive())
+
+                send_packets(SUT, random.randint(2, 10))
+
+                self.assertEqual(writer.record_queue.qsize(), 0)
+                messages = [call[0][0] for call in mock_logerr.call_args_list]
+                self.assertEqual(messages.count("The writer is not running, records are being dropped"), 1)
+        self.assertTrue(writer.stop(timeout=1))
+        SUT.writer = None
+        SUT.shutDown()
+
+    def test_archive_binding(self):
+        config_dict = build_config(self.sqlite_root, {'binding': 'archive'})
+        engine = create_engine(config_dict)
+        SUT = user.externalqueue.ExternalQueue(engine, config_dict)
+
+        engine.bind.assert_called_once_with(weewx.NEW_ARCHIVE_RECORD, SUT.new_archive_record)
+        record = {'dateTime': int(time.time()), 'usUnits': weewx.US, 'interval': 5}
+        SUT.new_archive_record(weewx.Event(weewx.NEW_ARCHIVE_RECORD, record=record))
+        SUT.shutDown()
+
+        rows = read_rows(config_dict)
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0][1], 'archive')
+
+    def test_packed_encoding(self):
+        for compress in ('False', 'True'):
+            config_dict = build_config(self.sqlite_root, {'encoding': 'packed', 'compress': compress})
+            SUT = user.externalqueue.ExternalQueue(create_engine(config_dict), config_dict)
+            packets = send_packets(SUT, random.randint(1, 20))
+            SUT.new_loop_packet(weewx.Event(weewx.NEW_LOOP_PACKET, packet={'dateTime': int(time.time()), 'new_field': 1.0}))
+            SUT.shutDown()
+
+            with user.externalqueue.open_reader(config_dict, name=compress) as reader:
+                rows = reader.dequeue(100)
+
+            self.assertEqual([row.record for row in rows[-len(packets) - 1:-1]], packets)
+            self.assertEqual(rows[-1].record['new_field'], 1.0)
+            self.assertIsInstance(read_rows(config_dict)[-1][2], bytes)
+
+    def test_mixed_encodings(self):
+        records = write_records(build_config(self.sqlite_root), ['loop'] * 5)
+        config_dict = build_config(self.sqlite_root, {'encoding': 'packed'})
+        SUT = user.externalqueue.ExternalQueue(create_engine(config_dict), config_dict)
+        packets = send_packets(SUT, 5)
+        SUT.shutDown()
+
+        with user.externalqueue.open_reader(config_dict) as reader:
+            rows = reader.dequeue(100)
+
+        self.assertEqual([row.record for row in rows], [record for _, record in records] + packets)
+
+    def test_invalid_encoding(self):
+        config_dict = build_config(self.sqlite_root, {'encoding': 'xml'})
+
+        self.assertRaises(ValueError, user.externalqueue.ExternalQueue, create_engine(config_dict), config_dict)
+
+    def test_not_enabled(self):
+        config_dict = build_config(self.sqlite_root, {'enable': 'False'})
+        engine = create_engine(config_dict)
+        SUT = user.externalqueue.ExternalQueue(engine, config_dict)
+
+        self.assertIsNone(SUT.writer)
+        engine.bind.assert_not_called()
+        SUT.shutDown()
+
+class TestQueueReader(unittest.TestCase):
+    def setUp(self):
+        self.sqlite_root = tempfile.mkdtemp()
+        self.config_dict = build_config(self.sqlite_root)
+
+    def tearDown(self):
+        shutil.rmtree(self.sqlite_root)
+
+    def test_dequeue_in_batches(self):
+        records = write_records(self.config_dict, ['loop'] * random.randint(10, 50))
+        count = random.randint(1, 9)
+
+        dequeued = []
+        with user.externalqueue.open_reader(self.config_dict) as SUT:
+            rows = SUT.dequeue(count)
+            while rows:
+                self.assertLessEqual(len(rows), count)
+                dequeued.extend(rows)
+                rows = SUT.dequeue(count)
+
+        self.assertEqual([(row.dataType, row.record) for row in dequeued], records)
+        self.assertEqual([row.id for row in dequeued], sorted(row.id for row in dequeued))
+
+    def test_data_type(self):
+        data_types = [random.choice(['loop', 'archive']) for _ in range(50)]
+        records = write_records(self.config_dict, data_types)
+
+        with user.externalqueue.open_reader(self.config_dict, data_type='archive') as SUT:
+            rows = SUT.dequeue(100)
+
+        self.assertEqual([row.record for row in rows], [record for data_type, record in records if data_type == 'archive'])
+
+    def test_resume_after_ack(self):
+        write_records(self.config_dict, ['loop'] * 20)
+
+        with user.externalqueue.open_reader(self.config_dict, name='consumer') as SUT:
+            acked = SUT.dequeue(5)
+            SUT.ack()
+            unacked = SUT.dequeue(5)
+
+        with user.externalqueue.open_reader(self.config_dict, name='consumer') as SUT:
+            rows = SUT.dequeue(5)
+
+        with user.externalqueue.open_reader(self.config_dict, name='other') as SUT:
+            other_rows = SUT.dequeue(5)
+
+        self.assertEqual(rows, unacked)
+        self.assertEqual(other_rows, acked)
+
+    def test_rewind(self):
+        write_records(self.config_dict, ['loop'] * 20)
+
+        with user.externalqueue.open_reader(self.config_dict) as SUT:
+            SUT.dequeue(5)
+            SUT.ack()
+            unacked = SUT.dequeue(5)
+            SUT.rewind()
+            rows = SUT.dequeue(5)
+
+        self.assertEqual(rows, unacked)
+
+    def test_delete_acked(self):
+        write_records(self.config_dict, ['loop'] * 20)
+
+        with user.externalqueue.open_reader(self.config_dict, delete_acked=True) as SUT:
+            SUT.dequeue(5)
+            SUT.ack()
+            self.assertEqual(len(read_rows(self.config_dict)), 15)
+
+            SUT.dequeue(100)
+            SUT.ack()
+
+        # The newest row is kept, so that its id is not reused.
+        self.assertEqual(len(read_rows(self.config_dict)), 1)
+        records = write_records(self.config_dict, ['loop'])
+        with user.externalqueue.open_reader(self.config_dict, delete_acked=True) as SUT:
+            rows = SUT.dequeue(100)
+
+        self.assertEqual([row.record for row in rows], [records[0][1]])
+
+    def test_delete_acked_data_type(self):
+        write_records(self.config_dict, ['loop', 'archive'] * 10)
+
+        with user.externalqueue.open_reader(self.config_dict, data_type='loop', delete_acked=True) as SUT:
+            SUT.dequeue(100)
+            SUT.ack()
+
+        data_types = [row[1] for row in read_rows(self.config_dict)]
+        self.assertEqual(data_types, ['archive'] * 10)
+
+    def test_dequeue_uses_index(self):
+        write_records(self.config_dict, ['loop'])
+
+        for data_type, expected in ((None, 'INTEGER PRIMARY KEY'), ('loop', 'INDEX archive_dataType')):
+            with user.externalqueue.open_reader(self.config_dict, data_type=data_type) as SUT:
+                plan = SUT.dbm.getSql("EXPLAIN QUERY PLAN " + SUT.dequeue_sql, SUT.parameters(0) + [10])
+            self.assertIn(expected, plan[-1])
+            self.assertIn('rowid>?', plan[-1])
+
+    def test_concurrent_writer(self):
+        config_dict = build_config(self.sqlite_root, {'batch_size': '10', 'batch_interval': '10'})
+        service = user.externalqueue.ExternalQueue(create_engine(config_dict), config_dict)
+        packet_count = 500
+
+        dequeued = []
+        with user.externalqueue.open_reader(config_dict, delete_acked=True) as SUT:
+            packets = send_packets(service, packet_count)
+            deadline = time.time() + 10
+            while len(dequeued) < packet_count and time.time() < deadline:
+                rows = SUT.dequeue(random.randint(1, 50))
+                dequeued.extend(rows)
+                SUT.ack()
+        service.shutDown()
+
+        self.assertEqual([row.record for row in dequeued], packets)
+
+def build_packets(count):
+    packets = []
+    start = int(time.time())
+    packet = {'usUnits': weewx.US, 'outTemp': 50.0, 'barometer': 30.0, 'windSpeed': 0.0}
+    for i in range(count):
+        packet = dict(packet)
+        packet['dateTime'] = start + i
+        packet['outTemp'] = random.choice([packet['outTemp'], random.uniform(0, 100)])
+        if random.randint(0, 4) == 0:
+            packet.pop('windSpeed', None)
+        else:
+            packet['windSpeed'] = random.choice([packet.get('windSpeed'), random.uniform(0, 10)])
+        packets.append(packet)
+    return packets
+
+class TestDelta(unittest.TestCase):
+    def setUp(self):
+        self.sqlite_root = tempfile.mkdtemp()
+        self.keyframe_interval = random.randint(2, 10)
+        self.config_dict = build_config(self.sqlite_root, {'keyframe_interval': str(self.keyframe_interval)})
+
+    def tearDown(self):
+        shutil.rmtree(self.sqlite_root)
+
+    def write_packets(self, packets):
+        SUT = user.externalqueue.ExternalQueue(create_engine(self.config_dict), self.config_dict)
+        for packet in packets:
+            SUT.new_loop_packet(weewx.Event(weewx.NEW_LOOP_PACKET, packet=packet))
+        SUT.shutDown()
+
+    def test_delta_round_trip(self):
+        previous, record = build_packets(2)
+        record['new_field'] = 1
+
+        delta = user.queuerecord.delta_record(previous, record)
+
+        self.assertEqual(user.queuerecord.apply_delta(previous, delta), record)
+        self.assertNotIn('usUnits', delta)
+
+    def test_keyframes(self):
+        packets = build_packets(random.randint(20, 50))
+
+        self.write_packets(packets)
+
+        data_types = [row[1] for row in read_rows(self.config_dict)]
+        expected = [('loop' if i % self.keyframe_interval == 0 else 'loop_delta') for i in range(len(packets))]
+        self.assertEqual(data_types, expected)
+
+    def test_dequeue_rebuilds_packets(self):
+        packets = build_packets(random.randint(20, 50))
+        self.write_packets(packets)
+
+        for data_type in (None, 'loop'):
+            with user.externalqueue.open_reader(self.config_dict, data_type=data_type) as SUT:
+                rows = SUT.dequeue(random.randint(1, 5))
+                dequeued = rows
+                while rows:
+                    rows = SUT.dequeue(random.randint(1, 5))
+                    dequeued.extend(rows)
+
+            self.assertEqual([row.record for row in dequeued], packets)
+            self.assertEqual(set(row.dataType for row in dequeued), set(['loop']))
+
+    def test_resume_from_keyframe(self):
+        packets = build_packets(30)
+        self.write_packets(packets)
+        count = random.randint(1, 29)
+
+        with user.externalqueue.open_reader(self.config_dict) as SUT:
+            SUT.dequeue(count)
+            SUT.ack()
+        with user.externalqueue.open_reader(self.config_dict) as SUT:
+            rows = SUT.dequeue(100)
+
+        self.assertEqual([row.record for row in rows], packets[count:])
+
+    def test_delete_acked_keeps_keyframe(self):
+        packets = build_packets(30)
+        self.write_packets(packets)
+        count = random.randint(1, 29)
+
+        with user.externalqueue.open_reader(self.config_dict, delete_acked=True) as SUT:
+            SUT.dequeue(count)
+            SUT.ack()
+        with user.externalqueue.open_reader(self.config_dict) as SUT:
+            rows = SUT.dequeue(100)
+
+        self.assertEqual([row.record for row in rows], packets[count:])
+        self.assertLessEqual(len(read_rows(self.config_dict)), 30 - count + self.keyframe_interval)
+
+    def test_stream(self):
+        packets = build_packets(50)
+        self.write_packets(packets)
+        start = random.randint(0, 20)
+        stop = random.randint(30, 50)
+
+        with user.externalqueue.open_reader(self.config_dict) as SUT:
+            ids = [row[0] for row in SUT.dbm.genSql("SELECT rowid FROM archive ORDER BY rowid;")]
+            rows = list(SUT.stream(after=ids[start - 1] if start else 0, stop=ids[stop - 1], batch_size=random.randint(1, 10)))
+            self.assertEqual(SUT.position, 0)
+
+        self.assertEqual([row.record for row in rows], packets[start:stop])
+
+    def test_reconstruct(self):
+        packets = build_packets(20)
+        self.write_packets(packets)
+
+        with user.externalqueue.open_reader(self.config_dict) as SUT:
+            rows = [user.queuerecord.QueueRow(row[0], row[1], row[2], json.loads(row[3]))
+                    for row in SUT.dbm.genSql("SELECT rowid, dateTime, dataType, data FROM archive ORDER BY rowid;")]
+
+        # The deltas before the first keyframe are skipped.
+        rebuilt = list(user.queuerecord.reconstruct(rows[1:]))
+        self.assertEqual([row.record for row in rebuilt], packets[self.keyframe_interval:])
+
+class TestPruner(unittest.TestCase):
+    def setUp(self):
+        self.sqlite_root = tempfile.mkdtemp()
+        self.config_dict = build_config(self.sqlite_root)
+        self.db_manager = weewx.manager.open_manager_with_config(self.config_dict, 'ext_queue_binding', initialize=True)
+        self.assertTrue(user.externalqueue.set_incremental_vacuum(self.db_manager))
+
+    def tearDown(self):
+        self.db_manager.close()
+        shutil.rmtree(self.sqlite_root)
+
+    def insert_rows(self, count, start, data_size=100, keyframe_interval=0):
+        with weedb.Transaction(self.db_manager.connection) as cursor:
+            for i in range(count):
+                data_type = 'loop_delta' if keyframe_interval and i % keyframe_interval else 'loop'
+                cursor.execute(user.externalqueue.INSERT_SQL % 'archive', [start + i, 0, 0, data_type, 'x' * data_size])
+
+    def get_data_types(self):
+        return [row[0] for row in self.db_manager.genSql("SELECT dataType FROM archive ORDER BY rowid;")]
+
+    def get_date_times(self):
+        return [row[0] for row in self.db_manager.genSql("SELECT dateTime FROM archive ORDER BY rowid;")]
+
+    def prune(self, SUT):
+        deleted = []
+        SUT.start(self.db_manager)
+        while SUT.pending:
+            rows, _ = SUT.step(self.db_manager)
+            deleted.append(rows)
+        return deleted
+
+    def test_max_rows(self):
+        # At least a full batch more than max_rows, so that a full batch is deleted
+        count = random.randint(200, 1000)
+        max_rows = random.randint(10, 90)
+        batch_size = random.randint(10, 50)
+        self.insert_rows(count, 1000)
+        SUT = user.externalqueue.QueuePruner(max_rows=max_rows, batch_size=batch_size)
+
+        deleted = self.prune(SUT)
+
+        self.assertEqual(self.get_date_times(), list(range(1000 + count - max_rows, 1000 + count)))
+        self.assertEqual(max(deleted), batch_size)
+
+    def test_max_age(self):
+        max_age = random.randint(100, 1000)
+        now = int(time.time())
+        self.insert_rows(2000, now - 2000)
+        SUT = user.externalqueue.QueuePruner(max_age=max_age, batch_size=random.randint(10, 50))
+
+        self.prune(SUT)
+
+        date_times = self.get_date_times()
+        self.assertGreaterEqual(date_times[0], now - max_age - 5)
+        self.assertLessEqual(date_times[0], now - max_age + 5)
+
+    def test_limits_together(self):
+        now = int(time.time())
+        for limits in ({'max_rows': 10, 'max_age': 3600}, {'max_bytes': 1, 'max_age': 3600},
+                       {'max_rows': 10, 'max_age': 3600, 'max_bytes': 10000000}):
+            self.db_manager.getSql("DELETE FROM archive;")
+            self.insert_rows(100, now - 100)
+            SUT = user.externalqueue.QueuePruner(batch_size=random.randint(5, 50), **limits)
+
+            self.prune(SUT)
+
+            if 'max_rows' in limits:
+                self.assertEqual(self.get_date_times(), list(range(now - 10, now)))
+            else:
+                self.assertEqual(self.get_date_times(), [now - 1])
+
+    def test_age_then_rows(self):
+        now = int(time.time())
+        self.insert_rows(100, now - 7200)
+        self.insert_rows(100, now - 100)
+        SUT = user.externalqueue.QueuePruner(max_rows=50, max_age=3600, batch_size=random.randint(5, 50))
+
+        self.prune(SUT)
+
+        self.assertEqual(self.get_date_times(), list(range(now - 50, now)))
+
+    def test_newest_row_is_kept(self):
+        self.insert_rows(100, 1000)
+        SUT = user.externalqueue.QueuePruner(max_age=1)
+
+        self.prune(SUT)
+
+        self.assertEqual(self.get_date_times(), [1099])
+
+    def test_max_bytes(self):
+        self.insert_rows(2000, 1000, 1000)
+        page_count = self.db_manager.getSql("PRAGMA page_count;")[0]
+        max_bytes = random.randint(100000, 1000000)
+        SUT = user.externalqueue.QueuePruner(max_bytes=max_bytes, batch_size=100, vacuum_pages=random.randint(10, 100))
+
+        self.prune(SUT)
+
+        self.assertLessEqual(SUT.used_bytes(self.db_manager), max_bytes)
+        self.assertEqual(self.db_manager.getSql("PRAGMA freelist_count;")[0], 0)
+        self.assertLess(self.db_manager.getSql("PRAGMA page_count;")[0], page_count)
+        self.assertGreater(len(self.get_date_times()), 0)
+
+    def test_max_bytes_under_max_rows(self):
+        self.insert_rows(500, 1000, 1000)
+        max_bytes = self.db_manager.getSql("PRAGMA page_count;")[0] * self.db_manager.getSql("PRAGMA page_size;")[0] // 2
+        batch_size = random.randint(10, 50)
+        SUT = user.externalqueue.QueuePruner(max_rows=1000, max_bytes=max_bytes, batch_size=batch_size)
+
+        deleted = self.prune(SUT)
+
+        self.assertLessEqual(max(deleted), batch_size)
+        self.assertLessEqual(SUT.used_bytes(self.db_manager), max_bytes)
+        self.assertGreater(len(self.get_date_times()), 100)
+
+    def test_max_bytes_at_max_rows(self):
+        self.insert_rows(1000, 1000, 1000)
+        max_bytes = self.db_manager.getSql("PRAGMA page_count;")[0] * self.db_manager.getSql("PRAGMA page_size;")[0] // 2
+        SUT = user.externalqueue.QueuePruner(max_rows=1000, max_bytes=max_bytes, batch_size=random.randint(10, 50))
+
+        self.prune(SUT)
+
+        self.assertLessEqual(SUT.used_bytes(self.db_manager), max_bytes)
+        self.assertGreater(len(self.get_date_times()), 0)
+
+    def test_prune_to_keyframe(self):
+        keyframe_interval = random.randint(5, 20)
+        self.insert_rows(500, 1000, keyframe_interval=keyframe_interval)
+        max_rows = random.randint(50, 400)
+        SUT = user.externalqueue.QueuePruner(max_rows=max_rows, batch_size=random.randint(10, 50), keyframes=True)
+
+        self.prune(SUT)
+
+        date_times = self.get_date_times()
+        self.assertEqual(self.get_data_types()[0], 'loop')
+        self.assertEqual((date_times[0] - 1000) % keyframe_interval, 0)
+        self.assertLessEqual(len(date_times), max_rows)
+        self.assertGreater(len(date_times), max_rows - keyframe_interval)
+
+    def test_prune_keeps_last_keyframe(self):
+        self.insert_rows(10, 1000)
+        self.insert_rows(50, 1010, keyframe_interval=100)
+        SUT = user.externalqueue.QueuePruner(max_rows=20, batch_size=random.randint(5, 50), keyframes=True)
+
+        self.prune(SUT)
+
+        self.assertEqual(self.get_date_times(), list(range(1010, 1060)))
+
+    def test_incremental_vacuum_needs_empty_queue(self):
+        db_manager = weewx.manager.Manager.open_with_create({'driver': 'weedb.sqlite',
+                                                             'database_name': 'other.sdb',
+                                                             'SQLITE_ROOT': self.sqlite_root},
+                                                            schema=user.externalqueue.schema)
+        db_manager.getSql(user.externalqueue.INSERT_SQL % 'archive', [1, 0, 0, 'loop', 'x'])
+
+        self.assertFalse(user.externalqueue.set_incremental_vacuum(db_manager))
+        self.assertEqual(db_manager.getSql("PRAGMA auto_vacuum;")[0], 0)
+        db_manager.close()
+
+    def test_writer_prunes(self):
+        self.db_manager.close()
+        config_dict = build_config(self.sqlite_root, {'max_rows': '10', 'prune_interval': '0', 'batch_size': '5', 'batch_interval': '10'})
+        SUT = user.externalqueue.ExternalQueue(create_engine(config_dict), config_dict)
+        writer = SUT.writer
+        for _ in range(10):
+            send_packets(SUT, 5)
+            time.sleep(0.02)
+        SUT.shutDown()
+        self.db_manager = weewx.manager.open_manager_with_config(config_dict, 'ext_queue_binding')
+
+        self.assertGreater(writer.metrics.pruned, 0)
+        self.assertEqual(self.db_manager.getSql("PRAGMA auto_vacuum;")[0], 2)
+        self.assertLess(len(self.get_date_times()), 50)
+
+class TestSegmentLog(unittest.TestCase):
+    def setUp(self):
+        self.weewx_root = tempfile.mkdtemp()
+        self.directory = os.path.join(self.weewx_root, 'archive', 'ext_queue')
+
+    def tearDown(self):
+        shutil.rmtree(self.weewx_root)
+
+    def build_config(self, service_dict=None):
+        config_dict = build_config(self.weewx_root, service_dict)
+        config_dict['ExternalQueue']['backend'] = 'segmentlog'
+        return config_dict
+
+    def append(self, SUT, count, start=1000, data_types=('loop',)):
+        rows = []
+        for i in range(count):
+            record = {'dateTime': start + i, 'usUnits': weewx.US, 'outTemp': random.uniform(0, 100)}
+            rows.append((random.choice(data_types), record))
+        SUT.append([(data_type, record['dateTime'], json.dumps(record).encode('utf-8')) for data_type, record in rows])
+        return rows
+
+    def read_all(self, reader, count=100):
+        rows = []
+        batch = reader.dequeue(count)
+        while batch:
+            rows.extend(batch)
+            batch = reader.dequeue(count)
+        return rows
+
+    def test_service(self):
+        config_dict = self.build_config({'binding': 'loop, archive'})
+        SUT = user.externalqueue.ExternalQueue(create_engine(config_dict), config_dict)
+        packets = send_packets(SUT, random.randint(1, 100))
+        record = {'dateTime': int(time.time()), 'usUnits': weewx.US, 'interval': 5}
+        SUT.new_archive_record(weewx.Event(weewx.NEW_ARCHIVE_RECORD, record=record))
+        SUT.shutDown()
+
+        with user.externalqueue.open_reader(config_dict) as reader:
+            self.assertIsInstance(reader, user.segmentlog.SegmentLogReader)
+            rows = self.read_all(reader)
+        with user.externalqueue.open_reader(config_dict, data_type='archive') as reader:
+            archive_rows = self.read_all(reader)
+
+        self.assertEqual([row.record for row in rows], packets + [record])
+        self.assertEqual([row.id for row in rows], list(range(1, len(packets) + 2)))
+        self.assertEqual([row.record for row in archive_rows], [record])
+
+    def test_segments_roll(self):
+        SUT = user.segmentlog.SegmentLog(self.directory, segment_size=2000, index_interval=300)
+        rows = self.append(SUT, 200)
+        SUT.close()
+
+        first_ids = user.segmentlog.list_segments(self.directory)
+        self.assertGreater(len(first_ids), 5)
+        for first_id in first_ids[:-1]:
+            segment_path = user.segmentlog.get_segment_path(self.directory, first_id)
+            self.assertLessEqual(os.path.getsize(segment_path), 2000)
+            index = user.segmentlog.read_segment_index(user.segmentlog.get_index_path(segment_path))
+            self.assertEqual(index[0][0], first_id)
+            self.assertGreater(len(index), 1)
+
+        with user.segmentlog.SegmentLogReader(self.directory) as reader:
+            read_rows_ = self.read_all(reader, random.randint(1, 30))
+        self.assertEqual([row.record for row in read_rows_], [record for _, record in rows])
+
+    def test_reads_while_writing(self):
+        SUT = user.segmentlog.SegmentLog(self.directory, segment_size=2000, index_interval=300)
+        with user.segmentlog.SegmentLogReader(self.directory) as reader:
+            rows = []
+            read = []
+            for _ in range(10):
+                rows.extend(self.append(SUT, random.randint(1, 30), 1000 + len(rows)))
+                read.extend(reader.dequeue(1000))
+        SUT.close()
+
+        self.assertEqual([row.record for row in read], [record for _, record in rows])
+
+    def test_seek(self):
+        SUT = user.segmentlog.SegmentLog(self.directory, segment_size=2000, index_interval=300)
+        self.append(SUT, 200)
+        SUT.close()
+        # At least five rows from date_time to the end.
+        date_time = random.randint(1000, 1195)
+
+        with user.segmentlog.SegmentLogReader(self.directory) as reader:
+            after = reader.seek(date_time)
+            rows = list(reader.stream(after, after + 5))
+            self.assertEqual(reader.seek(0), 0)
+            self.assertEqual(reader.seek(2000), 200)
+
+        self.assertEqual(rows[0].dateTime, date_time)
+        self.assertEqual(len(rows), 5)
+
+    def test_recover_incomplete_record(self):
+        SUT = user.segmentlog.SegmentLog(self.directory)
+        rows = self.append(SUT, 10)
+        SUT.close()
+        segment_path = user.segmentlog.get_segment_path(self.directory, 1)
+        with open(segment_path, 'ab') as file_ptr:
+            file_ptr.write(user.segmentlog.SEGMENT_RECORD.pack(100, 11, 2000, 0) + b'{"dateTime"')
+
+        SUT = user.segmentlog.SegmentLog(self.directory)
+        rows.extend(self.append(SUT, 5, 1010))
+        SUT.close()
+
+        with user.segmentlog.SegmentLogReader(self.directory) as reader:
+            read = self.read_all(reader)
+        self.assertEqual([row.record for row in read], [record for _, record in rows])
+        self.assertEqual([row.id for row in read], list(range(1, 16)))
+
+    def test_prune(self):
+        SUT = user.segmentlog.SegmentLog(self.directory, segment_size=2000)
+        self.append(SUT, 200)
+        with user.segmentlog.SegmentLogReader(self.directory) as reader:
+            self.read_all(reader)
+            reader.rewind()
+
+            deleted = SUT.prune(max_rows=50)
+            rows = self.read_all(reader)
+
+        self.assertEqual(len(rows), 200 - deleted)
+        self.assertGreaterEqual(len(rows), 50)
+        self.assertEqual(rows[-1].id, 200)
+        SUT.close()
+
+    def test_prune_by_age_and_bytes(self):
+        SUT = user.segmentlog.SegmentLog(self.directory, segment_size=2000)
+        now = int(time.time())
+        self.append(SUT, 200, now - 200)
+
+        SUT.prune(max_age=100)
+        with user.segmentlog.SegmentLogReader(self.directory) as reader:
+            first_time = reader.dequeue(1)[0].dateTime
+        self.assertLessEqual(first_time, now - 100)
+        self.assertGreater(first_time, now - 130)
+
+        SUT.prune(max_bytes=5000)
+        sizes = [os.path.getsize(os.path.join(self.directory, name)) for name in os.listdir(self.directory)]
+        self.assertLessEqual(sum(sizes), 5000)
+        SUT.close()
+
+    def test_ack(self):
+        SUT = user.segmentlog.SegmentLog(self.directory)
+        rows = self.append(SUT, 20)
+        SUT.close()
+
+        with user.segmentlog.SegmentLogReader(self.directory, name='consumer') as reader:
+            reader.dequeue(5)
+            reader.ack()
+            reader.dequeue(5)
+        with user.segmentlog.SegmentLogReader(self.directory, name='consumer') as reader:
+            read = reader.dequeue(5)
+
+        self.assertEqual([row.record for row in read], [record for _, record in rows[5:10]])
+        self.assertRaises(ValueError, user.segmentlog.SegmentLogReader, self.directory, delete_acked=True)
+
+    def test_unsupported_options(self):
+        for service_dict in ({'encoding': 'packed'}, {'keyframe_interval': '10'}, {'backend': 'file'}):
+            config_dict = self.build_config()
+            config_dict['ExternalQueue'].update(service_dict)
+
+            self.assertRaises(ValueError, user.externalqueue.ExternalQueue, create_engine(config_dict), config_dict)
+
+class TestNotify(unittest.TestCase):
+    def setUp(self):
+        self.weewx_root = tempfile.mkdtemp()
+        self.path = os.path.join(self.weewx_root, 'ext_queue.notify')
+
+    def tearDown(self):
+        shutil.rmtree(self.weewx_root)
+
+    def wait_for(self, notifications, last_id):
+        ids = None
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            announced = notifications.wait(1)
+            if announced is not None:
+                ids = (ids[0] if ids else announced[0], announced[1])
+                if announced[1] >= last_id:
+                    break
+        return ids
+
+    def test_socket(self):
+        for backend in ('sqlite', 'segmentlog'):
+            config_dict = build_config(self.weewx_root, {'notify': 'socket', 'notify_path': 'ext_queue.notify',
+                                                         'backend': backend, 'batch_size': '5', 'batch_interval': '10'})
+            SUT = user.externalqueue.ExternalQueue(create_engine(config_dict), config_dict)
+            with user.queuenotify.Notifications(self.path) as notifications, \
+                 user.externalqueue.open_reader(config_dict, name=backend) as reader:
+                # Connected when the first batch is announced.
+                send_packets(SUT, 1)
+                first_id = self.wait_for(notifications, 0)[0]
+                count = random.randint(10, 50)
+                send_packets(SUT, count)
+
+                ids = self.wait_for(notifications, first_id + count)
+                rows = reader.dequeue(100)
+            SUT.shutDown()
+
+            self.assertEqual(ids[1], first_id + count)
+            self.assertEqual(rows[-1].id, ids[1])
+            self.assertFalse(os.path.exists(self.path))
+
+    def test_slow_consumer_is_disconnected(self):
+        SUT = user.queuenotify.SocketNotifier(self.path)
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(self.path)
+
+        start = time.time()
+        i = 0
+        SUT.notify(1, 1)
+        while SUT.clients:
+            i += 1
+            SUT.notify(i, i)
+        elapsed = time.time() - start
+
+        self.assertLess(elapsed, 5)
+        client.close()
+        SUT.close()
+
+    def test_closed_consumer_is_disconnected(self):
+        SUT = user.queuenotify.SocketNotifier(self.path)
+        with user.queuenotify.Notifications(self.path) as notifications:
+            SUT.notify(1, 2)
+            self.assertEqual(notifications.wait(1), (1, 2))
+        SUT.notify(3, 4)
+        SUT.notify(5, 6)
+
+        self.assertEqual(SUT.clients, [])
+        SUT.close()
+
+    def test_fifo(self):
+        config_dict = build_config(self.weewx_root, {'notify': 'fifo', 'notify_path': 'ext_queue.notify',
+                                                     'batch_size': '5', 'batch_interval': '10'})
+        SUT = user.externalqueue.ExternalQueue(create_engine(config_dict), config_dict)
+        # No consumer yet.
+        count = random.randint(1, 10)
+        send_packets(SUT, count)
+        with user.queuenotify.Notifications(self.path) as notifications:
+            more = random.randint(10, 50)
+            send_packets(SUT, more)
+            count += more
+
+            ids = self.wait_for(notifications, count)
+            with user.externalqueue.open_reader(config_dict) as reader:
+                rows = reader.dequeue(100)
+        SUT.shutDown()
+
+        self.assertEqual(ids[1], count)
+        self.assertEqual(rows[-1].id, ids[1])
+
+    def test_full_fifo(self):
+        SUT = user.queuenotify.FifoNotifier(self.path)
+        with user.queuenotify.Notifications(self.path) as notifications:
+            start = time.time()
+            for i in range(100000):
+                SUT.notify(i, i)
+            elapsed = time.time() - start
+
+            ids = notifications.wait(1)
+        SUT.close()
+
+        self.assertLess(elapsed, 5)
+        self.assertEqual(ids[0], 0)
+        self.assertLess(ids[1], 99999)
+
+    def test_wait_timeout(self):
+        SUT = user.queuenotify.SocketNotifier(self.path)
+        with user.queuenotify.Notifications(self.path) as notifications:
+            start = time.time()
+            self.assertIsNone(notifications.wait(0.05))
+            self.assertGreaterEqual(time.time() - start, 0.05)
+        SUT.close()
+
+        with user.queuenotify.Notifications(self.path) as notifications:
+            self.assertIsNone(notifications.wait(0.01))
+
+    def test_wait_for_service(self):
+        sleeps = []
+        notifiers = []
+        def start_service(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == 3:
+                notifiers.append(user.queuenotify.SocketNotifier(self.path))
+                # After the wait has connected.
+                threading.Timer(0.1, notifiers[0].notify, (1, 2)).start()
+
+        with user.queuenotify.Notifications(self.path) as notifications:
+            with mock.patch.object(user.queuenotify.time, 'sleep', side_effect=start_service):
+                ids = notifications.wait()
+        notifiers[0].close()
+
+        self.assertEqual(ids, (1, 2))
+        self.assertEqual(sleeps, [user.queuenotify.RECONNECT_INTERVAL] * 3)
+
+    def test_invalid_notify(self):
+        config_dict = build_config(self.weewx_root, {'notify': 'email'})
+
+        self.assertRaises(ValueError, user.externalqueue.ExternalQueue, create_engine(config_dict), config_dict)
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
@@ -0,0 +1,152 @@
+#
+#    Copyright (c) 2024 Rich Bell <bellrichm@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+# pylint: disable=missing-docstring
+# pylint: disable=invalid-name
+
+import random
+import time
+
+import unittest
+import mock
+
+import user.instrumentation
+import weewx
+
+class Engine(object):
+    ''' The event binding and dispatching of weewx.engine.StdEngine.'''
+    def __init__(self):
+        self.callbacks = {}
+
+    def bind(self, event_type, callback):
+        self.callbacks.setdefault(event_type, []).append(callback)
+
+    def dispatchEvent(self, event):
+        for callback in self.callbacks.get(event.event_type, []):
+            callback(event)
+
+class Service(object):
+    def __init__(self):
+        self.packets = []
+        self.records = []
+
+    def new_loop_packet(self, event):
+        self.packets.append(event.packet)
+
+    def new_archive_record(self, event):
+        self.records.append(event.record)
+
+def send_archive_record(engine):
+    event = weewx.Event(weewx.NEW_ARCHIVE_RECORD, record={'dateTime': int(time.time()), 'interval': 5})
+    engine.dispatchEvent(event)
+    return event.record
+
+class TestHandlerStats(unittest.TestCase):
+    def test_summary(self):
+        SUT = user.instrumentation.HandlerStats(1000)
+        latencies = [random.uniform(0.0001, 0.01) for _ in range(100)]
+        for latency in latencies:
+            SUT.add(latency)
+
+        summary = SUT.summary()
+
+        latencies.sort()
+        self.assertEqual(summary['count'], 100)
+        self.assertAlmostEqual(summary['p50'], latencies[49] * 1000000)
+        self.assertAlmostEqual(summary['p95'], latencies[94] * 1000000)
+        self.assertAlmostEqual(summary['max'], latencies[-1] * 1000000)
+
+    def test_no_calls(self):
+        SUT = user.instrumentation.HandlerStats(1000)
+
+        self.assertIsNone(SUT.summary())
+
+    def test_samples_are_bounded(self):
+        SUT = user.instrumentation.HandlerStats(10)
+        for _ in range(1000):
+            SUT.add(random.uniform(0.0001, 0.01))
+        SUT.add(1.0)
+
+        self.assertEqual(len(SUT.samples), 10)
+        self.assertEqual(SUT.summary()['count'], 1001)
+        self.assertEqual(SUT.summary()['max'], 1000000)
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        self.engine = Engine()
+        self.before = Service()
+        self.engine.bind(weewx.NEW_LOOP_PACKET, self.before.new_loop_packet)
+
+    def create_service(self, service_dict=None):
+        config_dict = {'Instrumentation': service_dict or {}}
+        SUT = user.instrumentation.Instrumentation(self.engine, config_dict)
+        self.after = Service()
+        self.engine.bind(weewx.NEW_LOOP_PACKET, self.after.new_loop_packet)
+        self.engine.bind(weewx.NEW_ARCHIVE_RECORD, self.after.new_archive_record)
+        self.engine.dispatchEvent(weewx.Event(weewx.STARTUP))
+        return SUT
+
+    def test_handlers_are_timed(self):
+        SUT = self.create_service()
+        packet_count = random.randint(1, 20)
+        for _ in range(packet_count):
+            self.engine.dispatchEvent(weewx.Event(weewx.NEW_LOOP_PACKET, packet={'dateTime': int(time.time())}))
+
+        self.assertEqual(len(self.before.packets), packet_count)
+        self.assertEqual(len(self.after.packets), packet_count)
+        self.assertEqual(SUT.handler_stats['NEW_LOOP_PACKET_Service_new_loop_packet'].count, packet_count)
+        self.assertEqual(SUT.handler_stats['NEW_LOOP_PACKET_Service_new_loop_packet_2'].count, packet_count)
+
+    def test_summary_is_logged_and_reset(self):
+        SUT = self.create_service()
+        self.engine.dispatchEvent(weewx.Event(weewx.NEW_LOOP_PACKET, packet={'dateTime': int(time.time())}))
+
+        with mock.patch.object(user.instrumentation, 'log') as mock_log:
+            record = send_archive_record(self.engine)
+
+        # Two loop packet handlers, and the archive record handler bound after the service
+        self.assertEqual(mock_log.info.call_count, 3)
+        self.assertEqual(SUT.handler_stats['NEW_LOOP_PACKET_Service_new_loop_packet'].count, 0)
+        self.assertEqual(SUT.handler_stats['NEW_ARCHIVE_RECORD_Service_new_archive_record'].count, 0)
+        self.assertNotIn('instrumentation_NEW_LOOP_PACKET_Service_new_loop_packet_count', record)
+
+    def test_summary_added_to_next_record(self):
+        self.create_service({'add_to_record': 'True'})
+        self.engine.dispatchEvent(weewx.Event(weewx.NEW_LOOP_PACKET, packet={'dateTime': int(time.time())}))
+
+        record = send_archive_record(self.engine)
+        self.assertNotIn('instrumentation_NEW_LOOP_PACKET_Service_new_loop_packet_count', record)
+
+        record = send_archive_record(self.engine)
+        self.assertEqual(record['instrumentation_NEW_LOOP_PACKET_Service_new_loop_packet_count'], 1)
+        self.assertEqual(record['instrumentation_NEW_ARCHIVE_RECORD_Service_new_archive_record_count'], 1)
+        for stat in ('p50', 'p95', 'max'):
+            self.assertIn('instrumentation_NEW_LOOP_PACKET_Service_new_loop_packet_%s' % stat, record)
+
+    def test_exception_is_timed_and_raised(self):
+        SUT = self.create_service()
+        self.engine.bind(weewx.NEW_LOOP_PACKET, mock.Mock(side_effect=ValueError, __name__='failing'))
+
+        self.assertRaises(ValueError,
+                          self.engine.dispatchEvent, weewx.Event(weewx.NEW_LOOP_PACKET, packet={'dateTime': int(time.time())}))
+        self.assertEqual(SUT.handler_stats['NEW_LOOP_PACKET_failing'].count, 1)
+
+    def test_not_enabled(self):
+        SUT = self.create_service({'enable': 'False'})
+
+        self.assertEqual(SUT.handler_stats, {})
+        self.assertEqual(self.engine.callbacks[weewx.NEW_LOOP_PACKET][0], self.before.new_loop_packet)
+
+    def test_shutdown_restores_bind(self):
+        SUT = self.create_service()
+
+        SUT.shutDown()
+        callback = mock.Mock()
+        self.engine.bind(weewx.NEW_LOOP_PACKET, callback)
+
+        self.assertIs(self.engine.callbacks[weewx.NEW_LOOP_PACKET][-1], callback)
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
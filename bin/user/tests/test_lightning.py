@@ -6,7 +6,10 @@
 # pylint: disable=missing-docstring
 # pylint: disable=invalid-name
 
+import os
 import random
+import shutil
+import tempfile
 import time
 
 import unittest
@@ -112,5 +115,316 @@ class TestFirstLoopPacket(unittest.TestCase):
         self.assertEqual(event.packet[SUT.max_distance_field_name], strike_distance)
         self.assertEqual(event.packet[SUT.max_det_time_field_name], now)
 
+class TestRollingStrikes(unittest.TestCase):
+    def setUp(self):
+        self.start = int(time.time()) // 3600 * 3600
+        self.SUT = user.lightning.RollingStrikes([300, 900, 3600], 60, [0, 5, 10, 20, 40])
+
+    def test_window_counts(self):
+        self.SUT.add(self.start, 12)
+        self.SUT.add(self.start + 10 * 60, 30)
+        self.SUT.add(self.start + 10 * 60 + 5, 8, 2)
+
+        self.assertEqual(self.SUT.window_counts, [3, 4, 4])
+
+        self.SUT.advance(self.start + 20 * 60)
+        self.assertEqual(self.SUT.window_counts, [0, 3, 4])
+
+        self.SUT.advance(self.start + 60 * 60)
+        self.assertEqual(self.SUT.window_counts, [0, 0, 3])
+
+    def test_closest(self):
+        self.SUT.add(self.start, 3)
+        self.SUT.add(self.start + 2 * 60, 12)
+        self.SUT.add(self.start + 8 * 60, 25)
+
+        # The 5 minute window is the current bucket and the 4 before it
+        self.assertEqual([self.SUT.get_closest(i) for i in range(3)], [25, 3, 3])
+
+        self.SUT.advance(self.start + 20 * 60)
+        self.assertEqual([self.SUT.get_closest(i) for i in range(3)], [None, 25, 3])
+
+        self.SUT.advance(self.start + 61 * 60)
+        self.assertEqual([self.SUT.get_closest(i) for i in range(3)], [None, None, 12])
+
+    def test_histogram(self):
+        distances = [random.uniform(0, 60) for _ in range(50)]
+        for i, distance in enumerate(distances):
+            self.SUT.add(self.start + i * 60, distance)
+
+        expected = [0] * 5
+        for distance in distances[-60:]:
+            expected[sum(1 for edge in [5, 10, 20, 40] if distance >= edge)] += 1
+        self.assertEqual(self.SUT.histogram, expected)
+
+        self.SUT.advance(self.start + 49 * 60 + 3600)
+        self.assertEqual(self.SUT.histogram, [0] * 5)
+
+    def test_gap_longer_than_windows(self):
+        self.SUT.add(self.start, 3)
+
+        self.SUT.add(self.start + 5 * 3600, 30)
+
+        self.assertEqual(self.SUT.window_counts, [1, 1, 1])
+        self.assertEqual(self.SUT.get_closest(2), 30)
+
+    def test_fixed_memory(self):
+        for i in range(10000):
+            self.SUT.add(self.start + i * 7, random.uniform(0, 60))
+
+        self.assertEqual(len(self.SUT.counts), 60)
+        self.assertEqual(self.SUT.window_counts[2], sum(self.SUT.counts))
+
+class TestRollingFields(unittest.TestCase):
+    def test_fields_added_to_every_packet(self):
+        mock_engine = mock.Mock()
+        config_dict = {
+            'Lightning': {
+                'rolling_windows': ['5', '60'],
+                'histogram_bins': ['0', '10'],
+            }
+        }
+        now = int(time.time())
+        SUT = user.lightning.Lightning(mock_engine, config_dict)
+
+        event = weewx.NEW_LOOP_PACKET()
+        event.packet = {
+            'dateTime': now - 600,
+            'lightning_distance': 15,
+            'lightning_strike_count': 3,
+        }
+        SUT.new_loop_packet(event)
+
+        event = weewx.NEW_LOOP_PACKET()
+        event.packet = {
+            'dateTime': now,
+        }
+        SUT.new_loop_packet(event)
+
+        self.assertEqual(event.packet['lightning_strike_count_5m'], 0)
+        self.assertEqual(event.packet['lightning_strike_count_60m'], 3)
+        self.assertIsNone(event.packet['lightning_closest_distance_5m'])
+        self.assertEqual(event.packet['lightning_closest_distance_60m'], 15)
+        self.assertEqual(event.packet['lightning_distance_0_10_count'], 0)
+        self.assertEqual(event.packet['lightning_distance_10_max_count'], 3)
+        self.assertNotIn(SUT.last_distance_field_name, event.packet)
+
+def least_squares(points):
+    count = len(points)
+    mean_t = sum(t for t, _ in points) / count
+    mean_d = sum(d for _, d in points) / count
+    slope = sum((t - mean_t) * (d - mean_d) for t, d in points) / sum((t - mean_t) ** 2 for t, _ in points)
+    return slope, mean_d - slope * mean_t
+
+class TestStormTrend(unittest.TestCase):
+    def setUp(self):
+        self.start = int(time.time())
+        self.SUT = user.lightning.StormTrend(15 * 60, 5)
+
+    def test_approaching(self):
+        # 40 km away, approaching at 36 km/h
+        for i in range(10):
+            self.SUT.add(self.start + i * 30, 40 - 0.01 * i * 30)
+
+        now = self.start + 9 * 30
+        speed, eta = self.SUT.get_trend(now)
+
+        self.assertAlmostEqual(speed, 36)
+        self.assertAlmostEqual(eta, (40 - 0.01 * 9 * 30) / 0.01)
+
+    def test_receding(self):
+        for i in range(10):
+            self.SUT.add(self.start + i * 30, 10 + 0.02 * i * 30)
+
+        speed, eta = self.SUT.get_trend(self.start + 9 * 30)
+
+        self.assertAlmostEqual(speed, -72)
+        self.assertIsNone(eta)
+
+    def test_too_few_strikes(self):
+        for i in range(4):
+            self.SUT.add(self.start + i * 30, random.uniform(0, 40))
+
+        self.assertEqual(self.SUT.get_trend(self.start + 3 * 30), (None, None))
+
+    def test_strikes_leave_window(self):
+        for i in range(10):
+            self.SUT.add(self.start + i * 30, random.uniform(0, 40))
+
+        self.SUT.expire(self.start + 9 * 30 + 15 * 60)
+
+        self.assertEqual(self.SUT.count, 0)
+        self.assertEqual(self.SUT.get_trend(self.start + 9 * 30 + 15 * 60), (None, None))
+
+    def test_long_storm(self):
+        # Hours of strikes, the fit is of the last 15 minutes only
+        points = []
+        for i in range(2000):
+            strike_time = self.start + i * 7
+            distance = random.uniform(0, 40)
+            points.append((strike_time, distance))
+            self.SUT.add(strike_time, distance)
+
+        window = [(t - self.SUT.origin, d) for t, d in points if t > points[-1][0] - 15 * 60]
+        slope, intercept = least_squares(window)
+        self.assertEqual(self.SUT.count, len(window))
+        self.assertAlmostEqual(self.SUT.fit()[0], slope)
+        self.assertAlmostEqual(self.SUT.fit()[1], intercept)
+
+class TestStormTrendFields(unittest.TestCase):
+    def test_us_units(self):
+        mock_engine = mock.Mock()
+        config_dict = {}
+        now = int(time.time())
+        SUT = user.lightning.Lightning(mock_engine, config_dict)
+
+        # 20 miles away, approaching at 60 mph
+        for i in range(5):
+            event = weewx.NEW_LOOP_PACKET()
+            event.packet = {
+                'dateTime': now + i * 60,
+                'usUnits': weewx.US,
+                'lightning_distance': 20 - i,
+            }
+            SUT.new_loop_packet(event)
+
+        self.assertAlmostEqual(event.packet[SUT.storm_speed_field_name], 60 * 1.609344)
+        self.assertAlmostEqual(event.packet[SUT.storm_eta_field_name], 16 * 60)
+
+    def test_packet_without_strike(self):
+        mock_engine = mock.Mock()
+        config_dict = {}
+        SUT = user.lightning.Lightning(mock_engine, config_dict)
+
+        event = weewx.NEW_LOOP_PACKET()
+        event.packet = {
+            'dateTime': int(time.time()),
+        }
+        SUT.new_loop_packet(event)
+
+        self.assertIsNone(event.packet[SUT.storm_speed_field_name])
+        self.assertIsNone(event.packet[SUT.storm_eta_field_name])
+
+def send_strike(SUT, date_time, distance):
+    event = weewx.NEW_LOOP_PACKET()
+    event.packet = {
+        'dateTime': date_time,
+        'lightning_distance': distance,
+    }
+    SUT.new_loop_packet(event)
+    return event.packet
+
+class TestArchivePeriod(unittest.TestCase):
+    def setUp(self):
+        mock_engine = mock.Mock()
+        config_dict = {'StdArchive': {'archive_interval': 300}}
+        self.SUT = user.lightning.Lightning(mock_engine, config_dict)
+        self.period_start = int(time.time()) // 300 * 300
+
+    def test_no_pre_loop_reset(self):
+        self.assertNotIn(weewx.PRE_LOOP, [call[0][0] for call in self.SUT.engine.bind.call_args_list])
+
+    def test_same_period(self):
+        send_strike(self.SUT, self.period_start + 10, 5)
+
+        packet = send_strike(self.SUT, self.period_start + 300, 20)
+
+        self.assertEqual(packet[self.SUT.first_distance_field_name], 5)
+        self.assertEqual(packet[self.SUT.min_distance_field_name], 5)
+        self.assertEqual(packet[self.SUT.max_distance_field_name], 20)
+
+    def test_new_period(self):
+        send_strike(self.SUT, self.period_start + 10, 5)
+
+        packet = send_strike(self.SUT, self.period_start + 310, 20)
+
+        self.assertEqual(packet[self.SUT.first_distance_field_name], 20)
+        self.assertEqual(packet[self.SUT.first_det_time_field_name], self.period_start + 310)
+        self.assertEqual(packet[self.SUT.min_distance_field_name], 20)
+
+    def test_packet_without_strike_starts_new_period(self):
+        send_strike(self.SUT, self.period_start + 10, 5)
+
+        event = weewx.NEW_LOOP_PACKET()
+        event.packet = {'dateTime': self.period_start + 310}
+        self.SUT.new_loop_packet(event)
+
+        self.assertIsNone(self.SUT.min_lightning_distance)
+
+    def test_interval_from_archive_record(self):
+        event = weewx.NEW_ARCHIVE_RECORD()
+        event.record = {'dateTime': self.period_start, 'interval': 10}
+        self.SUT.new_archive_record(event)
+        period_start = self.period_start // 600 * 600
+        send_strike(self.SUT, period_start + 10, 5)
+
+        packet = send_strike(self.SUT, period_start + 310, 20)
+
+        self.assertEqual(packet[self.SUT.first_distance_field_name], 5)
+
+    def test_earlier_packet(self):
+        send_strike(self.SUT, self.period_start + 310, 5)
+
+        packet = send_strike(self.SUT, self.period_start + 200, 20)
+
+        self.assertEqual(packet[self.SUT.first_distance_field_name], 5)
+
+class TestStateFile(unittest.TestCase):
+    def setUp(self):
+        self.weewx_root = tempfile.mkdtemp()
+        self.config_dict = {
+            'WEEWX_ROOT': self.weewx_root,
+            'StdArchive': {'archive_interval': 300},
+            'Lightning': {'state_file': 'lightning.json'},
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.weewx_root)
+
+    def test_restart_in_period(self):
+        now = int(time.time())
+        SUT = user.lightning.Lightning(mock.Mock(), self.config_dict)
+        send_strike(SUT, now, 12)
+        SUT.shutDown()
+
+        SUT = user.lightning.Lightning(mock.Mock(), self.config_dict)
+        SUT.shutDown()
+
+        self.assertEqual(SUT.period_start, now // 300 * 300 if now % 300 else now - 300)
+        self.assertEqual(SUT.min_lightning_distance, 12)
+        self.assertEqual(SUT.min_lightning_time, now)
+
+    def test_restart_in_later_period(self):
+        now = int(time.time())
+        SUT = user.lightning.Lightning(mock.Mock(), self.config_dict)
+        send_strike(SUT, now - 600, 12)
+        SUT.shutDown()
+
+        SUT = user.lightning.Lightning(mock.Mock(), self.config_dict)
+        SUT.shutDown()
+
+        self.assertTrue(os.path.exists(os.path.join(self.weewx_root, 'lightning.json')))
+        self.assertIsNone(SUT.period_start)
+        self.assertIsNone(SUT.min_lightning_distance)
+
+    def test_saved_on_shutdown(self):
+        SUT = user.lightning.Lightning(mock.Mock(), self.config_dict)
+        with mock.patch.object(user.lightning, 'write_state') as write_state:
+            for i in range(random.randint(2, 10)):
+                send_strike(SUT, int(time.time()) + i, 12)
+            write_state.assert_not_called()
+
+            SUT.shutDown()
+            write_state.assert_called_once()
+
+    def test_unreadable_state_file(self):
+        with open(os.path.join(self.weewx_root, 'lightning.json'), 'w', encoding='utf-8') as file_ptr:
+            file_ptr.write('{')
+
+        SUT = user.lightning.Lightning(mock.Mock(), self.config_dict)
+        SUT.shutDown()
+
+        self.assertIsNone(SUT.min_lightning_distance)
+
 if __name__ == '__main__':
     unittest.main(exit=False)
@@ -7,6 +7,9 @@
 # pylint: disable=invalid-name
 
 import random
+import shutil
+import statistics
+import tempfile
 import time
 
 import unittest
@@ -14,6 +17,8 @@ import mock
 
 import user.observationtime
 import weewx
+import weewx.manager
+from weeutil.weeutil import startOfDay, TimeSpan
 
 types = {
     'last': {
@@ -52,122 +57,636 @@ def config_observation(observation_name, observation_types):
         observations[observation_name][observation_type]['observation_time_name'] = types[observation_type]['observation_time_name']
     return observations[observation_name]
 
-def set_prior_value(observation_configuration, observation_types, prior_value, prior_time):
-    for observation_type in observation_types:
-        observation_configuration[observation_type]['observation'] = prior_value
-        observation_configuration[observation_type]['observation_time'] = prior_time
+def create_service(observation_name, observation_types):
+    mock_engine = mock.Mock()
+    config_dict = {
+        'StdArchive': {
+            'archive_interval': 300
+        },
+        'ObservationTime': {
+            'observations': {
+                observation_name: config_observation(observation_name, observation_types)
+            }
+        }
+    }
+    return user.observationtime.ObservationTime(mock_engine, config_dict)
+
+def send_loop_packet(SUT, observation_name, packet_time, value):
+    event = weewx.NEW_LOOP_PACKET()
+    event.packet = {
+        'dateTime': packet_time,
+        observation_name: value,
+    }
+    SUT.new_loop_packet(event)
+
+def send_archive_record(SUT, record_time):
+    event = weewx.NEW_ARCHIVE_RECORD()
+    event.record = {
+        'dateTime': record_time,
+        'interval': 5,
+    }
+    SUT.new_archive_record(event)
+    return event.record
 
 class TestFirstLoopPacket(unittest.TestCase):
+    def setUp(self):
+        self.archive_time = int(time.time()) // 300 * 300
+        self.observation_name = 'observation'
+        self.observation_types = ['last', 'first', 'min', 'max']
+
+    def tearDown(self):
+        weewx.xtypes.xtypes.remove(self.SUT.observation_time_xtype)
+
     def test_first_packet(self):
-        observation_name = 'observation'
-        observation_types = ['last', 'first', 'min', 'max']
-        mock_engine = mock.Mock()
-        config_dict = {
-            'ObservationTime': {
-                'observations': {
-                    observation_name: config_observation(observation_name, observation_types)
-                }
-            }
-        }
+        current_time = self.archive_time - 10
+        current_value = random.randint(1, 50)
+
+        self.SUT = create_service(self.observation_name, self.observation_types)
+        send_loop_packet(self.SUT, self.observation_name, current_time, current_value)
+        record = send_archive_record(self.SUT, self.archive_time)
+
+        self.assertEqual(record[last_value_field_name], current_value)
+        self.assertEqual(record[last_time_field_name], current_time)
+        self.assertEqual(record[first_value_field_name], current_value)
+        self.assertEqual(record[first_time_field_name], current_time)
+        self.assertEqual(record[min_value_field_name], current_value)
+        self.assertEqual(record[min_time_field_name], current_time)
+        self.assertEqual(record[max_value_field_name], current_value)
+        self.assertEqual(record[max_time_field_name], current_time)
+
+    def test_new_min_value(self):
+        current_time = self.archive_time - 10
+        current_value = random.randint(1, 50)
+
+        prior_value = current_value + random.randint(1, 50)
+        prior_time = self.archive_time - 60
+
+        self.SUT = create_service(self.observation_name, self.observation_types)
+        send_loop_packet(self.SUT, self.observation_name, prior_time, prior_value)
+        send_loop_packet(self.SUT, self.observation_name, current_time, current_value)
+        record = send_archive_record(self.SUT, self.archive_time)
 
-        current_time = int(time.time())
+        self.assertEqual(record[last_value_field_name], current_value)
+        self.assertEqual(record[last_time_field_name], current_time)
+        self.assertEqual(record[first_value_field_name], prior_value)
+        self.assertEqual(record[first_time_field_name], prior_time)
+        self.assertEqual(record[min_value_field_name], current_value)
+        self.assertEqual(record[min_time_field_name], current_time)
+        self.assertEqual(record[max_value_field_name], prior_value)
+        self.assertEqual(record[max_time_field_name], prior_time)
+
+    def test_new_max_value(self):
+        current_time = self.archive_time - 10
         current_value = random.randint(1, 50)
 
-        prior_value = None
-        prior_time = None
+        prior_value = current_value - random.randint(1, 50)
+        prior_time = self.archive_time - 60
 
-        SUT = user.observationtime.ObservationTime(mock_engine, config_dict)
-        set_prior_value(SUT.observations[observation_name], observation_types, prior_value, prior_time)
+        self.SUT = create_service(self.observation_name, self.observation_types)
+        send_loop_packet(self.SUT, self.observation_name, prior_time, prior_value)
+        send_loop_packet(self.SUT, self.observation_name, current_time, current_value)
+        record = send_archive_record(self.SUT, self.archive_time)
+
+        self.assertEqual(record[last_value_field_name], current_value)
+        self.assertEqual(record[last_time_field_name], current_time)
+        self.assertEqual(record[first_value_field_name], prior_value)
+        self.assertEqual(record[first_time_field_name], prior_time)
+        self.assertEqual(record[min_value_field_name], prior_value)
+        self.assertEqual(record[min_time_field_name], prior_time)
+        self.assertEqual(record[max_value_field_name], current_value)
+        self.assertEqual(record[max_time_field_name], current_time)
+
+    def test_packet_after_archive_period(self):
+        current_value = random.randint(1, 50)
+        next_value = random.randint(1, 50)
+
+        self.SUT = create_service(self.observation_name, self.observation_types)
+        send_loop_packet(self.SUT, self.observation_name, self.archive_time, current_value)
+        send_loop_packet(self.SUT, self.observation_name, self.archive_time + 2, next_value)
+        record = send_archive_record(self.SUT, self.archive_time)
+
+        self.assertEqual(record[last_value_field_name], current_value)
+        self.assertEqual(record[last_time_field_name], self.archive_time)
+
+        record = send_archive_record(self.SUT, self.archive_time + 300)
+
+        self.assertEqual(record[first_value_field_name], next_value)
+        self.assertEqual(record[first_time_field_name], self.archive_time + 2)
+
+    def test_no_packets(self):
+        self.SUT = create_service(self.observation_name, self.observation_types)
+        record = send_archive_record(self.SUT, self.archive_time)
+
+        self.assertNotIn(last_value_field_name, record)
+        self.assertNotIn(last_time_field_name, record)
 
-        event = weewx.NEW_LOOP_PACKET()
-        event.packet = {
-            'dateTime': current_time,
-            observation_name: current_value,
+class TestObservationTimeXtype(unittest.TestCase):
+    def setUp(self):
+        self.sqlite_root = tempfile.mkdtemp()
+        schema = [('dateTime', 'INTEGER NOT NULL UNIQUE PRIMARY KEY'),
+                  ('usUnits', 'INTEGER NOT NULL'),
+                  ('interval', 'INTEGER NOT NULL')]
+        for observation_type in types.values():
+            schema.append((observation_type['observation_name'], 'REAL'))
+            schema.append((observation_type['observation_time_name'], 'INTEGER'))
+        database_dict = {
+            'driver': 'weedb.sqlite',
+            'database_name': 'archive.sdb',
+            'SQLITE_ROOT': self.sqlite_root,
         }
-        SUT.new_loop_packet(event)
+        self.db_manager = weewx.manager.Manager.open_with_create(database_dict, schema=schema)
 
-        self.assertEqual(event.packet[last_value_field_name], current_value)
-        self.assertEqual(event.packet[last_time_field_name], current_time)
-        self.assertEqual(event.packet[first_value_field_name], current_value)
-        self.assertEqual(event.packet[first_time_field_name], current_time)
-        self.assertEqual(event.packet[min_value_field_name], current_value)
-        self.assertEqual(event.packet[min_time_field_name], current_time)
-        self.assertEqual(event.packet[max_value_field_name], current_value)
-        self.assertEqual(event.packet[max_time_field_name], current_time)
+        self.start = int(time.time()) // 300 * 300 - 3600
+        # value, time of the value
+        for i, value in enumerate([5.0, 2.0, 9.0, 2.0, 4.0]):
+            record = {
+                'dateTime': self.start + (i + 1) * 300,
+                'usUnits': weewx.US,
+                'interval': 5,
+            }
+            for observation_type in types.values():
+                record[observation_type['observation_name']] = value
+                record[observation_type['observation_time_name']] = record['dateTime'] - 10
+            self.db_manager.addRecord(record)
 
-    def test_new_min_value(self):
-        observation_name = 'observation'
-        observation_types = ['last', 'first', 'min', 'max']
+        observations = {'observation': config_observation('observation', ['last', 'first', 'min', 'max'])}
+        self.SUT = user.observationtime.ObservationTimeXtype(observations)
+
+    def tearDown(self):
+        self.db_manager.close()
+        shutil.rmtree(self.sqlite_root)
+
+    def test_aggregates(self):
+        timespan = TimeSpan(self.start, self.start + 3600)
+
+        self.assertEqual(self.SUT.get_aggregate(first_time_field_name, timespan, 'first', self.db_manager)[0],
+                         self.start + 300 - 10)
+        self.assertEqual(self.SUT.get_aggregate(last_time_field_name, timespan, 'last', self.db_manager)[0],
+                         self.start + 1500 - 10)
+        # ties go to the later record
+        self.assertEqual(self.SUT.get_aggregate(min_time_field_name, timespan, 'min', self.db_manager)[0],
+                         self.start + 1200 - 10)
+        self.assertEqual(self.SUT.get_aggregate(max_time_field_name, timespan, 'max', self.db_manager)[0],
+                         self.start + 900 - 10)
+
+    def test_one_query_per_timespan(self):
+        timespan = TimeSpan(self.start, self.start + 3600)
+
+        with mock.patch.object(self.db_manager, 'genSql', wraps=self.db_manager.genSql) as gen_sql:
+            for observation_type in ['first', 'last', 'min', 'max']:
+                self.SUT.get_aggregate(types[observation_type]['observation_time_name'], timespan, observation_type, self.db_manager)
+            self.assertEqual(gen_sql.call_count, 1)
+
+    def test_invalidate(self):
+        timespan = TimeSpan(self.start, self.start + 3600)
+        other_timespan = TimeSpan(self.start - 3600, self.start)
+        self.SUT.get_aggregate(last_time_field_name, timespan, 'last', self.db_manager)
+        self.SUT.get_aggregate(last_time_field_name, other_timespan, 'last', self.db_manager)
+
+        self.SUT.invalidate(self.start + 1800)
+
+        self.assertEqual(len(self.SUT.memoized), 1)
+
+    def test_empty_timespan(self):
+        timespan = TimeSpan(self.start - 3600, self.start)
+
+        self.assertIsNone(self.SUT.get_aggregate(last_time_field_name, timespan, 'last', self.db_manager)[0])
+
+    def test_unknown_aggregation(self):
+        timespan = TimeSpan(self.start, self.start + 3600)
+
+        self.assertRaises(weewx.UnknownAggregation,
+                          self.SUT.get_aggregate, last_time_field_name, timespan, 'min', self.db_manager)
+
+def create_database(sqlite_root):
+    schema = [('dateTime', 'INTEGER NOT NULL UNIQUE PRIMARY KEY'),
+              ('usUnits', 'INTEGER NOT NULL'),
+              ('interval', 'INTEGER NOT NULL')]
+    for observation_type in types.values():
+        schema.append((observation_type['observation_name'], 'REAL'))
+        schema.append((observation_type['observation_time_name'], 'INTEGER'))
+    database_dict = {
+        'driver': 'weedb.sqlite',
+        'database_name': 'archive.sdb',
+        'SQLITE_ROOT': sqlite_root,
+    }
+    return weewx.manager.Manager.open_with_create(database_dict, schema=schema)
+
+def create_hourly_records(start, stop):
+    records = []
+    record_time = start + 3600
+    while record_time <= stop:
+        record = {
+            'dateTime': record_time,
+            'usUnits': weewx.US,
+            'interval': 60,
+        }
+        value = round(random.uniform(0, 100), 1)
+        for observation_type in types.values():
+            record[observation_type['observation_name']] = value
+            record[observation_type['observation_time_name']] = record_time - random.randint(1, 3599)
+        records.append(record)
+        record_time += 3600
+    return records
+
+class TestDaySummaries(unittest.TestCase):
+    def setUp(self):
+        self.sqlite_root = tempfile.mkdtemp()
+        self.db_manager = create_database(self.sqlite_root)
+
+        self.observations = {'observation': config_observation('observation', ['last', 'first', 'min', 'max'])}
+        self.start = startOfDay(int(time.time())) - 10 * 24 * 3600
+        self.stop = self.start + 5 * 24 * 3600
+        self.records = create_hourly_records(self.start, self.stop)
+
+    def tearDown(self):
+        self.db_manager.close()
+        shutil.rmtree(self.sqlite_root)
+
+    def add_records(self, day_summaries=None):
+        for record in self.records:
+            self.db_manager.addRecord(record)
+            if day_summaries:
+                day_summaries.update(dict(record))
+
+    def archive_aggregates(self, timespan):
+        xtype = user.observationtime.ObservationTimeXtype(self.observations)
+        return {observation_type: xtype.get_aggregate(types[observation_type]['observation_time_name'],
+                                                      timespan, observation_type, self.db_manager)[0]
+                for observation_type in types}
+
+    def assert_day_summaries_match_archive(self):
+        # Timespans that start and end in the middle of days, and on day boundaries
+        timespans = [TimeSpan(self.start, self.stop),
+                     TimeSpan(self.start + 5 * 3600, self.stop - 7 * 3600),
+                     TimeSpan(self.start + 24 * 3600, self.stop - 11 * 3600)]
+        SUT = user.observationtime.ObservationTimeXtype(self.observations, use_day_summaries=True)
+        for timespan in timespans:
+            expected = self.archive_aggregates(timespan)
+            for observation_type in types:
+                self.assertEqual(SUT.get_aggregate(types[observation_type]['observation_time_name'],
+                                                   timespan, observation_type, self.db_manager)[0],
+                                 expected[observation_type])
+
+    def test_update(self):
+        day_summaries = user.observationtime.DaySummaries(self.db_manager, self.observations)
+        self.add_records(day_summaries)
+
+        rows = list(self.db_manager.genSql("SELECT dateTime FROM observationtime_day;"))
+        self.assertEqual(len(rows), 5 * len(types))
+        self.assert_day_summaries_match_archive()
+
+    def test_backfill(self):
+        self.add_records()
+        day_summaries = user.observationtime.DaySummaries(self.db_manager, self.observations)
+
+        days = day_summaries.backfill(batch_days=2)
+
+        self.assertEqual(days, 5)
+        self.assert_day_summaries_match_archive()
+
+    def test_long_timespan_uses_day_table(self):
+        day_summaries = user.observationtime.DaySummaries(self.db_manager, self.observations)
+        self.add_records(day_summaries)
+        SUT = user.observationtime.ObservationTimeXtype(self.observations, use_day_summaries=True)
+        timespan = TimeSpan(self.start + 5 * 3600, self.stop - 7 * 3600)
+
+        with mock.patch.object(self.db_manager, 'genSql', wraps=self.db_manager.genSql) as gen_sql:
+            SUT.get_aggregate(last_time_field_name, timespan, 'last', self.db_manager)
+            sql_stmts = [call[0][0] for call in gen_sql.call_args_list]
+
+        self.assertEqual(len(sql_stmts), 3)
+        self.assertTrue(any('observationtime_day' in sql_stmt for sql_stmt in sql_stmts))
+
+    def test_missing_day_table(self):
+        self.add_records()
+        SUT = user.observationtime.ObservationTimeXtype(self.observations, use_day_summaries=True)
+        timespan = TimeSpan(self.start, self.stop)
+
+        self.assertEqual(SUT.get_aggregate(last_time_field_name, timespan, 'last', self.db_manager)[0],
+                         self.records[-1][last_time_field_name])
+
+class TestObservationTimeSeries(unittest.TestCase):
+    def setUp(self):
+        self.sqlite_root = tempfile.mkdtemp()
+        self.db_manager = create_database(self.sqlite_root)
+
+        self.observations = {'observation': config_observation('observation', ['last', 'first', 'min', 'max'])}
+        self.start = startOfDay(int(time.time())) - 10 * 24 * 3600
+        self.stop = self.start + 5 * 24 * 3600
+        self.records = create_hourly_records(self.start, self.stop)
+        # A record missing the observation
+        for observation_type in types.values():
+            self.records[30][observation_type['observation_name']] = None
+            self.records[30][observation_type['observation_time_name']] = None
+        for record in self.records:
+            self.db_manager.addRecord(record)
+        # The manager only tracks the first and last timestamps once the table has data.
+        self.db_manager.first_timestamp = self.db_manager.firstGoodStamp()
+        self.db_manager.last_timestamp = self.db_manager.lastGoodStamp()
+
+        self.SUT = user.observationtime.ObservationTimeXtype(self.observations)
+
+    def tearDown(self):
+        self.db_manager.close()
+        shutil.rmtree(self.sqlite_root)
+
+    def test_series_matches_aggregates(self):
+        timespan = TimeSpan(self.start - 24 * 3600, self.stop + 24 * 3600)
+        aggregates_xtype = user.observationtime.ObservationTimeXtype(self.observations)
+
+        for observation_type in types:
+            obs_type = types[observation_type]['observation_time_name']
+            start_vec, stop_vec, data_vec = self.SUT.get_series(obs_type, timespan, self.db_manager,
+                                                                aggregate_type=observation_type,
+                                                                aggregate_interval='day')
+
+            self.assertEqual(start_vec[0][0], self.start)
+            self.assertEqual(stop_vec[0][-1], self.stop)
+            self.assertEqual(len(data_vec[0]), 5)
+            for i, bucket_start in enumerate(start_vec[0]):
+                self.assertEqual(data_vec[0][i],
+                                 aggregates_xtype.get_aggregate(obs_type, TimeSpan(bucket_start, stop_vec[0][i]),
+                                                                observation_type, self.db_manager)[0])
+
+    def test_one_query_per_series(self):
+        timespan = TimeSpan(self.start, self.stop)
+
+        with mock.patch.object(self.db_manager, 'genSql', wraps=self.db_manager.genSql) as gen_sql:
+            for observation_type in types:
+                _, _, data_vec = self.SUT.get_series(types[observation_type]['observation_time_name'], timespan,
+                                                     self.db_manager,
+                                                     aggregate_type=observation_type, aggregate_interval=3600)
+                # Like the archive series, the bucket ending at the first record is skipped
+                self.assertEqual(len(data_vec[0]), 5 * 24 - 1)
+            self.assertEqual(gen_sql.call_count, 1)
+
+        # The hour without the observation
+        self.assertIsNone(data_vec[0][29])
+        self.assertIsNotNone(data_vec[0][28])
+
+    def test_no_aggregation(self):
+        timespan = TimeSpan(self.start, self.stop)
+
+        self.assertRaises(weewx.UnknownAggregation,
+                          self.SUT.get_series, last_time_field_name, timespan, self.db_manager)
+
+class TestIndexes(unittest.TestCase):
+    def setUp(self):
+        self.sqlite_root = tempfile.mkdtemp()
+        self.db_manager = create_database(self.sqlite_root)
+        stop = startOfDay(int(time.time()))
+        self.db_manager.addRecord(create_hourly_records(stop - 2 * 24 * 3600, stop))
+
+        self.observations = {'observation': config_observation('observation', ['last', 'first', 'min', 'max'])}
+        self.index_names = {'observationtime_%s' % types[observation_type]['observation_name'] for observation_type in ['min', 'max']}
+
+    def tearDown(self):
+        self.db_manager.close()
+        shutil.rmtree(self.sqlite_root)
+
+    def create_service(self, indexes):
         mock_engine = mock.Mock()
+        mock_engine.db_binder.get_manager.return_value = self.db_manager
         config_dict = {
             'ObservationTime': {
-                'observations': {
-                    observation_name: config_observation(observation_name, observation_types)
-                }
+                'indexes': indexes,
+                'observations': self.observations,
             }
         }
+        SUT = user.observationtime.ObservationTime(mock_engine, config_dict)
+        SUT.shutDown()
+        return SUT
 
-        current_time = int(time.time())
-        current_value = random.randint(1, 50)
+    def test_verify(self):
+        missing_indexes = user.observationtime.manage_indexes(self.db_manager, self.observations, False)
 
-        prior_value = current_value + random.randint(1, 50)
-        prior_time = current_time - 60 * 60
+        self.assertEqual(set(missing_indexes), self.index_names)
+        self.assertFalse(self.index_names & user.observationtime.get_index_names(self.db_manager))
 
-        SUT = user.observationtime.ObservationTime(mock_engine, config_dict)
-        set_prior_value(SUT.observations[observation_name], observation_types, prior_value, prior_time)
+    def test_create(self):
+        missing_indexes = user.observationtime.manage_indexes(self.db_manager, self.observations, True)
 
-        event = weewx.NEW_LOOP_PACKET()
-        event.packet = {
-            'dateTime': current_time,
-            observation_name: current_value,
-        }
-        SUT.new_loop_packet(event)
+        self.assertEqual(missing_indexes, [])
+        self.assertEqual(self.index_names & user.observationtime.get_index_names(self.db_manager), self.index_names)
+        # A second time, the indexes exist
+        self.assertEqual(user.observationtime.manage_indexes(self.db_manager, self.observations, False), [])
 
-        self.assertEqual(event.packet[last_value_field_name], current_value)
-        self.assertEqual(event.packet[last_time_field_name], current_time)
-        self.assertEqual(event.packet[first_value_field_name], prior_value)
-        self.assertEqual(event.packet[first_time_field_name], prior_time)
-        self.assertEqual(event.packet[min_value_field_name], current_value)
-        self.assertEqual(event.packet[min_time_field_name], current_time)
-        self.assertEqual(event.packet[max_value_field_name], prior_value)
-        self.assertEqual(event.packet[max_time_field_name], prior_time)
+    def test_service_creates_indexes(self):
+        with mock.patch.object(user.observationtime, 'log') as mock_log:
+            self.create_service('create')
 
-    def test_new_max_value(self):
-        observation_name = 'observation'
-        observation_types = ['last', 'first', 'min', 'max']
+        self.assertEqual(self.index_names & user.observationtime.get_index_names(self.db_manager), self.index_names)
+        query_plans = [call for call in mock_log.info.call_args_list if call[0][0].startswith("Query plan")]
+        self.assertTrue(query_plans)
+
+    def test_indexed_aggregates(self):
+        user.observationtime.manage_indexes(self.db_manager, self.observations, True)
+        stop = self.db_manager.lastGoodStamp()
+        timespan = TimeSpan(stop - user.observationtime.INDEX_MIN_SPAN, stop)
+        expected = user.observationtime.ObservationTimeXtype(self.observations).get_aggregates('observation', timespan, self.db_manager)
+
+        SUT = user.observationtime.ObservationTimeXtype(self.observations, use_indexes=True)
+
+        self.assertIs(SUT.get_sql_stmts(timespan, self.db_manager), SUT.indexed_sql_stmts)
+        self.assertEqual(SUT.get_aggregates('observation', timespan, self.db_manager), expected)
+
+    def test_missing_indexes_not_used(self):
+        timespan = TimeSpan(0, user.observationtime.INDEX_MIN_SPAN)
+        SUT = user.observationtime.ObservationTimeXtype(self.observations, use_indexes=True)
+
+        self.assertIs(SUT.get_sql_stmts(timespan, self.db_manager), user.observationtime.SQL_STMTS)
+
+    def test_service_default_leaves_indexes(self):
+        self.create_service('none')
+
+        self.assertFalse(self.index_names & user.observationtime.get_index_names(self.db_manager))
+
+    def test_invalid_option(self):
+        self.assertRaises(ValueError, self.create_service, 'always')
+
+statistic_types = {
+    'count': {'observation_name': 'observation_count'},
+    'stddev': {'observation_name': 'observation_stddev'},
+    'p50': {'observation_name': 'observation_p50'},
+    'p90': {'observation_name': 'observation_p90'},
+    'p99': {'observation_name': 'observation_p99'},
+}
+
+def exact_percentile(values, quantile):
+    # The 'inclusive' quantiles interpolate between the closest ranks of (n - 1) * quantile
+    return statistics.quantiles(values, n=100, method='inclusive')[int(round(quantile * 100)) - 1]
+
+class TestStatistics(unittest.TestCase):
+    def test_running_stats(self):
+        values = [random.uniform(-50, 50) for _ in range(random.randint(2, 500))]
+        SUT = user.observationtime.RunningStats()
+        for value in values:
+            SUT.add(value)
+
+        self.assertEqual(SUT.count, len(values))
+        self.assertAlmostEqual(SUT.stddev(), statistics.stdev(values))
+
+    def test_running_stats_one_value(self):
+        SUT = user.observationtime.RunningStats()
+        SUT.add(random.uniform(-50, 50))
+
+        self.assertIsNone(SUT.stddev())
+
+    def test_percentile_few_values(self):
+        self.assertIsNone(user.observationtime.percentile([], 0.5))
+        self.assertEqual(user.observationtime.percentile([1.0, 2.0, 3.0], 0.5), 2.0)
+        self.assertEqual(user.observationtime.percentile([1.0, 2.0], 0.5), 1.5)
+
+    def test_quantiles_few_values(self):
+        SUT = user.observationtime.P2Quantiles([0.5, 0.9])
+        self.assertIsNone(SUT.value(0.5))
+
+        values = [random.uniform(0, 100) for _ in range(random.randint(1, 7))]
+        for value in values:
+            SUT.add(value)
+
+        for quantile in (0.5, 0.9):
+            self.assertAlmostEqual(SUT.value(quantile), user.observationtime.percentile(sorted(values), quantile))
+
+    def test_quantiles_estimate(self):
+        # Seeded, so that the estimates are repeatable
+        rng = random.Random(20)
+        values = [rng.gauss(20, 5) for _ in range(10000)]
+        SUT = user.observationtime.P2Quantiles(list(user.observationtime.PERCENTILES.values()))
+        for value in values:
+            SUT.add(value)
+
+        # The estimate is within a small fraction of the spread of the values
+        for quantile in user.observationtime.PERCENTILES.values():
+            self.assertAlmostEqual(SUT.value(quantile), exact_percentile(values, quantile), delta=1.0)
+
+    def test_one_quantile(self):
+        rng = random.Random(20)
+        values = [rng.gauss(20, 5) for _ in range(10000)]
+        SUT = user.observationtime.P2Quantiles([0.9])
+        for value in values:
+            SUT.add(value)
+
+        self.assertAlmostEqual(SUT.value(0.9), exact_percentile(values, 0.9), delta=1.0)
+
+    def test_quantiles_constant_memory(self):
+        SUT = user.observationtime.P2Quantiles(list(user.observationtime.PERCENTILES.values()))
+        for _ in range(1000):
+            SUT.add(random.uniform(0, 100))
+
+        self.assertEqual(len(SUT.heights), 2 * len(user.observationtime.PERCENTILES) + 3)
+
+class TestLoopStatistics(unittest.TestCase):
+    def setUp(self):
+        self.observation_name = 'observation'
         mock_engine = mock.Mock()
         config_dict = {
+            'StdArchive': {
+                'archive_interval': 300
+            },
             'ObservationTime': {
                 'observations': {
-                    observation_name: config_observation(observation_name, observation_types)
+                    self.observation_name: statistic_types
                 }
             }
         }
+        self.SUT = user.observationtime.ObservationTime(mock_engine, config_dict)
 
-        current_time = int(time.time())
-        current_value = random.randint(1, 50)
+    def tearDown(self):
+        self.SUT.shutDown()
 
-        prior_value = current_value - random.randint(1, 50)
-        prior_time = current_time - 60 * 60
+    def test_statistics(self):
+        archive_time = int(time.time()) // 300 * 300 + 300
+        values = [round(random.uniform(0, 100), 1) for _ in range(100)]
+        for i, value in enumerate(values):
+            send_loop_packet(self.SUT, self.observation_name, archive_time - 299 + i * 2, value)
 
-        SUT = user.observationtime.ObservationTime(mock_engine, config_dict)
-        set_prior_value(SUT.observations[observation_name], observation_types, prior_value, prior_time)
+        record = send_archive_record(self.SUT, archive_time)
+
+        self.assertEqual(record['observation_count'], len(values))
+        self.assertAlmostEqual(record['observation_stddev'], statistics.stdev(values))
+        for aggregate_type, quantile in user.observationtime.PERCENTILES.items():
+            self.assertAlmostEqual(record[statistic_types[aggregate_type]['observation_name']],
+                                   exact_percentile(values, quantile), delta=15)
+
+    def test_missing_observation(self):
+        archive_time = int(time.time()) // 300 * 300 + 300
+        send_loop_packet(self.SUT, 'other_observation', archive_time - 10, random.uniform(0, 100))
 
-        event = weewx.NEW_LOOP_PACKET()
-        event.packet = {
-            'dateTime': current_time,
-            observation_name: current_value,
+        record = send_archive_record(self.SUT, archive_time)
+
+        self.assertEqual(record['observation_count'], 0)
+        self.assertNotIn('observation_stddev', record)
+        self.assertNotIn('observation_p50', record)
+
+class TestXtypeStatistics(unittest.TestCase):
+    def setUp(self):
+        self.sqlite_root = tempfile.mkdtemp()
+        schema = [('dateTime', 'INTEGER NOT NULL UNIQUE PRIMARY KEY'),
+                  ('usUnits', 'INTEGER NOT NULL'),
+                  ('interval', 'INTEGER NOT NULL'),
+                  ('observation', 'REAL')]
+        database_dict = {
+            'driver': 'weedb.sqlite',
+            'database_name': 'archive.sdb',
+            'SQLITE_ROOT': self.sqlite_root,
         }
-        SUT.new_loop_packet(event)
-
-        self.assertEqual(event.packet[last_value_field_name], current_value)
-        self.assertEqual(event.packet[last_time_field_name], current_time)
-        self.assertEqual(event.packet[first_value_field_name], prior_value)
-        self.assertEqual(event.packet[first_time_field_name], prior_time)
-        self.assertEqual(event.packet[min_value_field_name], prior_value)
-        self.assertEqual(event.packet[min_time_field_name], prior_time)
-        self.assertEqual(event.packet[max_value_field_name], current_value)
-        self.assertEqual(event.packet[max_time_field_name], current_time)
+        self.db_manager = weewx.manager.Manager.open_with_create(database_dict, schema=schema)
+
+        self.start = int(time.time()) // 300 * 300 - 24 * 3600
+        self.values = [round(random.uniform(0, 100), 1) for _ in range(288)]
+        for i, value in enumerate(self.values):
+            self.db_manager.addRecord({'dateTime': self.start + (i + 1) * 300, 'usUnits': weewx.US, 'interval': 5,
+                                       'observation': value})
+
+        observations = {'observation': dict(statistic_types, last=types['last'])}
+        self.SUT = user.observationtime.ObservationTimeXtype(observations)
+
+    def tearDown(self):
+        self.db_manager.close()
+        shutil.rmtree(self.sqlite_root)
+
+    def test_statistics(self):
+        timespan = TimeSpan(self.start, self.start + 24 * 3600)
+
+        stddev = self.SUT.get_aggregate('observation', timespan, 'stddev', self.db_manager)
+        self.assertAlmostEqual(stddev[0], statistics.stdev(self.values))
+        for aggregate_type, quantile in user.observationtime.PERCENTILES.items():
+            self.assertAlmostEqual(self.SUT.get_aggregate('observation', timespan, aggregate_type, self.db_manager)[0],
+                                   exact_percentile(self.values, quantile))
+
+    def test_empty_timespan(self):
+        timespan = TimeSpan(self.start - 3600, self.start)
+
+        self.assertIsNone(self.SUT.get_aggregate('observation', timespan, 'stddev', self.db_manager)[0])
+        self.assertIsNone(self.SUT.get_aggregate('observation', timespan, 'p90', self.db_manager)[0])
+
+    def test_count_is_not_served(self):
+        timespan = TimeSpan(self.start, self.start + 24 * 3600)
+
+        self.assertRaises(weewx.UnknownType, self.SUT.get_aggregate, 'observation', timespan, 'count', self.db_manager)
+
+    def test_queries_per_timespan(self):
+        timespan = TimeSpan(self.start, self.start + 24 * 3600)
+
+        with mock.patch.object(self.db_manager, 'genSql', wraps=self.db_manager.genSql) as gen_sql, \
+             mock.patch.object(self.db_manager, 'getSql', wraps=self.db_manager.getSql) as get_sql:
+            for aggregate_type in user.observationtime.XTYPE_STATISTIC_TYPES:
+                self.SUT.get_aggregate('observation', timespan, aggregate_type, self.db_manager)
+            self.assertEqual(get_sql.call_count, 1)
+            self.assertEqual(gen_sql.call_count, 1)
+
+    def test_long_timespan(self):
+        SUT = user.observationtime.ObservationTimeXtype({'observation': statistic_types}, statistics_max_span=3600)
+        timespan = TimeSpan(self.start, self.start + 24 * 3600)
+
+        self.assertRaises(weewx.UnknownAggregation, SUT.get_aggregate, 'observation', timespan, 'p90', self.db_manager)
+
+    def test_other_aggregation(self):
+        timespan = TimeSpan(self.start, self.start + 24 * 3600)
+
+        self.assertRaises(weewx.UnknownType, self.SUT.get_aggregate, 'observation', timespan, 'avg', self.db_manager)
 
 if __name__ == '__main__':
     unittest.main(exit=False)
@@ -0,0 +1,64 @@
+#
+#    Copyright (c) 2024 Rich Bell <bellrichm@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+# pylint: disable=missing-docstring
+# pylint: disable=invalid-name
+
+import os
+import random
+import shutil
+import tempfile
+
+import unittest
+
+import user.statefile
+
+class TestStateFile(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.directory, 'state.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        state = {'value': random.uniform(0, 100), 'time': random.randint(1, 2**31), 'none': None}
+
+        user.statefile.write_state(self.state_file, state)
+
+        self.assertEqual(user.statefile.read_state(self.state_file), state)
+        self.assertEqual(os.listdir(self.directory), ['state.json'])
+
+    def test_missing_file(self):
+        self.assertEqual(user.statefile.read_state(self.state_file), {})
+
+    def test_unreadable_file(self):
+        with open(self.state_file, 'w', encoding='utf-8') as file_ptr:
+            file_ptr.write('{')
+
+        self.assertEqual(user.statefile.read_state(self.state_file), {})
+
+    def test_thread_writes_newest_state(self):
+        SUT = user.statefile.StateThread(self.state_file)
+        states = [{'value': i} for i in range(random.randint(1, 10))]
+        for state in states:
+            SUT.save(state)
+        SUT.start()
+        SUT.stop()
+
+        self.assertFalse(SUT.is_alive())
+        self.assertEqual(user.statefile.read_state(self.state_file), states[-1])
+
+    def test_thread_prepares_state(self):
+        SUT = user.statefile.StateThread(self.state_file, prepare=lambda state: {'values': list(state)})
+        value = random.randint(1, 100)
+        SUT.start()
+        SUT.save((value,))
+        SUT.stop()
+
+        self.assertEqual(user.statefile.read_state(self.state_file), {'values': [value]})
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
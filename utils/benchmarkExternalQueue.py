@@ -0,0 +1,182 @@
+#
+#    Copyright (c) 2020-2021 Rich Bell <bellrichm@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+"""
+Benchmarks for user.externalqueue.
+
+Run from the repository root:
+    PYTHONPATH=bin python utils/benchmarkExternalQueue.py
+"""
+
+import json
+import random
+import shutil
+import tempfile
+import time
+import timeit
+
+import weewx
+import weewx.manager
+
+from user.externalqueue import ExternalQueue, INSERT_SQL
+from user.queuerecord import decode_packed, delta_record, encode_packed
+
+ITERATIONS = 10000
+PACKETS = 2000
+FIELD_COUNT = 30
+
+class Engine(object):
+    """ Just enough of an engine to create a service. """
+    def __init__(self, config_dict):
+        self.config_dict = config_dict
+        self.db_binder = self
+
+    def bind(self, event_type, callback):
+        """ Events are not dispatched by the benchmarks. """
+
+    def get_manager(self, data_binding, initialize):
+        """ Open the queue database. """
+        return weewx.manager.open_manager_with_config(self.config_dict, data_binding, initialize)
+
+def build_config(sqlite_root, service_dict=None):
+    """ The ExternalQueue configuration, with the queue in sqlite_root. """
+    return {
+        'WEEWX_ROOT': sqlite_root,
+        'ExternalQueue': service_dict or {},
+        'DataBindings': {'ext_queue_binding': {'database': 'ext_queue_sqlite',
+                                               'table_name': 'archive',
+                                               'manager': 'weewx.manager.Manager',
+                                               'schema': 'user.externalqueue.schema'}},
+        'Databases': {'ext_queue_sqlite': {'database_name': 'ext_queue.sdb', 'database_type': 'SQLite'}},
+        'DatabaseTypes': {'SQLite': {'driver': 'weedb.sqlite', 'SQLITE_ROOT': sqlite_root}},
+    }
+
+def build_packets(field_count=FIELD_COUNT):
+    """ Loop packets of field_count random observations. """
+    packets = []
+    start = int(time.time())
+    for i in range(PACKETS):
+        packet = {'dateTime': start + i, 'usUnits': weewx.US}
+        for j in range(field_count):
+            packet['observation%i' % j] = random.uniform(0, 100)
+        packets.append(packet)
+    return packets
+
+def benchmark_writer():
+    """ Compare one INSERT per packet on the engine thread with the group commit writer thread. """
+    print("%i loop packets of %i fields (microseconds per packet on the engine thread)" % (PACKETS, FIELD_COUNT))
+    packets = build_packets()
+
+    sqlite_root = tempfile.mkdtemp()
+    try:
+        config_dict = build_config(sqlite_root)
+        db_manager = Engine(config_dict).get_manager('ext_queue_binding', True)
+        db_manager.getSql("PRAGMA journal_mode=WAL;")
+        start = time.time()
+        for packet in packets:
+            db_manager.getSql(INSERT_SQL % db_manager.table_name, [packet['dateTime'], 0, 0, 'loop', json.dumps(packet)])
+        synchronous_time = (time.time() - start) / PACKETS * 1000000
+        db_manager.close()
+    finally:
+        shutil.rmtree(sqlite_root)
+
+    print("  INSERT per packet: %8.2f" % synchronous_time)
+
+    for batch_size in (10, 50, 200):
+        sqlite_root = tempfile.mkdtemp()
+        try:
+            config_dict = build_config(sqlite_root, {'batch_size': batch_size, 'queue_size': PACKETS})
+            service = ExternalQueue(Engine(config_dict), config_dict)
+            writer = service.writer
+            start = time.time()
+            for packet in packets:
+                service.new_loop_packet(weewx.Event(weewx.NEW_LOOP_PACKET, packet=packet))
+            queued_time = (time.time() - start) / PACKETS * 1000000
+            start = time.time()
+            service.shutDown()
+            flush_time = (time.time() - start) * 1000
+        finally:
+            shutil.rmtree(sqlite_root)
+
+        metrics = writer.metrics.as_dict()
+        print("  batch_size %3i: %8.2f queued, %8.2f ms to flush on shutDown, %i batches, average %.1f rows, dropped %i"
+              % (batch_size, queued_time, flush_time, metrics['batches'], metrics['average_batch'], metrics['dropped']))
+
+def benchmark_encoding():
+    """ Compare the size, encode, and decode time of the json and packed encodings. """
+    print("Encoding a loop packet (bytes per row, microseconds per encode and decode)")
+    for field_count in (10, 30, 80):
+        packet = build_packets(field_count)[0]
+        # Loop packets are mostly whole numbers and values with a decimal or two.
+        for name in packet:
+            if name.startswith('observation'):
+                packet[name] = round(packet[name], random.randint(0, 2))
+        field_ids = {name: i for i, name in enumerate(packet)}
+        field_names = {i: name for name, i in field_ids.items()}
+
+        results = []
+        data = json.dumps(packet)
+        results.append(('json', len(data),
+                        min(timeit.repeat(lambda: json.dumps(packet), number=ITERATIONS, repeat=5)),
+                        min(timeit.repeat(lambda: json.loads(data), number=ITERATIONS, repeat=5))))
+        for compress in (False, True):
+            data = encode_packed(packet, field_ids, compress)
+            results.append(('packed+zlib' if compress else 'packed', len(data),
+                            min(timeit.repeat(lambda: encode_packed(packet, field_ids, compress), number=ITERATIONS, repeat=5)),
+                            min(timeit.repeat(lambda: decode_packed(data, field_names), number=ITERATIONS, repeat=5))))
+
+        for name, size, encode_time, decode_time in results:
+            print("  %2i fields %-11s: %5i bytes, %6.2f encode, %6.2f decode"
+                  % (field_count, name, size, encode_time / ITERATIONS * 1000000, decode_time / ITERATIONS * 1000000))
+
+def benchmark_delta():
+    """ The bytes stored per loop packet, without and with deltas, when 10 of 80 fields change each packet. """
+    print("Delta encoded loop packets, 80 fields, 10 changing (average bytes per row)")
+    packet = build_packets(80)[0]
+    names = [name for name in packet if name.startswith('observation')]
+    packets = []
+    for i in range(PACKETS):
+        packet = dict(packet)
+        packet['dateTime'] += 2
+        for name in random.sample(names, 10):
+            packet[name] = round(random.uniform(0, 100), 1)
+        packets.append(packet)
+    field_ids = {name: i for i, name in enumerate(list(packet) + ['_removed'])}
+
+    for keyframe_interval in (1, 10, 30, 100):
+        sizes = {'json': 0, 'packed': 0}
+        previous = None
+        for i, packet in enumerate(packets):
+            record = packet if previous is None or i % keyframe_interval == 0 else delta_record(previous, packet)
+            previous = packet
+            sizes['json'] += len(json.dumps(record))
+            sizes['packed'] += len(encode_packed(record, field_ids))
+        print("  keyframe_interval %3i: %6.0f json, %6.0f packed"
+              % (keyframe_interval, float(sizes['json']) / PACKETS, float(sizes['packed']) / PACKETS))
+
+def benchmark_backends():
+    """ The sustained rate of the sqlite and segmentlog backends, from the first packet queued until all are written. """
+    print("Sustained packets per second, %i packets of %i fields" % (PACKETS * 10, FIELD_COUNT))
+    packets = build_packets() * 10
+    for backend in ('sqlite', 'segmentlog'):
+        for batch_size in (50, 500):
+            sqlite_root = tempfile.mkdtemp()
+            try:
+                config_dict = build_config(sqlite_root, {'backend': backend, 'batch_size': batch_size, 'queue_size': len(packets)})
+                service = ExternalQueue(Engine(config_dict), config_dict)
+                start = time.time()
+                for packet in packets:
+                    service.new_loop_packet(weewx.Event(weewx.NEW_LOOP_PACKET, packet=packet))
+                service.shutDown()
+                elapsed = time.time() - start
+            finally:
+                shutil.rmtree(sqlite_root)
+            print("  %-10s batch_size %3i: %8.0f" % (backend, batch_size, len(packets) / elapsed))
+
+if __name__ == "__main__":
+    benchmark_writer()
+    benchmark_backends()
+    benchmark_encoding()
+    benchmark_delta()
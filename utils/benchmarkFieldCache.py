@@ -0,0 +1,163 @@
+#
+#    Copyright (c) 2020-2021 Rich Bell <bellrichm@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+"""
+Benchmarks for user.fieldcache.
+
+Run from the repository root:
+    PYTHONPATH=bin python utils/benchmarkFieldCache.py
+"""
+
+import shutil
+import tempfile
+import time
+import timeit
+
+import configobj
+import weewx
+
+from user.fieldcache import Cache, FieldCache
+
+ITERATIONS = 10000
+
+class Engine(object):
+    """ Just enough of an engine to create a service. """
+    def bind(self, event_type, callback):
+        """ Events are not dispatched by the benchmarks. """
+
+class DictCache(object):
+    """ The dict of dicts cache and per field record handling that Cache replaced, kept as the baseline. """
+    def __init__(self, unit_system):
+        self.unit_system = unit_system
+        self.cached_values = {}
+
+    def get_value(self, key, timestamp, expires_after):
+        """ Get the cached value. """
+        if key in self.cached_values and \
+            (expires_after is None or timestamp - self.cached_values[key]['timestamp'] < expires_after):
+            return self.cached_values[key]['value']
+
+        return None
+
+    def update_value(self, key, value, unit_system, timestamp):
+        """ Update the cached value. """
+        if unit_system != self.unit_system:
+            raise ValueError("Unit system does not match unit system of the cache. %s vs %s"
+                             % (unit_system, self.unit_system))
+        self.cached_values[key] = {}
+        self.cached_values[key]['value'] = value
+        self.cached_values[key]['timestamp'] = timestamp
+
+    def update_record(self, record, fields):
+        """ The original FieldCache.new_archive_record loop. """
+        target_data = {}
+        for field in fields:
+            if field in record:
+                self.update_value(field, record[field], record['usUnits'], time.time())
+            else:
+                target_data[field] = self.get_value(field, time.time(), fields[field]['expires_after'])
+        record.update(target_data)
+
+def build_config(field_count, weewx_root=None, snapshot_file=None):
+    """ Build a FieldCache configuration with field_count fields. """
+    config_dict = {
+        'FieldCache': {
+            'fields': {}
+        }
+    }
+    for i in range(field_count):
+        config_dict['FieldCache']['fields']['field%i' % i] = {}
+
+    if weewx_root is not None:
+        config_dict['WEEWX_ROOT'] = weewx_root
+    if snapshot_file is not None:
+        config_dict['FieldCache']['snapshot_file'] = snapshot_file
+
+    return configobj.ConfigObj(config_dict)
+
+def time_new_archive_record(service, field_count):
+    """ The average time, in microseconds, of new_archive_record when half of the fields are missing. """
+    full_record = {'usUnits': weewx.US}
+    for i in range(field_count):
+        full_record['field%i' % i] = float(i)
+
+    def run():
+        record = dict(full_record)
+        for i in range(0, field_count, 2):
+            del record['field%i' % i]
+        service.new_archive_record(weewx.Event(weewx.NEW_ARCHIVE_RECORD, record=record))
+
+    return min(timeit.repeat(run, number=ITERATIONS, repeat=5)) / ITERATIONS * 1000000
+
+def benchmark_snapshot():
+    """ Compare new_archive_record with and without checkpointing the cache. """
+    print("new_archive_record, with and without snapshot_file (microseconds per record)")
+    weewx_root = tempfile.mkdtemp()
+    try:
+        for field_count in (10, 40, 100):
+            service = FieldCache(Engine(), build_config(field_count))
+            without_snapshot = time_new_archive_record(service, field_count)
+            service.shutDown()
+
+            service = FieldCache(Engine(), build_config(field_count, weewx_root, 'fieldcache.json'))
+            with_snapshot = time_new_archive_record(service, field_count)
+            service.shutDown()
+
+            print("  %4i fields: %8.2f without, %8.2f with" % (field_count, without_snapshot, with_snapshot))
+    finally:
+        shutil.rmtree(weewx_root)
+
+def benchmark_cache():
+    """ Compare Cache with the dict of dicts cache it replaced. Half of the fields are missing from each record. """
+    print("Cache.update_record vs dict of dicts (microseconds per record)")
+    for field_count in (10, 100, 1000):
+        fields = {}
+        full_record = {'usUnits': weewx.US}
+        for i in range(field_count):
+            fields['field%i' % i] = {'expires_after': None}
+            full_record['field%i' % i] = float(i)
+        partial_record = dict(full_record)
+        for i in range(0, field_count, 2):
+            del partial_record['field%i' % i]
+
+        dict_cache = DictCache(weewx.US)
+        dict_cache.update_record(dict(full_record), fields)
+        dict_time = min(timeit.repeat(lambda: dict_cache.update_record(dict(partial_record), fields),
+                                      number=ITERATIONS // 10, repeat=5)) / (ITERATIONS // 10) * 1000000
+
+        cache = Cache(weewx.US, {field: None for field in fields})
+        cache.update_record(dict(full_record), time.time())
+        cache_time = min(timeit.repeat(lambda: cache.update_record(dict(partial_record), time.time()),
+                                       number=ITERATIONS // 10, repeat=5)) / (ITERATIONS // 10) * 1000000
+
+        print("  %4i fields: %8.2f dict of dicts, %8.2f Cache" % (field_count, dict_time, cache_time))
+
+def benchmark_loop():
+    """ The cost of filling loop packets, as reported by the service's own loop statistics. """
+    print("new_loop_packet, 30 field packet (microseconds per packet)")
+    for field_count in (10, 100, 300, 1000):
+        config = build_config(field_count)
+        config['FieldCache']['binding'] = 'loop'
+        service = FieldCache(Engine(), config)
+
+        packet = {'usUnits': weewx.US}
+        for i in range(field_count):
+            packet['field%i' % i] = float(i)
+        service.new_loop_packet(weewx.Event(weewx.NEW_LOOP_PACKET, packet=packet))
+        service.loop_stats.reset()
+
+        packet = {'usUnits': weewx.US}
+        for i in range(30):
+            packet['observation%i' % i] = float(i)
+        for _ in range(ITERATIONS):
+            service.new_loop_packet(weewx.Event(weewx.NEW_LOOP_PACKET, packet=dict(packet)))
+
+        stats = service.loop_stats.summary()
+        print("  %4i fields: %8.2f p50, %8.2f max" % (field_count, stats['p50'], stats['max']))
+
+if __name__ == "__main__":
+    benchmark_loop()
+    benchmark_cache()
+    benchmark_snapshot()
@@ -0,0 +1,48 @@
+#
+#    Copyright (c) 2024 Rich Bell <bellrichm@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+"""
+Benchmarks for user.instrumentation.
+
+Run from the repository root:
+    PYTHONPATH=bin python utils/benchmarkInstrumentation.py
+"""
+
+import timeit
+
+import weewx
+
+from user.instrumentation import HandlerStats, timed
+
+ITERATIONS = 100000
+REPEAT = 5
+
+def handler(event):
+    """ A handler that does nothing, so that only the wrapper is timed. """
+
+def benchmark_overhead():
+    """ The cost a timed handler adds to each call, including once the samples are full. """
+    print("Overhead of a timed handler (microseconds per call)")
+    event = weewx.Event(weewx.NEW_LOOP_PACKET, packet={})
+    for max_samples in (ITERATIONS * REPEAT, 1000):
+        stats = HandlerStats(max_samples)
+        wrapper = timed(handler, stats)
+        direct_time = min(timeit.repeat(lambda: handler(event), number=ITERATIONS, repeat=REPEAT)) / ITERATIONS * 1000000
+        timed_time = min(timeit.repeat(lambda: wrapper(event), number=ITERATIONS, repeat=REPEAT)) / ITERATIONS * 1000000
+        print("  max_samples %7i: %6.3f direct, %6.3f timed, %6.3f overhead"
+              % (max_samples, direct_time, timed_time, timed_time - direct_time))
+
+def benchmark_summary():
+    """ The cost of the archive period summary of a full sample. """
+    print("Summary of 1000 samples (microseconds)")
+    stats = HandlerStats(1000)
+    for i in range(1000):
+        stats.add(i / 1000000)
+    summary_time = min(timeit.repeat(stats.summary, number=1000, repeat=REPEAT)) / 1000 * 1000000
+    print("  %8.2f" % summary_time)
+
+if __name__ == "__main__":
+    benchmark_overhead()
+    benchmark_summary()
@@ -0,0 +1,271 @@
+#
+#    Copyright (c) 2024 Rich Bell <bellrichm@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+"""
+Benchmarks for user.observationtime.
+
+Run from the repository root:
+    PYTHONPATH=bin python utils/benchmarkObservationTime.py
+"""
+
+import math
+import random
+import shutil
+import tempfile
+import timeit
+
+import weewx
+import weewx.manager
+from weeutil.weeutil import TimeSpan
+
+from user.observationtime import ObservationTime, ObservationTimeXtype, manage_indexes, query_aggregates, \
+    INDEXED_SQL_STMTS, SQL_STMTS
+
+ARCHIVE_INTERVAL = 30 * 60
+LOOP_INTERVAL = 2.5
+REPEAT = 5
+
+class Engine(object):
+    """ Just enough of an engine to create a service. """
+    def bind(self, event_type, callback):
+        """ Events are not dispatched by the benchmarks. """
+
+def build_config(observation_count, statistic_types=()):
+    """ Build an ObservationTime configuration tracking first, last, min, and max of observation_count observations. """
+    observations = {}
+    for i in range(observation_count):
+        observations['observation%i' % i] = {}
+        for aggregate_type in ('first', 'last', 'min', 'max'):
+            observations['observation%i' % i][aggregate_type] = {
+                'observation_name': 'observation%i_%s' % (i, aggregate_type),
+                'observation_time_name': 'observation%i_%s_time' % (i, aggregate_type),
+            }
+        for aggregate_type in statistic_types:
+            observations['observation%i' % i][aggregate_type] = {
+                'observation_name': 'observation%i_%s' % (i, aggregate_type),
+            }
+    return {
+        'StdArchive': {'archive_interval': ARCHIVE_INTERVAL},
+        'ObservationTime': {'observations': observations},
+    }
+
+def build_packets(observation_count, start):
+    """ An archive interval of loop packets. """
+    packets = []
+    packet_time = start + LOOP_INTERVAL
+    while packet_time <= start + ARCHIVE_INTERVAL:
+        packet = {'dateTime': packet_time, 'usUnits': weewx.US}
+        for i in range(observation_count):
+            packet['observation%i' % i] = random.uniform(0, 100)
+        packets.append(packet)
+        packet_time += LOOP_INTERVAL
+    return packets
+
+class DictObservationTime(object):
+    """ The per packet dictionary that the streaming aggregates replaced, kept as the baseline. """
+    def __init__(self, observations):
+        self.observations = observations
+        self.data = {observation: {} for observation in observations}
+
+    def new_loop_packet(self, packet):
+        """ Save every packet's value. """
+        for observation in self.observations:
+            if packet.get(observation) is None:
+                continue
+            observation_time = packet['dateTime']
+            self.data[observation][str(observation_time)] = {}
+            self.data[observation][str(observation_time)]['value'] = packet[observation]
+            self.data[observation][str(observation_time)]['time'] = observation_time
+
+    def new_archive_record(self, record):
+        """ Walk the saved values. """
+        end_time_stamp = record['dateTime']
+        start_timestamp = end_time_stamp - record['interval'] * 60
+        for observation, observation_data in self.observations.items():
+            values = {'first': None, 'last': None, 'min': None, 'max': None}
+            data = self.data[observation]
+            for key in list(data):
+                observation_time = data[key]['time']
+                observation_value = data[key]['value']
+                if observation_time <= start_timestamp:
+                    del data[key]
+                    continue
+                if observation_time > end_time_stamp:
+                    break
+                if values['first'] is None:
+                    values['first'] = (observation_value, observation_time)
+                values['last'] = (observation_value, observation_time)
+                if values['min'] is None or observation_value <= values['min'][0]:
+                    values['min'] = (observation_value, observation_time)
+                if values['max'] is None or observation_value >= values['max'][0]:
+                    values['max'] = (observation_value, observation_time)
+                del data[key]
+
+            for observation_type in observation_data:
+                if values[observation_type] is not None:
+                    record[observation_data[observation_type]['observation_name']] = values[observation_type][0]
+                    record[observation_data[observation_type]['observation_time_name']] = values[observation_type][1]
+
+def benchmark_archive_interval():
+    """ Time one 30 minute archive interval of 2.5 second loop packets. """
+    print("One %i minute archive interval of %s second loop packets (milliseconds)" % (ARCHIVE_INTERVAL // 60, LOOP_INTERVAL))
+    start = ARCHIVE_INTERVAL * 1000000
+    for observation_count in (1, 10, 100):
+        config_dict = build_config(observation_count)
+        packets = build_packets(observation_count, start)
+
+        baseline = DictObservationTime(config_dict['ObservationTime']['observations'])
+        def run_baseline():
+            for packet in packets:
+                baseline.new_loop_packet(packet)
+            baseline.new_archive_record({'dateTime': start + ARCHIVE_INTERVAL, 'interval': ARCHIVE_INTERVAL // 60})
+
+        service = ObservationTime(Engine(), config_dict)
+        def run_service():
+            for packet in packets:
+                service.new_loop_packet(weewx.Event(weewx.NEW_LOOP_PACKET, packet=packet))
+            service.new_archive_record(weewx.Event(weewx.NEW_ARCHIVE_RECORD,
+                                                   record={'dateTime': start + ARCHIVE_INTERVAL,
+                                                           'interval': ARCHIVE_INTERVAL // 60}))
+
+        baseline_time = min(timeit.repeat(run_baseline, number=1, repeat=REPEAT)) * 1000
+        service_time = min(timeit.repeat(run_service, number=1, repeat=REPEAT)) * 1000
+        service.shutDown()
+
+        print("  %3i observations, %i packets: %8.2f per packet dictionary, %8.2f streaming"
+              % (observation_count, len(packets), baseline_time, service_time))
+
+def benchmark_statistics():
+    """ The cost of adding count, stddev, p50, p90, and p99 to the first, last, min, and max. """
+    print("One %i minute archive interval, without and with the statistics (milliseconds)" % (ARCHIVE_INTERVAL // 60))
+    start = ARCHIVE_INTERVAL * 1000000
+    for observation_count in (1, 10, 100):
+        packets = build_packets(observation_count, start)
+        times = []
+        for statistic_types in ((), ('count', 'stddev', 'p50', 'p90', 'p99')):
+            service = ObservationTime(Engine(), build_config(observation_count, statistic_types))
+            def run():
+                for packet in packets:
+                    service.new_loop_packet(weewx.Event(weewx.NEW_LOOP_PACKET, packet=packet))
+                service.new_archive_record(weewx.Event(weewx.NEW_ARCHIVE_RECORD,
+                                                       record={'dateTime': start + ARCHIVE_INTERVAL,
+                                                               'interval': ARCHIVE_INTERVAL // 60}))
+            times.append(min(timeit.repeat(run, number=1, repeat=REPEAT)) * 1000)
+            service.shutDown()
+
+        print("  %3i observations, %i packets: %8.2f without, %8.2f with" % (observation_count, len(packets), times[0], times[1]))
+
+def seasonal_value(timestamp):
+    """ A temperature like value, with a yearly and a daily cycle and some noise. """
+    return 50 + 40 * math.sin(2 * math.pi * timestamp / (365 * 24 * 3600)) \
+        + 10 * math.sin(2 * math.pi * timestamp / (24 * 3600)) + random.gauss(0, 3)
+
+def create_archive(sqlite_root, observations, start, stop, archive_interval, seasonal=False):
+    """ An archive of random, or seasonal, values of the observations. """
+    schema = [('dateTime', 'INTEGER NOT NULL UNIQUE PRIMARY KEY'),
+              ('usUnits', 'INTEGER NOT NULL'),
+              ('interval', 'INTEGER NOT NULL')]
+    for observation_data in observations.values():
+        for observation_type_data in observation_data.values():
+            schema.append((observation_type_data['observation_name'], 'REAL'))
+            schema.append((observation_type_data['observation_time_name'], 'INTEGER'))
+    database_dict = {'driver': 'weedb.sqlite', 'database_name': 'archive.sdb', 'SQLITE_ROOT': sqlite_root}
+    db_manager = weewx.manager.Manager.open_with_create(database_dict, schema=schema)
+
+    records = []
+    record_time = start + archive_interval
+    while record_time <= stop:
+        record = {'dateTime': record_time, 'usUnits': weewx.US, 'interval': archive_interval // 60}
+        for observation_data in observations.values():
+            for observation_type_data in observation_data.values():
+                if seasonal:
+                    record[observation_type_data['observation_name']] = seasonal_value(record_time)
+                else:
+                    record[observation_type_data['observation_name']] = random.uniform(0, 100)
+                record[observation_type_data['observation_time_name']] = record_time - random.randint(1, archive_interval)
+        records.append(record)
+        record_time += archive_interval
+    db_manager.addRecord(records)
+    db_manager.first_timestamp = db_manager.firstGoodStamp()
+    db_manager.last_timestamp = db_manager.lastGoodStamp()
+    return db_manager
+
+def benchmark_series():
+    """ Compare get_series with one get_aggregate per bucket, for a year of hourly archive records. """
+    print("A series of the times of the hourly and daily max over a year of hourly records (milliseconds)")
+    observations = build_config(1)['ObservationTime']['observations']
+    stop = 3600 * 24 * 20000
+    start = stop - 365 * 24 * 3600
+    timespan = TimeSpan(start, stop)
+    obs_type = observations['observation0']['max']['observation_time_name']
+
+    sqlite_root = tempfile.mkdtemp()
+    try:
+        db_manager = create_archive(sqlite_root, observations, start, stop, 3600)
+        for aggregate_interval in (3600, 24 * 3600):
+            def run_per_bucket():
+                xtype = ObservationTimeXtype(observations)
+                bucket_start = start
+                while bucket_start < stop:
+                    xtype.get_aggregate(obs_type, TimeSpan(bucket_start, bucket_start + aggregate_interval), 'max', db_manager)
+                    bucket_start += aggregate_interval
+
+            def run_series():
+                xtype = ObservationTimeXtype(observations)
+                xtype.get_series(obs_type, timespan, db_manager, aggregate_type='max', aggregate_interval=aggregate_interval)
+
+            per_bucket_time = min(timeit.repeat(run_per_bucket, number=1, repeat=REPEAT)) * 1000
+            series_time = min(timeit.repeat(run_series, number=1, repeat=REPEAT)) * 1000
+            print("  %5i second buckets: %8.2f one query per bucket, %8.2f get_series"
+                  % (aggregate_interval, per_bucket_time, series_time))
+        db_manager.close()
+    finally:
+        shutil.rmtree(sqlite_root)
+
+def benchmark_indexes():
+    """ Compare the min and max queries without the indexes, with the indexes and the plan SQLite chooses,
+    and with the indexes forced, on two years of five minute records of a seasonal value.
+    Each span is timed ending at each quarter of the last year, the slowest is reported. """
+    print("min and max of a seasonal value, without indexes, with indexes, with the indexes forced (milliseconds)")
+    observations = build_config(1)['ObservationTime']['observations']
+    observation_types = {aggregate_type: observations['observation0'][aggregate_type] for aggregate_type in ('min', 'max')}
+    observations = {'observation0': observation_types}
+    year = 365 * 24 * 3600
+    stop = 3600 * 24 * 20000
+    start = stop - 2 * year
+    spans = [('week', 7 * 24 * 3600), ('month', 31 * 24 * 3600), ('90 days', 90 * 24 * 3600),
+             ('180 days', 180 * 24 * 3600), ('year', year)]
+    forced_sql_stmts = dict(SQL_STMTS)
+    forced_sql_stmts.update(INDEXED_SQL_STMTS)
+
+    sqlite_root = tempfile.mkdtemp()
+    try:
+        db_manager = create_archive(sqlite_root, observations, start, stop, 300, seasonal=True)
+        results = {}
+        for plan, sql_stmts in (('without', SQL_STMTS), ('with', SQL_STMTS), ('forced', forced_sql_stmts)):
+            if plan == 'with':
+                manage_indexes(db_manager, observations, True)
+            for name, span in spans:
+                slowest = 0
+                for quarter in range(4):
+                    timespan = TimeSpan(stop - quarter * year // 4 - span, stop - quarter * year // 4)
+                    def run():
+                        query_aggregates(db_manager, sql_stmts, db_manager.table_name, observation_types,
+                                         timespan.start, timespan.stop)
+                    slowest = max(slowest, min(timeit.repeat(run, number=1, repeat=REPEAT)) * 1000)
+                results[(name, plan)] = slowest
+        db_manager.close()
+    finally:
+        shutil.rmtree(sqlite_root)
+
+    for name, _ in spans:
+        print("  %-8s: %8.2f without, %8.2f with, %8.2f forced"
+              % (name, results[(name, 'without')], results[(name, 'with')], results[(name, 'forced')]))
+
+if __name__ == "__main__":
+    benchmark_archive_interval()
+    benchmark_statistics()
+    benchmark_series()
+    benchmark_indexes()